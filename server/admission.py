@@ -0,0 +1,86 @@
+# Admission control for the CPU-heavy endpoints (import, sample, feedback)
+# Each worker runs at most DUO_HEAVY_CONCURRENCY heavy requests at once; up to DUO_HEAVY_QUEUE more wait for a slot,
+# and requests beyond that are turned away right away with a 503 and a Retry-After header instead of slowing everyone down.
+# Light endpoints (e.g. /duo/api, /resume) are not gated, so they never wait behind heavy work.
+
+import os, time, functools, threading
+from flask import request
+
+import metrics
+
+HEAVY_CONCURRENCY = int(os.environ.get('DUO_HEAVY_CONCURRENCY', 2))    # Max number of heavy requests running at once per worker
+HEAVY_QUEUE = int(os.environ.get('DUO_HEAVY_QUEUE', 32))   # Max number of heavy requests waiting for a slot per worker
+HEAVY_QUEUE_TIMEOUT = float(os.environ.get('DUO_HEAVY_QUEUE_TIMEOUT', 30))  # Max seconds a heavy request waits for a slot
+RETRY_AFTER = int(os.environ.get('DUO_RETRY_AFTER', 2))    # Seconds clients are asked to wait before retrying a rejected request
+
+queue_seconds = metrics.Histogram('queue_seconds', 'Time heavy requests waited for a slot, by endpoint', ('endpoint',))
+
+# Gate: Bounds the number of requests running at once, with a bounded number of requests waiting for a slot
+class Gate(object):
+    def __init__(self, concurrency, max_waiting, timeout):
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.slots = threading.Semaphore(concurrency)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0   # turned away because the queue was full
+        self.timeouts = 0   # turned away after waiting too long for a slot
+
+    # Take a slot, waiting for one if the queue has room
+    # Returns the seconds waited, or None if the request was turned away
+    def enter(self):
+        with self.lock:
+            if self.slots.acquire(blocking=False):
+                self.running += 1
+                self.admitted += 1
+                return 0.0
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                return None
+            self.waiting += 1
+        start = time.perf_counter()
+        acquired = self.slots.acquire(timeout=self.timeout)
+        with self.lock:
+            self.waiting -= 1
+            if not acquired:
+                self.timeouts += 1
+                return None
+            self.running += 1
+            self.admitted += 1
+        return time.perf_counter() - start
+
+    def leave(self):
+        with self.lock:
+            self.running -= 1
+        self.slots.release()
+
+heavy = Gate(HEAVY_CONCURRENCY, HEAVY_QUEUE, HEAVY_QUEUE_TIMEOUT)
+
+# Run a heavy request handler once it gets a slot, or tell the client to retry later
+# Use as a method decorator of a Resource: method_decorators = {'post': [admission.admit]}
+def admit(handler):
+    @functools.wraps(handler)
+    def admitted(*args, **kwargs):
+        waited = heavy.enter()
+        if waited is None:
+            return {'msg': '[BUSY] The server is busy; retry in ' + str(RETRY_AFTER) + ' seconds', 'retry_after': RETRY_AFTER}, 503, {'Retry-After': str(RETRY_AFTER), 'Access-Control-Allow-Origin': '*'}
+        queue_seconds.observe(waited, request.url_rule.rule if request.url_rule is not None else 'unmatched')
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            heavy.leave()
+    return admitted
+
+def stats():
+    return {
+        'concurrency': heavy.concurrency,
+        'max_waiting': heavy.max_waiting,
+        'running': heavy.running,
+        'waiting': heavy.waiting,
+        'admitted': heavy.admitted,
+        'rejected': heavy.rejected,
+        'timeouts': heavy.timeouts,
+    }
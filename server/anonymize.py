@@ -1,13 +1,17 @@
 # Anonymizes participant details to hide PII
 
+import os
 import json
 import pickle
 import copy
 import numpy as np
 from pkl2json import pkl2jsonRecursive
-from api import User
+from studydb import User
+import studydb
+import sessions
 
 def anonymize():
+    studydb.users.exportPickle('./study-utils/users.p')
     users: dict[str, User] = pickle.load( open('./study-utils/users.p', 'rb') )
     with open('./study-utils/users.json', 'r') as f:
         users_json = json.load(f)
@@ -17,6 +21,13 @@ def anonymize():
         if '@anonymized.com' not in email and 'test' not in users_json[email]['background']:
             new_email = 'participant' + str(i+1) + '@anonymized.com'
             for run in user.runs:
+                for name in [sessions.STATIC_NAME, sessions.SNAPSHOT_NAME]:    # The project info of runs stored as a snapshot is in the static objects (or, for older runs, the snapshot)
+                    snapshot = sessions.readSnapshot('./docker-out/' + run, name)
+                    if snapshot is not None and 'project_info.json' in snapshot['objects'].keys():
+                        snapshot['objects']['project_info.json']['email'] = new_email
+                        sessions.writeSnapshot('./docker-out/' + run, sessions.serializeSnapshot(snapshot['objects'], snapshot['iteration'], snapshot.get('events')), name)
+                if not os.path.isfile('./docker-out/' + run + '/project_info.json'):
+                    continue
                 with open('./docker-out/' + run + '/project_info.json', 'r') as f:
                     project_info = json.load(f)
                 project_info['email'] = new_email
@@ -26,6 +37,7 @@ def anonymize():
             anonymized_users[new_email].background = users_json[email]['background']
             # del users[email]
     pickle.dump( anonymized_users, open('./study-utils/users.p', 'wb') )
+    studydb.users.importPickle('./study-utils/users.p', replace=True)  # Replace the stored users with the anonymized ones
     pkl2jsonRecursive('real')
 
 if __name__ == '__main__':
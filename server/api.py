@@ -1,56 +1,70 @@
-import json, os, time, pickle, math, logging
+import json, os, time, pickle, math, logging, functools
 import random
 from pprint import pprint
 from random import shuffle
 from datetime import datetime
 
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, request, send_file, jsonify, Response
 from flask_restful import Resource, Api, reqparse, abort
 from flask_cors import CORS, cross_origin
-from flask_csv import send_csv
 
 import pandas as pd
 import numpy as np
 from rich.console import Console
 
-import helpers, analyze
+import helpers, sessions, datasets, scenarios, studydb, eventlog, speculation, payloads, metrics, profiler, admission, warmup
+from studydb import User
 
 console = Console()
 
+# Get the project ID and iteration of the current request, for naming its profile
+def requestProject():
+    body = request.get_json(silent=True) if request.is_json else None
+    project_id = body.get('project_id') if isinstance(body, dict) else request.form.get('project_id')
+    if project_id is None:
+        return None, None
+    return project_id, sessions.peek(str(project_id), 'current_iter.p')
+
+# Profile a sample of requests with cProfile (see profiler.py)
+def profileRequest(view):
+    @functools.wraps(view)
+    def profiled(*args, **kwargs):
+        if not profiler.request_profiler.wants(request.headers.get(profiler.PROFILE_HEADER)):
+            return view(*args, **kwargs)
+        return profiler.request_profiler.run(request.endpoint, requestProject, view, *args, **kwargs)
+    return profiled
+
 # Flask configs
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
-api = Api(app)
+api = Api(app, decorators=[profileRequest])
 logging.getLogger('flask_cors').level = logging.DEBUG
 
 TOTAL_SCENARIOS = 5
 
-class User(object):
-    def __init__(self):
-        with open('scenarios-for-study.json', 'r') as f:
-            data = json.load(f)
-        self.scenarios = data['scenarios']
-        shuffle(self.scenarios)
-        self.start_time = datetime.now()
-        self.done = list()
-        self.runs = list()
-        self.pre_survey = dict()
-        self.post_questionnaire = dict()
-        self.comments = ''
-        self.background = list()
-        console.log(self.scenarios)
-    
-    def asdict(self):
-        return {
-            'scenarios': self.scenarios,
-            'start_time': self.start_time.strftime("%m/%d/%Y, %H:%M:%S"),
-            'done': self.done,
-            'runs': self.runs if hasattr(self, 'runs') else None,
-            'pre_survey': self.pre_survey,
-            'post_questionnaire': self.post_questionnaire,
-            'comments': self.comments if hasattr(self, 'comments') else None,
-            'background': self.background
-        }
+metrics.register('sessions', sessions.stats, counters=['hits', 'misses', 'writes', 'coalesced_writes'])
+metrics.register('eventlog', eventlog.stats, counters=['appends', 'syncs'])
+metrics.register('datasets', datasets.stats, counters=['loads', 'hits', 'shared_loads'])
+metrics.register('speculation', speculation.stats, counters=['hits', 'misses', 'late', 'cold', 'errors'])
+metrics.register('profiler', profiler.stats, counters=['profiled', 'skipped'])
+metrics.register('admission', admission.stats, counters=['admitted', 'rejected', 'timeouts'])
+metrics.register('startup', warmup.stats)
+
+# Start timing each request
+@app.before_request
+def startRequest():
+    metrics.begin(request.url_rule.rule if request.url_rule is not None else 'unmatched', request.content_length)
+
+# Record each request's latency and response size (registered first, so it runs after the other after_request functions)
+@app.after_request
+def endRequest(response):
+    metrics.end(request.method, response.status_code, response.calculate_content_length())
+    return response
+
+# Compress large responses for clients that accept gzip
+@app.after_request
+def compressResponse(response):
+    return payloads.gzipResponse(request, response)
 
 # Test endpoint to check if the server is live
 class Test(Resource):
@@ -71,30 +85,28 @@ class Start(Resource):
             email = json.loads(request.data)['email']
         print('Email:', email)
         
-        # Load the users list
-        try:
-            users = pickle.load( open('./study-utils/users.p', 'rb') )
-        except:
-            users = dict()
+        user = studydb.users.get(email)
+        if user is None:    # Store the user in the users list
+            user = User()
+            created = studydb.users.create(email, user)
+            if not created:    # Another request registered this email first
+                user = studydb.users.get(email)
+        else:
+            created = False
         
-        if email in users.keys():   # Get the already existing user
-            user = users[email]
+        if not created:   # Get the already existing user
             console.log(user.scenarios)
             scenarios_left = [s for s in user.scenarios if s not in user.done]
             status_code = 200
             response = {
                 'scenarios': scenarios_left
             }
-        else:   # Store the user in the users list
-            user = User()
-            users[email] = user
+        else:
             status_code = 201
             response = {
                 'scenarios': user.scenarios
             }
         
-        pickle.dump( users, open('./study-utils/users.p', 'wb') )
-        
         # Return
         return response, status_code, {'Access-Control-Allow-Origin': '*'}
     
@@ -111,28 +123,13 @@ class PreSurvey(Resource):
             email = json.loads(request.data)['email']
             answers = json.loads(request.data)['answers']
         
-        # Get the user from the users list
-        try:
-            users = pickle.load( open('./study-utils/users.p', 'rb'))
-        except:
-            return {'msg': '[ERROR] users does not exist'}, 400, {'Access-Control-Allow-Origin': '*'}
-        
         # Save the user's questionnaire responses
-        if email not in users.keys():
-            return {'msg': '[ERROR] no user exists with this email'}, 400, {'Access-Control-Allow-Origin': '*'}
-        
-        user = users[email]
-        user.pre_survey = answers
-        users[email] = user
-
-        # Save the users object updates
-        pickle.dump( users, open('./study-utils/users.p', 'wb') )
+        with studydb.users.edit(email) as user:
+            if user is None:
+                return {'msg': '[ERROR] no user exists with this email'}, 400, {'Access-Control-Allow-Origin': '*'}
+            user.pre_survey = answers
 
-        with open('scenarios.json', 'r') as f:
-            scenarios_list = json.load(f)
-        scenario = scenarios_list[scenario_id]
-        data = pd.read_csv(scenario['dirty_dataset'])
-        header = [col for col in data.columns]
+        header = scenarios.registry.header(scenario_id)
 
         response = {
             'header': header,
@@ -141,17 +138,14 @@ class PreSurvey(Resource):
         return response, 201, {'Access-Control-Allow-Origin': '*'}
 
 class Import(Resource):
+    method_decorators = {'post': [admission.admit]}   # CPU-heavy: admitted through the bounded queue
+
     def get(self):
         return {'msg': '[SUCCESS] /duo/api/import is live!'}
 
     def post(self):
         # Initialize a new project
-        projects = [('0x' + d) for d in os.listdir('./store') if os.path.isdir(os.path.join('./store/', d))]
-        if len(projects) == 0:
-            new_project_id = '{:08x}'.format(1)
-        else:
-            project_ids = [int(d, 0) for d in projects]
-            new_project_id = '{:08x}'.format(max(project_ids) + 1)
+        new_project_id = studydb.project_ids.next()
         new_project_dir = './store/' + new_project_id
         
         # Save the new project
@@ -185,31 +179,18 @@ class Import(Resource):
         console.log(initial_user_h)
 
         if not skip_user:
-            # Get the user from the users list
-            try:
-                users = pickle.load( open('./study-utils/users.p', 'rb'))
-            except:
-                return {'msg': '[ERROR] users does not exist'}, 400, {'Access-Control-Allow-Origin': '*'}
-            
-            # Save the user's questionnaire responses
-            if email not in users.keys():
-                return {'msg': '[ERROR] no user exists with this email'}, 400, {'Access-Control-Allow-Origin': '*'}
-            
-            user = users[email]
-            user.scenarios = user.scenarios[1:]
-            user.runs.append(new_project_id)
-            user_interaction_number = TOTAL_SCENARIOS - len(user.scenarios)
-            users[email] = user
-
-            # Save the users object updates
-            pickle.dump( users, open('./study-utils/users.p', 'wb') )
+            # Record the new run for the user
+            with studydb.users.edit(email) as user:
+                if user is None:
+                    return {'msg': '[ERROR] no user exists with this email'}, 400, {'Access-Control-Allow-Origin': '*'}
+                user.scenarios = user.scenarios[1:]
+                user.runs.append(new_project_id)
+                user_interaction_number = TOTAL_SCENARIOS - len(user.scenarios)
         
         else:
             user_interaction_number = 1 if violation_ratio == 'close' else 5
 
-        with open('scenarios.json', 'r') as f:
-            scenarios_list = json.load(f)
-        scenario = scenarios_list[scenario_id]
+        scenario = scenarios.registry.scenario(scenario_id)
         # if user_interaction_number == 1:
         if user_interaction_number <= 3:
             target_h_sample_ratio = 0.2
@@ -238,71 +219,25 @@ class Import(Resource):
             'scenario': scenario
         }
 
-        with open(new_project_dir + '/project_info.json', 'w') as f:
-            json.dump(project_info, f, indent=4)
-
-        print('*** Project info saved ***')
-
-        data = pd.read_csv(scenario['dirty_dataset'])
+        data = datasets.get(scenario['dirty_dataset'])
         header = [col for col in data.columns]
         # random.shuffle(header)
 
         # Initialize the iteration counter
         current_iter = 0
 
+        # Start the project's event log; the interaction and FD metadata can be rebuilt from it
+        eventlog.init(new_project_id, header, data.index, [initial_user_h, fd_comment])
+
         # Initialize metadata objects
-        interaction_metadata = dict()
-        interaction_metadata['header'] = header
-        interaction_metadata['user_hypothesis_history'] = [helpers.StudyMetric(iter_num=current_iter, value=[initial_user_h, fd_comment], elapsed_time=0)]
-        interaction_metadata['feedback_history'] = dict()
-        interaction_metadata['sample_history'] = list()
-        for idx in data.index:
-            interaction_metadata['feedback_history'][int(idx)] = dict()
-            for col in header:
-                interaction_metadata['feedback_history'][int(idx)][col] = list()
+        interaction_metadata = helpers.initialInteractionMetadata(header, data.index, [initial_user_h, fd_comment])
         
         # Initialize hypothesis parameters
-        fd_metadata = dict()
-        h_space = scenario['hypothesis_space']
-        for h in h_space:
-
-            # Calculate the mean and variance
-            h['vio_pairs'] = set(tuple(vp) for vp in h['vio_pairs'])
-            mu = h['conf']      # h['conf'] = # tuples that satisfy FD / # tuples total
-            if mu == 1:
-                mu = 0.99999
-            variance = 0.0025   # hyperparameter
-            
-            # Calculate alpha and beta
-            alpha, beta = helpers.initialPrior(mu, variance)
-            
-            # Initialize the FD metadata object
-            fd_m = helpers.FDMeta(
-                fd=h['cfd'],
-                a=alpha,
-                b=beta,
-                support=h['support'],
-                vios=h['vios'],
-                vio_pairs=h['vio_pairs'],
-            )
-
-            print('iter: 0'),
-            print('alpha:', fd_m.alpha)
-            print('beta:', fd_m.beta)
-            print('conf:', h['conf'])
-
-            fd_metadata[h['cfd']] = fd_m
+        fd_metadata = helpers.initialFDMetadata(scenario['hypothesis_space'])
 
         current_iter += 1
 
-        study_metrics = dict()
-        study_metrics['iter_err_precision'] = list()
-        study_metrics['iter_err_recall'] = list()
-        study_metrics['iter_err_f1'] = list()
-        study_metrics['all_err_precision'] = list()
-        study_metrics['all_err_recall'] = list()
-        study_metrics['all_err_f1'] = list()
-        pickle.dump( study_metrics, open(new_project_dir + '/study_metrics.p', 'wb') )
+        study_metrics = helpers.initialStudyMetrics()
 
         # Initialize tuple metadata and value metadata objects
         tuple_weights = dict()
@@ -311,11 +246,15 @@ class Import(Resource):
             # Tuple metadata
             tuple_weights[idx] = 1/len(data)
 
-        pickle.dump( interaction_metadata, open(new_project_dir + '/interaction_metadata.p', 'wb') )
-        pickle.dump( tuple_weights, open(new_project_dir + '/tuple_weights.p', 'wb') )
-        pickle.dump( fd_metadata, open(new_project_dir + '/fd_metadata.p', 'wb') )
-        pickle.dump( current_iter, open(new_project_dir + '/current_iter.p', 'wb') )
-        pickle.dump( fd_metadata[target_fd].vio_pairs, open(new_project_dir + '/X.p', 'wb') )
+        with sessions.locked(new_project_id):   # Store the objects as one unit, which is not evicted halfway
+            sessions.dump(new_project_id, 'project_info.json', project_info)
+            sessions.dump(new_project_id, 'study_metrics.p', study_metrics)
+            sessions.dump(new_project_id, 'interaction_metadata.p', interaction_metadata)
+            sessions.dump(new_project_id, 'tuple_weights.p', tuple_weights)
+            sessions.dump(new_project_id, 'fd_metadata.p', fd_metadata)
+            sessions.dump(new_project_id, 'current_iter.p', current_iter)
+            sessions.dump(new_project_id, 'X.p', fd_metadata[target_fd].vio_pairs)
+            sessions.commit(new_project_id)
 
         print('*** Metadata and objects initialized and saved ***')
 
@@ -328,6 +267,8 @@ class Import(Resource):
 
 # Get the first sample for a scenario interaction
 class Sample(Resource):
+    method_decorators = {'post': [admission.admit]}   # CPU-heavy: admitted through the bounded queue
+
     def get(self):
         return {'msg': '[SUCCESS] /duo/api/sample is live!'}
     
@@ -337,159 +278,260 @@ class Sample(Resource):
         if project_id is None:
             # print(request.data)
             project_id = json.loads(request.data)['project_id']
-        sample_size = 10
-        with open('./store/' + project_id + '/project_info.json') as f:
-            project_info = json.load(f)
+        with sessions.locked(project_id):   # One request at a time per project; the session is not evicted meanwhile
+            sample_size = 10
+            with metrics.stage('load_state'):
+                project_info = sessions.load(project_id, 'project_info.json')
+
+            # Calculate the start time of the interaction
+            start_time = time.time()
+            sessions.dump(project_id, 'start_time.p', start_time)
+
+            print('*** Project info loaded ***')
+
+            # Get data
+            with metrics.stage('load_dataset'):
+                data = datasets.get(project_info['scenario']['dirty_dataset'])
+            with metrics.stage('load_state'):
+                current_iter = sessions.load(project_id, 'current_iter.p')
+                X = sessions.load(project_id, 'X.p') # list of true violation pairs (vio pairs for target FD)
+        
+            # Build sample
+            with metrics.stage('sample'):
+                s_out, sample_X = helpers.buildSample(data, X, sample_size, project_id, current_iter, start_time)
+            s_index = s_out.index
+            eventlog.sample(project_id, current_iter, 0, s_index, sample_X)
+            sessions.dump(project_id, 'current_sample.p', s_index)
+            sessions.dump(project_id, 'current_X.p', sample_X)
+            sessions.commit(project_id)
+            speculation.schedule(project_id, data, sample_size, current_iter + 1)  # Compute the next sample while the user labels this one
+
+            print('*** Feedback object created ***')
+
+            # Return information to the user
+            with metrics.stage('serialize'):
+                response = payloads.sampleResponse(payloads.requestedFormat(request), s_out, current_iter, sample_X, lambda idx, col: False, '[SUCCESS] Successfully built sample.')
+            return response, 200, {'Access-Control-Allow-Origin': '*'}
+
+# Apply one feedback submission to a project: record and analyze the feedback, then get the next sample
+# Call with the project's session lock held; the caller commits the project's state
+# Raises ValueError if the feedback has a cell that does not belong to the current sample; nothing is logged then
+# Returns the new sample, its true violation pairs, the new iteration number, the dataset, the interaction metadata, and the status message
+def applyFeedbackSubmission(project_id, feedback_dict, marked, sample_id, current_user_h, user_h_comment, speculate=True):
+    sample_size = 10
+
+    print('*** Necessary objects loaded ***')
+
+    # Get the current iteration count and current time
+    with metrics.stage('load_state'):
+        current_iter = sessions.load(project_id, 'current_iter.p')
+        print(current_iter)
+        current_time = time.time()
 
-        # Calculate the start time of the interaction
-        start_time = time.time()
-        pickle.dump( start_time, open('./store/' + project_id + '/start_time.p', 'wb') )
+        curr_sample_X = sessions.load(project_id, 'current_X.p')
+        X = sessions.load(project_id, 'X.p')
 
-        print('*** Project info loaded ***')
+        print('*** Iteration counter updated ***')
 
-        # Get data
-        data = pd.read_csv(project_info['scenario']['dirty_dataset'], keep_default_na=False)
-        current_iter = pickle.load( open('./store/' + project_id + '/current_iter.p', 'rb') )
-        X = pickle.load( open('./store/' + project_id + '/X.p', 'rb') ) # list of true violation pairs (vio pairs for target FD)
-        
-        # Build sample
-        s_out, sample_X = helpers.buildSample(data, X, sample_size, project_id, current_iter, start_time)
-        s_index = s_out.index
-        pickle.dump( s_index, open('./store/' + project_id + '/current_sample.p', 'wb') )
-        pickle.dump( sample_X, open('./store/' + project_id + '/current_X.p', 'wb') )
-
-        # Add ID to s_out (for use on frontend)
-        s_out.insert(0, 'id', s_out.index, True)
-        
-        # Build initial feedback map for frontend
-        feedback = list()
-        for idx in s_out.index:
-            for col in s_out.columns:
-                feedback.append({
-                    'row': idx,
-                    'col': col,
-                    'marked': False
-                })
-
-        print('*** Feedback object created ***')
+        # Get the project info
+        project_info = sessions.load(project_id, 'project_info.json')
 
-        # Return information to the user
-        response = {
-            'sample': s_out.to_json(orient='index'),
-            'X': [list(v) for v in sample_X],
-            'feedback': json.dumps(feedback),
-            'msg': '[SUCCESS] Successfully built sample.'
-        }
-        return response, 200, {'Access-Control-Allow-Origin': '*'}
+    print('*** Project info loaded ***')
+    
+    # Load the dataset
+    with metrics.stage('load_dataset'):
+        data = datasets.get(project_info['scenario']['dirty_dataset'])
+
+    print('*** Loaded dirty dataset ***')
+
+    # Get the user's feedback: only the marked cells of the sample, or the full map of the sample's cells
+    if marked is not None:
+        feedback_dict = feedback = payloads.sparseFeedback(sample_id, marked, current_iter, sessions.load(project_id, 'current_sample.p'), data.columns)
+        s_in = data.iloc[feedback.rows]
+    else:
+        feedback = payloads.fullFeedback(feedback_dict, sessions.load(project_id, 'current_sample.p'), data.columns)
+        s_in = data.iloc[feedback.index]
+
+    # Record the user's feedback and analyze it
+    print('*** Extracted sample from dataset ***')
+    start_time = sessions.load(project_id, 'start_time.p')
+    with metrics.stage('record'):
+        eventlog.feedback(project_id, current_iter, current_time - start_time, feedback_dict)
+        helpers.recordFeedback(data, feedback_dict, curr_sample_X, project_id, current_iter, current_time)
+    target_fd = project_info['scenario']['target_fd'] # NOTE: For current sims only
+    with metrics.stage('interpret'):
+        helpers.interpretFeedback(s_in, feedback, X, curr_sample_X, project_id, current_iter, current_time)
+
+    # Get the new sample (computed in the background while the user labeled the last one, if still valid)
+    current_iter += 1
+    with metrics.stage('sample'):
+        if speculate:
+            s_out, new_sample_X = speculation.take(project_id, data, sample_size, current_iter)
+        else:
+            s_out, new_sample_X = helpers.buildSample(data, X, sample_size, project_id, current_iter, current_time)
+    s_index = s_out.index
+    eventlog.sample(project_id, current_iter, current_time - start_time, s_index, new_sample_X)
+    sessions.dump(project_id, 'current_sample.p', s_index)
+    sessions.dump(project_id, 'current_X.p', new_sample_X)
+
+    print(s_out.index)
+    
+    elapsed_time = current_time - start_time
+    interaction_metadata = sessions.load(project_id, 'interaction_metadata.p')
+    eventlog.hypothesis(project_id, current_iter-1, elapsed_time, [current_user_h, user_h_comment])
+    interaction_metadata['user_hypothesis_history'].append(helpers.StudyMetric(iter_num=current_iter-1, value=[current_user_h, user_h_comment], elapsed_time=elapsed_time))   # current iter - 1 because it's for the prev iter (i.e. before incrementing current_iter)
+    sessions.dump(project_id, 'interaction_metadata.p', interaction_metadata)
+
+    # Check if the scenario is done
+    # if current_iter <= 5:
+    #     terminate = False
+    # else:
+    #     terminate = helpers.checkForTermination(project_id)
+    if current_iter > 15:
+        msg = '[DONE]'
+    else:
+        msg = '[SUCCESS]: Saved feedback and built new sample.'
+
+    # Save object updates
+    sessions.dump(project_id, 'current_iter.p', current_iter)
+
+    return s_out, new_sample_X, current_iter, data, interaction_metadata, msg
+
+BAD_SUBMISSION = (ValueError, KeyError, IndexError, TypeError, AttributeError)   # Errors caused by a malformed submission
+
+# Check the shape of a feedback submission before any submission of its batch is applied
+# Returns what is wrong with the submission, or None if it is well-formed
+def submissionError(sub):
+    if not isinstance(sub, dict):
+        return 'must be an object'
+    for key in ('current_user_h', 'user_h_comment'):
+        if key not in sub.keys():
+            return 'missing ' + key
+    if sub.get('marked') is not None:
+        if not isinstance(sub['marked'], list):
+            return 'marked must be a list of cells'
+        if sub.get('sample_id') is None:
+            return 'marked requires sample_id'
+    elif not isinstance(sub.get('feedback'), dict):
+        return 'needs a feedback map or a list of marked cells'
+    return None
+
+# Apply an ordered list of feedback submissions to a project in one transaction, then commit the project's state
+# Call with the project's session lock held, with at least one submission, after checking each of them with submissionError
+# Returns the response of every applied submission (they stop at the one that ends the scenario), the new iteration number, and the last status message
+# Raises the error of the submission that failed after rolling all of them back (malformed submissions raise one of BAD_SUBMISSION)
+def applySubmissions(project_id, submissions, fmt):
+    sessions.flush(project_id)     # Start from a snapshot the submissions can be rolled back to
+    samples = list()
+    try:
+        with eventlog.transaction(project_id):     # The submissions' events are only logged if all of them are applied
+            for i, sub in enumerate(submissions):
+                try:
+                    s_out, new_sample_X, current_iter, data, interaction_metadata, msg = applyFeedbackSubmission(project_id, sub.get('feedback'), sub.get('marked'), sub.get('sample_id'), sub['current_user_h'], sub['user_h_comment'], speculate=(i == 0))
+                except BAD_SUBMISSION as e:
+                    if len(submissions) == 1:
+                        raise
+                    raise ValueError('Submission ' + str(i) + ': ' + str(e))
+                with metrics.stage('serialize'):
+                    samples.append(payloads.sampleResponse(fmt, s_out, current_iter, new_sample_X, interaction_metadata['feedback_history'].marked, msg))
+                if msg == '[DONE]':
+                    break
+    except Exception:     # Nothing of the submissions may stay applied, whatever failed
+        sessions.rollback(project_id)
+        raise
+    sessions.commit(project_id)    # Write the state after the last submission as one snapshot
+    if msg != '[DONE]':
+        speculation.schedule(project_id, data, 10, current_iter + 1)
+    return samples, current_iter, msg
 
 # Take in and analyze user feedback, and return a new sample
 class Feedback(Resource):
+    method_decorators = {'post': [admission.admit]}   # CPU-heavy: admitted through the bounded queue
+
     def get(self):
         return {'msg': '[SUCCESS] /duo/api/feedback is live!'}
     
     def post(self):
         # Get the project ID for the interaction and the user's feedback object
         project_id = request.form.get('project_id')
-        current_user_h = request.form.get('current_user_h')
-        user_h_comment = request.form.get('user_h_comment')
         if project_id is None:
             req = json.loads(request.data)
             project_id = req['project_id']
-            feedback_dict = req['feedback']
-            current_user_h = req['current_user_h']
-            user_h_comment = req['user_h_comment']
+            sub = {key: req.get(key) for key in ('feedback', 'marked', 'sample_id')}
+            sub.update({key: req[key] for key in ('current_user_h', 'user_h_comment') if key in req.keys()})
         else:
-            feedback_dict = json.loads(request.form.get('feedback'))
-
-        print(project_id)
-        console.log(current_user_h)
-
-        feedback = pd.DataFrame.from_dict(feedback_dict, orient='index')
-        sample_size = 10
-
-        print('*** Necessary objects loaded ***')
-
-        # Get the current iteration count and current time
-        current_iter = pickle.load( open('./store/' + project_id + '/current_iter.p', 'rb') )
-        print(current_iter)
-        current_time = time.time()
+            sub = {
+                'feedback': json.loads(request.form['feedback']) if 'feedback' in request.form.keys() else None,
+                'marked': json.loads(request.form['marked']) if 'marked' in request.form.keys() else None,
+                'sample_id': request.form.get('sample_id'),
+                'current_user_h': request.form.get('current_user_h'),
+                'user_h_comment': request.form.get('user_h_comment'),
+            }
 
-        curr_sample_X = pickle.load( open('./store/' + project_id + '/current_X.p', 'rb') )
-        X = pickle.load( open('./store/' + project_id + '/X.p', 'rb') )
+        console.log(str(project_id) + ': ' + str(sub.get('current_user_h')))
 
-        print('*** Iteration counter updated ***')
+        error = submissionError(sub)
+        if error is not None:
+            return {'msg': '[ERROR] Feedback ' + error}, 400, {'Access-Control-Allow-Origin': '*'}
 
-        # Get the project info
-        with open('./store/' + project_id + '/project_info.json', 'r') as f:
-            project_info = json.load(f)
-
-        print('*** Project info loaded ***')
-        
-        # Load the dataset
-        data = pd.read_csv(project_info['scenario']['dirty_dataset'], keep_default_na=False)
+        with sessions.locked(project_id):   # One request at a time per project; the session is not evicted meanwhile
+            try:
+                samples, current_iter, msg = applySubmissions(project_id, [sub], payloads.requestedFormat(request))
+            except BAD_SUBMISSION as e:
+                return {'msg': '[ERROR] ' + str(e)}, 400, {'Access-Control-Allow-Origin': '*'}
 
-        print('*** Loaded dirty dataset ***')
+            # Return information to the user, with the cells the user has marked before
+            return samples[0], 200, {'Access-Control-Allow-Origin': '*'}
 
-        # Record the user's feedback and analyze it
-        s_in = data.iloc[feedback.index]
-        print('*** Extracted sample from dataset ***')
-        helpers.recordFeedback(data, feedback_dict, curr_sample_X, project_id, current_iter, current_time)
-        target_fd = project_info['scenario']['target_fd'] # NOTE: For current sims only
-        helpers.interpretFeedback(s_in, feedback, X, curr_sample_X, project_id, current_iter, current_time)
+# Take in an ordered list of feedback submissions for a project and apply them in one transaction
+# Returns every intermediate sample and the final state; if any submission is invalid, none of them are applied
+# Body: {'project_id': ..., 'submissions': [{'feedback': ... | 'marked': ..., 'sample_id': ..., 'current_user_h': ..., 'user_h_comment': ...}, ...], 'format': ...}
+class FeedbackBatch(Resource):
+    method_decorators = {'post': [admission.admit]}   # CPU-heavy: admitted through the bounded queue
 
-        # Build a new sample
-        current_iter += 1
-        s_out, new_sample_X = helpers.buildSample(data, X, sample_size, project_id, current_iter, current_time)
-        s_index = s_out.index
-        pickle.dump( s_index, open('./store/' + project_id + '/current_sample.p', 'wb') )
-        pickle.dump( new_sample_X, open('./store/' + project_id + '/current_X.p', 'wb') )
+    def get(self):
+        return {'msg': '[SUCCESS] /duo/api/feedback-batch is live!'}
 
-        s_out.insert(0, 'id', s_out.index, True)
-        print(s_out.index)
-        
-        # Build feedback map for front-end
-        start_time = pickle.load( open('./store/' + project_id + '/start_time.p', 'rb') )
-        elapsed_time = current_time - start_time
-        feedback = list()
-        interaction_metadata = pickle.load( open('./store/' + project_id + '/interaction_metadata.p', 'rb') )
-        interaction_metadata['user_hypothesis_history'].append(helpers.StudyMetric(iter_num=current_iter-1, value=[current_user_h, user_h_comment], elapsed_time=elapsed_time))   # current iter - 1 because it's for the prev iter (i.e. before incrementing current_iter)
-        pickle.dump( interaction_metadata, open('./store/' + project_id + '/interaction_metadata.p', 'wb') )
-        
-        for idx in s_out.index:
-            for col in s_out.columns:
-                feedback.append({
-                    'row': idx,
-                    'col': col,
-                    'marked': False if col == 'id' else (bool(interaction_metadata['feedback_history'][int(idx)][col][-1].marked) if len(interaction_metadata['feedback_history'][int(idx)][col]) > 0 else False)
-                })
-
-        print('*** Feedback object created ***')
-
-        # Check if the scenario is done
-        # if current_iter <= 5:
-        #     terminate = False
-        # else:
-        #     terminate = helpers.checkForTermination(project_id)
-        if current_iter > 15:
-            msg = '[DONE]'
-        else:
-            msg = '[SUCCESS]: Saved feedback and built new sample.'
+    def post(self):
+        req = json.loads(request.data)
+        project_id = req['project_id']
+        submissions = req['submissions']
+        fmt = payloads.requestedFormat(request)
+
+        if not isinstance(submissions, list):
+            return {'msg': '[ERROR] submissions must be a list'}, 400, {'Access-Control-Allow-Origin': '*'}
+        if len(submissions) == 0:
+            return {'msg': '[ERROR] No feedback submissions'}, 400, {'Access-Control-Allow-Origin': '*'}
+        console.log(str(project_id) + ': ' + str(len(submissions)) + ' feedback submissions')
+        for i, sub in enumerate(submissions):
+            error = submissionError(sub)
+            if error is not None:
+                return {'msg': '[ERROR] Submission ' + str(i) + ': ' + error + ' (no feedback was applied)'}, 400, {'Access-Control-Allow-Origin': '*'}
+
+        with sessions.locked(project_id):   # One request at a time per project; the session is not evicted meanwhile
+            try:
+                samples, current_iter, msg = applySubmissions(project_id, submissions, fmt)
+            except BAD_SUBMISSION as e:
+                return {'msg': '[ERROR] ' + str(e) + ' (no feedback was applied)'}, 400, {'Access-Control-Allow-Origin': '*'}
 
-        # Save object updates
-        pickle.dump( current_iter, open('./store/' + project_id + '/current_iter.p', 'wb') )
-        with open('./store/' + project_id + '/project_info.json', 'w') as f:
-            json.dump(project_info, f)
+            fd_metadata = sessions.load(project_id, 'fd_metadata.p')
+            response = {
+                'applied': len(samples),
+                'samples': samples,
+                'state': {
+                    'current_iter': current_iter,
+                    'fds': {fd: {'alpha': fd_m.alpha, 'beta': fd_m.beta, 'conf': fd_m.conf} for fd, fd_m in fd_metadata.items()},
+                },
+                'msg': msg
+            }
+            return response, 200, {'Access-Control-Allow-Origin': '*'}
 
-        print(new_sample_X)
-        
-        # Return information to the user
-        response = {
-            'sample': s_out.to_json(orient='index'),
-            'X': [list(v) for v in new_sample_X],
-            'feedback': json.dumps(feedback),
-            'msg': msg
-        }
-        return response, 200, {'Access-Control-Allow-Origin': '*'}
+# Serve the server's metrics in the Prometheus text format (to local clients only, unless DUO_METRICS_PUBLIC=1)
+class Metrics(Resource):
+    def get(self):
+        if not metrics.allowed(request.remote_addr):
+            return {'msg': '[ERROR] Metrics are only served locally'}, 403
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 class Resume(Resource):
     def get(self):
@@ -502,11 +544,7 @@ class Resume(Resource):
             scenario_id = json.loads(request.data)['scenario_id']
             email = json.loads(request.data)['email']
 
-        with open('scenarios.json', 'r') as f:
-            scenarios_list = json.load(f)
-        scenario = scenarios_list[scenario_id]
-        data = pd.read_csv(scenario['dirty_dataset'])
-        header = [col for col in data.columns]
+        header = scenarios.registry.header(scenario_id)
 
         response = {
             'header': header,
@@ -530,29 +568,15 @@ class PostInteraction(Resource):
             email = json.loads(request.data)['email']
 
         if next_scenario_id != '0':
-            with open('scenarios.json', 'r') as f:
-                scenarios_list = json.load(f)
-            scenario = scenarios_list[next_scenario_id]
-            data = pd.read_csv(scenario['dirty_dataset'])
-            header = [col for col in data.columns]
+            header = scenarios.registry.header(next_scenario_id)
         else:
             header = list()
 
-        try:
-            users = pickle.load( open('./study-utils/users.p', 'rb'))
-        except:
-            return {'msg': '[ERROR] users does not exist'}, 400, {'Access-Control-Allow-Origin': '*'}
-        
-        # Save the user's questionnaire responses
-        if email not in users.keys():
-            return {'msg': '[ERROR] no user exists with this email'}, 400, {'Access-Control-Allow-Origin': '*'}
-        
-        user = users[email]
-        user.done.append(prev_scenario_id)
-        users[email] = user
-
-        # Save the users object updates
-        pickle.dump( users, open('./study-utils/users.p', 'wb') )
+        # Mark the previous scenario as done
+        with studydb.users.edit(email) as user:
+            if user is None:
+                return {'msg': '[ERROR] no user exists with this email'}, 400, {'Access-Control-Allow-Origin': '*'}
+            user.done.append(prev_scenario_id)
 
         response = {
             'header': header,
@@ -573,22 +597,11 @@ class Done(Resource):
         
         console.log(email)
         console.log(comments)
-        # Get the user from the users list
-        try:
-            users = pickle.load( open('./study-utils/users.p', 'rb'))
-        except:
-            return {'msg': '[ERROR] users does not exist'}, 400, {'Access-Control-Allow-Origin': '*'}
-        
-        # Save the user's questionnaire responses
-        if email not in users.keys():
-            return {'msg': '[ERROR] no user exists with this email'}, 400, {'Access-Control-Allow-Origin': '*'}
-        
-        user = users[email]
-        user.comments = comments
-        users[email] = user
-
-        # Save the users object updates
-        pickle.dump( users, open('./study-utils/users.p', 'wb') )
+        # Save the user's comments
+        with studydb.users.edit(email) as user:
+            if user is None:
+                return {'msg': '[ERROR] no user exists with this email'}, 400, {'Access-Control-Allow-Origin': '*'}
+            user.comments = comments
 
         return '', 201, {'Access-Control-Allow-Origin': '*'}
 
@@ -598,9 +611,17 @@ api.add_resource(PreSurvey, '/duo/api/pre-survey')
 api.add_resource(Import, '/duo/api/import')
 api.add_resource(Sample, '/duo/api/sample')
 api.add_resource(Feedback, '/duo/api/feedback')
+api.add_resource(FeedbackBatch, '/duo/api/feedback-batch')
 api.add_resource(Resume, '/duo/api/resume')
 api.add_resource(PostInteraction, '/duo/api/post-interaction')
 api.add_resource(Done, '/duo/api/done')
+api.add_resource(Metrics, '/duo/api/metrics')
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
\ No newline at end of file
+    debug = not warmup.FAST_START     # Never run the debugger where the server is exposed (e.g. in the container)
+    if warmup.ENABLED and (not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):    # Only warm up the process that serves
+        warmup.warmup()
+    scenarios.registry.start()
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warmup.ready()
+    app.run(debug=debug, host='0.0.0.0', use_reloader=debug)
\ No newline at end of file
@@ -0,0 +1,59 @@
+import os, threading
+import pandas as pd
+
+import shareddata, metrics
+
+# Process-wide registry of parsed datasets, keyed by absolute path
+# Entries are reloaded when the file's modification time or size changes
+registry = dict()   # path -> (mtime_ns, size, DataFrame)
+lock = threading.Lock()
+loads = 0
+hits = 0
+shared_loads = 0
+
+# Get the parsed dataset at a path
+# The returned DataFrame is shared by every caller in the process and must not be modified; slice or copy it instead
+# Text columns are categorical columns (with the values of pd.read_csv(path, keep_default_na=False))
+# If the dataset is published in shared memory (see shareddata.py), it is rebuilt from there instead of parsing the file,
+# with its categorical columns over the shared codes
+def get(path):
+    global loads, hits, shared_loads
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with lock:
+        entry = registry.get(path)
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            hits += 1
+            return entry[2]
+        shared = shareddata.get()
+        if shared is not None and shared.has(path, stat):
+            data = shared.frame(path)
+            shared_loads += 1
+        else:
+            data = shareddata.categorize(pd.read_csv(path, keep_default_na=False))
+            metrics.read('dataset', stat.st_size)
+        registry[path] = (stat.st_mtime_ns, stat.st_size, data)
+        loads += 1
+        return data
+
+# Get the column names of the dataset at a path
+def header(path):
+    return [col for col in get(path).columns]
+
+# Drop the parsed datasets (e.g. to rebuild them from shared memory)
+def clear():
+    with lock:
+        registry.clear()
+
+# Load a list of datasets ahead of time
+def preload(paths):
+    for path in paths:
+        get(path)
+
+def stats():
+    return {
+        'datasets': len(registry),
+        'loads': loads,
+        'hits': hits,
+        'shared_loads': shared_loads,
+    }
@@ -4,6 +4,7 @@ import numpy as np
 import scipy as sp
 import sys
 import helpers
+import datasets
 import json
 import matplotlib.pyplot as plt
 from rich.console import Console
@@ -30,8 +31,8 @@ def eval_user_h(project_id, run_type):
         project_info = json.load(f)
     scenario = project_info['scenario']
     scenario_id = project_info['scenario_id']
-    data = pd.read_csv(scenario['dirty_dataset'], keep_default_na=False)
-    clean_data = pd.read_csv(scenario['clean_dataset'], keep_default_na=False)
+    data = datasets.get(scenario['dirty_dataset'])
+    clean_data = datasets.get(scenario['clean_dataset'])
     target_fd = scenario['target_fd']
     h_space = scenario['hypothesis_space']
     with open(pathstart + project_id + '/interaction_metadata.json', 'r') as f:
@@ -428,16 +429,16 @@ def eval_h_grouped(group_type, run_type, id, background=None, max_iters=None):
         saved_scenario = project_info['scenario']
         user_num = str(user_num_dict[project_info['email']])
         
-        data = pd.read_csv(scenario['dirty_dataset'], keep_default_na=False)
-        clean_data = pd.read_csv(scenario['clean_dataset'], keep_default_na=False)
+        data = datasets.get(scenario['dirty_dataset'])
+        clean_data = datasets.get(scenario['clean_dataset'])
         target_fd = scenario['target_fd']
         target_fd_lhs = set(target_fd.split(' => ')[0][1:-1].split(', '))
         target_fd_rhs = set(target_fd.split(' => ')[1].split(', '))
         h_space = scenario['hypothesis_space']
         target_fd = next(h for h in fd_metadata.keys() if set(h.split(' => ')[0][1:-1].split(', ')) == target_fd_lhs and set(h.split(' => ')[1].split(', ')) == target_fd_rhs)
 
-        data = pd.read_csv(scenario['dirty_dataset'], keep_default_na=False)
-        clean_data = pd.read_csv(scenario['clean_dataset'], keep_default_na=False)
+        data = datasets.get(scenario['dirty_dataset'])
+        clean_data = datasets.get(scenario['clean_dataset'])
 
         fds = [h['cfd'] for h in h_space]
         for fd in fds:
@@ -0,0 +1,242 @@
+import os, json, time, threading, atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+import pandas as pd
+from rich.console import Console
+
+import helpers, sessions, datasets, metrics
+
+console = Console()
+LOG_NAME = 'events.log'
+FSYNC_INTERVAL = float(os.environ.get('DUO_EVENT_FSYNC_INTERVAL', 0.5))  # Max seconds between an append and its fsync
+FSYNC_BATCH = int(os.environ.get('DUO_EVENT_FSYNC_BATCH', 32))  # Number of unsynced events that triggers an early fsync
+MAX_OPEN_LOGS = sessions.SESSION_CAPACITY   # Max number of log files kept open
+
+# Objects that can be rebuilt from the event log
+REPLAYED = ['interaction_metadata.p', 'fd_metadata.p', 'study_metrics.p']
+
+# EventLog: Append-only log of the events of one project, one JSON object per line
+#   init: the project was created (header, rows, and the user's initial hypothesis)
+#   sample: a sample was issued (rows and violation pairs)
+#   feedback: the user submitted feedback on the current sample (marks per row and column, or only the marked cells)
+#   hypothesis: the user submitted a hypothesis
+class EventLog(object):
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.file = open(logPath(project_id), 'ab')
+        self.unsynced = 0
+
+# EventWriter: Appends events to the projects' logs and fsyncs them in batches
+class EventWriter(object):
+    def __init__(self, interval, batch, max_open):
+        self.interval = interval
+        self.batch = batch
+        self.max_open = max_open
+        self.logs = OrderedDict()  # project ID -> EventLog, least recently appended first
+        self.held = dict()  # project ID -> lines of an open transaction, appended when it completes
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.unsynced = 0
+        self.appends = 0
+        self.syncs = 0
+
+    def append(self, project_id, event):
+        line = (json.dumps(event) + '\n').encode()
+        with self.lock:
+            if project_id in self.held.keys():
+                self.held[project_id].append(line)
+                return
+            self.write(project_id, line)
+
+    # Append a line to a project's log (call with the writer lock held)
+    def write(self, project_id, line):
+        if project_id not in self.logs.keys():
+            self.logs[project_id] = EventLog(project_id)
+        self.logs.move_to_end(project_id)
+        log = self.logs[project_id]
+        log.file.write(line)
+        log.file.flush()    # Hand the event to the OS right away; fsync happens in the background
+        metrics.written('eventlog', len(line))
+        log.unsynced += 1
+        self.unsynced += 1
+        self.appends += 1
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        while len(self.logs) > self.max_open:
+            self.closeLog(self.logs.popitem(last=False)[1])
+        if self.unsynced >= self.batch:
+            self.wakeup.set()
+
+    # Hold a project's events back from its log until the transaction completes
+    def hold(self, project_id):
+        with self.lock:
+            self.held[project_id] = list()
+
+    # Append a project's held events to its log, or discard them
+    def release(self, project_id, keep):
+        with self.lock:
+            lines = self.held.pop(project_id, list())
+            if keep:
+                for line in lines:
+                    self.write(project_id, line)
+
+    def closeLog(self, log):
+        if log.unsynced > 0:
+            os.fsync(log.file.fileno())
+            self.unsynced -= log.unsynced
+            self.syncs += 1
+        log.file.close()
+
+    # fsync the logs with unsynced events (of one project, or of all projects)
+    def sync(self, project_id=None):
+        with self.lock:
+            for p_id, log in self.logs.items():
+                if log.unsynced > 0 and (project_id is None or p_id == project_id):
+                    os.fsync(log.file.fileno())
+                    self.unsynced -= log.unsynced
+                    log.unsynced = 0
+                    self.syncs += 1
+
+    # Close a project's log (e.g. when its session ends)
+    def close(self, project_id):
+        with self.lock:
+            log = self.logs.pop(project_id, None)
+            if log is not None:
+                self.closeLog(log)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.sync()
+            except Exception as e:
+                console.log('[ERROR] Failed to sync event logs:', e)
+
+def logPath(project_id):
+    return sessions.STORE_DIR + project_id + '/' + LOG_NAME
+
+writer = EventWriter(FSYNC_INTERVAL, FSYNC_BATCH, MAX_OPEN_LOGS)
+
+# Append an event to a project's log
+def append(project_id, event_type, iter_num, elapsed_time, **fields):
+    event = {
+        'type': event_type,
+        'iter_num': iter_num,
+        'time': time.time(),
+        'elapsed_time': elapsed_time,
+    }
+    event.update(fields)
+    writer.append(project_id, event)
+    sessions.logged(project_id)
+
+# Log a project's events as one unit: they are appended when the block completes, and discarded if it raises
+# (use with the project's session lock held)
+@contextmanager
+def transaction(project_id):
+    writer.hold(project_id)
+    try:
+        yield
+    except BaseException:
+        writer.release(project_id, False)
+        raise
+    writer.release(project_id, True)
+
+def init(project_id, header, rows, user_h):
+    append(project_id, 'init', 0, 0, header=header, rows=[int(i) for i in rows], user_h=user_h)
+
+def sample(project_id, iter_num, elapsed_time, rows, sample_X):
+    append(project_id, 'sample', iter_num, elapsed_time, rows=[int(i) for i in rows], X=[[int(x), int(y)] for x, y in sample_X])
+
+# Feedback is logged in the form it was submitted in: the full map, or the sample's rows and the marked cells
+def feedback(project_id, iter_num, elapsed_time, feedback):
+    if isinstance(feedback, helpers.SparseFeedback):
+        append(project_id, 'feedback', iter_num, elapsed_time, rows=feedback.rows, marked=[[r, c] for r, c in feedback.marked])
+    else:
+        append(project_id, 'feedback', iter_num, elapsed_time, feedback=feedback)
+
+def hypothesis(project_id, iter_num, elapsed_time, user_h):
+    append(project_id, 'hypothesis', iter_num, elapsed_time, value=user_h)
+
+def exists(project_id):
+    return os.path.isfile(logPath(project_id))
+
+# Read a project's events
+# A truncated last line (from a crash mid-append) is ignored
+def read(project_id):
+    writer.sync(project_id)
+    events = list()
+    with open(logPath(project_id), 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            events.append(json.loads(line))
+        metrics.read('eventlog', f.tell())
+    return events
+
+# Rebuild a project's interaction metadata, FD metadata, and study metrics from its event log
+def replay(project_id):
+    if not exists(project_id):
+        return None
+    events = read(project_id)
+    if len(events) == 0 or events[0]['type'] != 'init':
+        return None
+    project_info = sessions.load(project_id, 'project_info.json')
+    data = datasets.get(project_info['scenario']['dirty_dataset'])
+
+    state = {
+        'interaction_metadata.p': helpers.initialInteractionMetadata(events[0]['header'], events[0]['rows'], events[0]['user_h']),
+        'fd_metadata.p': helpers.initialFDMetadata(project_info['scenario']['hypothesis_space']),
+        'study_metrics.p': helpers.initialStudyMetrics(),
+    }
+    for e in events[1:]:
+        applyEvent(state, e, data)
+
+    return {name: state[name] for name in REPLAYED}
+
+# Replay the events logged after a project's snapshot onto the snapshot's objects (e.g. after a crash before the snapshot was written)
+# n_events is the number of events the snapshot includes (None if unknown); returns the number of events in the log
+def catchUp(project_id, objects, n_events):
+    if not exists(project_id):
+        return 0
+    events = read(project_id)
+    if n_events is None or len(events) <= n_events:
+        return len(events)
+    data = datasets.get(objects['project_info.json']['scenario']['dirty_dataset'])
+    for e in events[n_events:]:
+        applyEvent(objects, e, data)
+    console.log('Replayed ' + str(len(events) - n_events) + ' events of project ' + project_id + ' logged after its last snapshot')
+    return len(events)
+
+# Apply a logged event to a project's objects (name -> object) the way the API applied it
+def applyEvent(state, e, data):
+    if e['type'] == 'sample':
+        state['current_sample.p'] = pd.Index(e['rows'])
+        state['current_X.p'] = set(tuple(x) for x in e['X'])
+        state['current_iter.p'] = e['iter_num']
+    elif e['type'] == 'feedback':
+        if 'marked' in e.keys():
+            submitted = marks = helpers.SparseFeedback(e['rows'], e['marked'])
+            s_index = data.iloc[submitted.rows].index
+        else:
+            submitted = e['feedback']
+            marks = pd.DataFrame.from_dict(submitted, orient='index')
+            s_index = data.iloc[marks.index].index
+        helpers.applyFeedback(state['interaction_metadata.p'], submitted, e['iter_num'], e['elapsed_time'])
+        helpers.updateBeliefs(state['fd_metadata.p'], s_index, marks, state.get('current_X.p', set()), e['iter_num'], e['elapsed_time'])
+    elif e['type'] == 'hypothesis':
+        state['interaction_metadata.p']['user_hypothesis_history'].append(helpers.StudyMetric(iter_num=e['iter_num'], value=e['value'], elapsed_time=e['elapsed_time']))
+
+def stats():
+    return {
+        'open_logs': len(writer.logs),
+        'appends': writer.appends,
+        'syncs': writer.syncs,
+        'unsynced': writer.unsynced,
+    }
+
+sessions.register(REPLAYED, replay)
+sessions.registerCatchUp(catchUp)
+atexit.register(writer.sync)
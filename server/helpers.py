@@ -1,18 +1,32 @@
-import copy, random, os, json, pickle, math, itertools
+import copy, random, os, json, pickle, math, itertools, bisect
 from pprint import pprint
 from collections import Counter
 import heapq
 import pandas as pd
 import numpy as np
 from rich.console import Console
+import samplepools
+import sessions
+import datasets
 
 console = Console()
 BAYESIAN_SMOOTHING = 0.15    # Bayesian model hyperparameter
 HP_MEMORY = 1  # Hypothesis testing model hyperparameter
 HP_DECISION_THRESHOLD = 0.95  # Score threshold at which the user switches their hypothesis
 
+# Restore the attributes of a slotted object from a pickled state
+# Handles both the attribute dictionary of objects pickled before the class had __slots__ and the (None, slots) form
+def setSlots(obj, state):
+    if type(state) == tuple:
+        state = {k: v for d in state if d is not None for k, v in d.items()}
+    for k, v in state.items():
+        if k in type(obj).__slots__:
+            setattr(obj, k, v)
+
 # CellFeedback: An instance of feedback for a particular cell
 class CellFeedback(object):
+    __slots__ = ('iter_num', 'marked', 'elapsed_time')
+
     def __init__(self, iter_num, marked, elapsed_time):
         self.iter_num = iter_num    # iteration number
         self.marked = marked            # whether or not the user marked the cell as noisy in this iteration
@@ -26,8 +40,178 @@ class CellFeedback(object):
             'elapsed_time': self.elapsed_time
         }
 
+    def __getstate__(self):
+        return self.asdict()
+
+    def __setstate__(self, state):
+        setSlots(self, state)
+
+# SparseFeedback: The user's feedback on a sample given as only the marked cells
+# Every other cell of the sample's rows is unmarked
+class SparseFeedback(object):
+    def __init__(self, rows, marked):
+        self.rows = [int(r) for r in rows]  # IDs of the rows in the sample
+        self.marked = [(int(r), c) for r, c in marked]  # marked cells, as (row ID, column)
+
+    # Get the rows with at least one marked cell
+    def markedRows(self):
+        return list(dict.fromkeys(r for r, c in self.marked))
+
+# FeedbackHistory: The user's feedback on each cell throughout the interaction
+# Only the latest marks are kept as a (rows x columns) boolean array; each recorded iteration stores just the cells
+# whose mark it flipped, so recording a sample costs only the sample's cells
+# The marks as of an earlier iteration are rebuilt on demand by replaying the flips
+class FeedbackHistory(object):
+    def __init__(self, header, rows):
+        self.header = list(header)  # columns of the dataset
+        self.rows = [int(r) for r in rows]  # row indexes of the dataset
+        self.current = np.zeros((len(self.rows), len(self.header)), dtype=bool)   # marks as of the latest iteration
+        self.flips = list()         # flat positions (row position * # columns + column position) of the cells each iteration flipped
+        self.iter_nums = list()     # iteration number of each recorded iteration
+        self.elapsed_times = list() # elapsed time of each recorded iteration
+        self.view = None            # (iteration position, flat marks) of the last earlier iteration rebuilt
+        self.buildPositions()
+
+    def buildPositions(self):
+        self.row_pos = {r: i for i, r in enumerate(self.rows)}
+        self.col_pos = {c: j for j, c in enumerate(self.header)}
+
+    @property
+    def n_iters(self):
+        return len(self.iter_nums)
+
+    # Record the user's feedback on a sample (row -> column -> marked, or a SparseFeedback)
+    def record(self, feedback, iter_num, elapsed_time):
+        if isinstance(feedback, SparseFeedback):
+            positions = list(dict.fromkeys([self.row_pos[r] for r in feedback.rows] + [self.row_pos[r] for r, c in feedback.marked]))
+            local = {i: n for n, i in enumerate(positions)}
+            marks = self.current[positions]
+            marks[[local[self.row_pos[r]] for r in feedback.rows]] = False
+            for r, c in feedback.marked:
+                marks[local[self.row_pos[r]], self.col_pos[c]] = True
+        else:
+            positions = [self.row_pos[int(idx)] for idx in feedback.keys()]
+            marks = np.array([[bool(feedback[idx][col]) for col in self.header] for idx in feedback.keys()], dtype=bool).reshape(len(positions), len(self.header))
+        changed_rows, changed_cols = np.nonzero(self.current[positions] != marks)
+        self.flips.append(np.asarray(positions, dtype=np.int64)[changed_rows] * len(self.header) + changed_cols)
+        self.current[positions] = marks
+        self.iter_nums.append(iter_num)
+        self.elapsed_times.append(elapsed_time)
+
+    # Get the position of the latest recorded iteration at or before an iteration (-1 if there is none)
+    def iterPos(self, iter_num=None):
+        if iter_num is None:
+            return self.n_iters - 1
+        return bisect.bisect_right(self.iter_nums, iter_num) - 1
+
+    # Get the marks (rows x columns) as of a recorded iteration position; treat the result as read-only
+    def marksAt(self, k):
+        if k == self.n_iters - 1:
+            return self.current
+        if k < 0:
+            return np.zeros_like(self.current)
+        if self.view is not None and self.view[0] <= k:     # Continue from the last rebuilt iteration (e.g. when walking the history)
+            start, marks = self.view[0] + 1, self.view[1].copy()
+        else:
+            start, marks = 0, np.zeros(self.current.size, dtype=bool)
+        for flat in self.flips[start:k+1]:
+            marks[flat] = ~marks[flat]
+        self.view = (k, marks)
+        return marks.reshape(self.current.shape)
+
+    # Whether or not cell (row, col) was marked as of an iteration (or as of the latest iteration)
+    def marked(self, row, col, iter_num=None):
+        k = self.iterPos(iter_num)
+        if k < 0:
+            return False
+        if k == self.n_iters - 1:
+            return bool(self.current[self.row_pos[int(row)], self.col_pos[col]])
+        return bool(self.cellHistory(row, col)[k])
+
+    # Get the rows with at least one marked cell as of an iteration
+    def markedRows(self, iter_num=None):
+        return [self.rows[i] for i in np.flatnonzero(self.marksAt(self.iterPos(iter_num)).any(axis=1))]
+
+    # Get the marks of a cell in each recorded iteration
+    def cellHistory(self, row, col):
+        flat = self.row_pos[int(row)] * len(self.header) + self.col_pos[col]
+        flipped = np.array([bool((f == flat).any()) for f in self.flips], dtype=bool)
+        return np.logical_xor.accumulate(flipped) if len(flipped) > 0 else flipped
+
+    # Get the marks of some rows as of an iteration (row as a string -> column -> marked)
+    def snapshot(self, rows, iter_num):
+        marks = self.marksAt(self.iterPos(iter_num))
+        return {str(r): dict(zip(self.header, marks[self.row_pos[int(r)]].tolist())) for r in rows}
+
+    # Convert to the full per-cell, per-iteration form (row -> column -> list of CellFeedback dictionaries)
+    def asdict(self):
+        history = {r: {col: list() for col in self.header} for r in self.rows}
+        marks = np.zeros(self.current.size, dtype=bool)
+        for it, et, flat in zip(self.iter_nums, self.elapsed_times, self.flips):
+            marks[flat] = ~marks[flat]
+            layer = marks.reshape(self.current.shape).tolist()
+            for i, r in enumerate(self.rows):
+                for j, col in enumerate(self.header):
+                    history[r][col].append({ 'iter_num': it, 'marked': layer[i][j], 'elapsed_time': et })
+        return history
+
+    # Set the history from the marks of every iteration (iterations x rows x columns)
+    def setMarks(self, marks, iter_nums, elapsed_times):
+        self.iter_nums = [int(it) for it in iter_nums]
+        self.elapsed_times = [float(et) for et in elapsed_times]
+        previous = np.zeros(self.current.size, dtype=bool)
+        self.flips = list()
+        for layer in marks:
+            layer = layer.ravel()
+            self.flips.append(np.flatnonzero(layer != previous))
+            previous = layer
+        self.current = previous.reshape(self.current.shape).copy()
+        self.view = None
+
+    # Build a history from the full form (e.g. interaction_metadata.json)
+    @classmethod
+    def fromdict(cls, header, history):
+        fh = cls(header, history.keys())
+        if len(fh.rows) == 0 or len(fh.header) == 0:
+            return fh
+        cells = [[[cf if type(cf) == dict else cf.asdict() for cf in history[r][col]] for col in fh.header] for r in history.keys()]
+        first = cells[0][0]
+        marks = np.array([[[bool(cf['marked']) for cf in cell] for cell in row] for row in cells], dtype=bool).reshape(len(fh.rows), len(fh.header), len(first)).transpose(2, 0, 1)
+        fh.setMarks(marks, [cf['iter_num'] for cf in first], [cf['elapsed_time'] for cf in first])
+        return fh
+
+    # Pickle the latest marks as packed bits and the flips of each iteration as one array plus their counts
+    def __getstate__(self):
+        return {
+            'header': self.header,
+            'rows': self.rows,
+            'current': np.packbits(self.current, axis=None),
+            'flips': np.concatenate(self.flips) if len(self.flips) > 0 else np.zeros(0, dtype=np.int64),
+            'flip_counts': np.array([len(f) for f in self.flips], dtype=np.int64),
+            'iter_nums': list(self.iter_nums),
+            'elapsed_times': list(self.elapsed_times),
+        }
+
+    def __setstate__(self, state):
+        self.header = state['header']
+        self.rows = state['rows']
+        self.current = np.zeros((len(self.rows), len(self.header)), dtype=bool)
+        self.view = None
+        self.buildPositions()
+        if 'shape' in state.keys():     # Older pickles hold the packed marks of every iteration
+            shape = state['shape']
+            marks = np.unpackbits(state['marks'], count=int(np.prod(shape))).astype(bool).reshape(shape)
+            self.setMarks(marks, state['iter_nums'], state['elapsed_times'])
+            return
+        self.current = np.unpackbits(state['current'], count=self.current.size).astype(bool).reshape(self.current.shape)
+        self.flips = np.split(state['flips'], np.cumsum(state['flip_counts'])[:-1]) if len(state['flip_counts']) > 0 else list()
+        self.iter_nums = list(state['iter_nums'])
+        self.elapsed_times = list(state['elapsed_times'])
+
 # StudyMetric: a standardized class to represent various metrics being collected in the study
 class StudyMetric(object):
+    __slots__ = ('iter_num', 'value', 'elapsed_time')
+
     def __init__(self, iter_num, value, elapsed_time):
         self.iter_num = iter_num    # iteration number
         self.value = value  # the metric value
@@ -41,8 +225,75 @@ class StudyMetric(object):
             'elapsed_time': self.elapsed_time
         }
 
+    def __getstate__(self):
+        return self.asdict()
+
+    def __setstate__(self, state):
+        setSlots(self, state)
+
+# MetricHistory: A numeric metric's history, kept in growable numpy arrays (iteration number, value, elapsed time)
+# Behaves like a list of StudyMetric objects
+class MetricHistory(object):
+    __slots__ = ('iter_nums', 'values', 'elapsed_times', 'n')
+
+    def __init__(self, capacity=16):
+        self.iter_nums = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.elapsed_times = np.zeros(capacity, dtype=np.float64)
+        self.n = 0
+
+    # Add an entry (doubling the capacity when full)
+    def record(self, iter_num, value, elapsed_time):
+        if self.n == len(self.values):
+            capacity = max(16, 2 * len(self.values))
+            self.iter_nums = np.resize(self.iter_nums, capacity)
+            self.values = np.resize(self.values, capacity)
+            self.elapsed_times = np.resize(self.elapsed_times, capacity)
+        self.iter_nums[self.n] = iter_num
+        self.values[self.n] = value
+        self.elapsed_times[self.n] = elapsed_time
+        self.n += 1
+
+    def append(self, metric):
+        self.record(metric.iter_num, metric.value, metric.elapsed_time)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n
+        if i < 0 or i >= self.n:
+            raise IndexError('metric history index out of range')
+        return StudyMetric(iter_num=int(self.iter_nums[i]), value=float(self.values[i]), elapsed_time=float(self.elapsed_times[i]))
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+    # Convert to a list of StudyMetric dictionaries
+    def asdict(self):
+        return [{ 'iter_num': it, 'value': v, 'elapsed_time': et } for it, v, et in zip(self.iter_nums[:self.n].tolist(), self.values[:self.n].tolist(), self.elapsed_times[:self.n].tolist())]
+
+    # Build a history from a list of StudyMetric objects (e.g. from an FDMeta pickled before histories were arrays)
+    @classmethod
+    def fromlist(cls, metrics):
+        history = cls(max(16, len(metrics)))
+        for m in metrics:
+            history.append(m)
+        return history
+
+    def __getstate__(self):
+        return (self.iter_nums[:self.n].copy(), self.values[:self.n].copy(), self.elapsed_times[:self.n].copy())
+
+    def __setstate__(self, state):
+        self.iter_nums, self.values, self.elapsed_times = state
+        self.n = len(self.values)
+
 # FDMeta: An object storing all important attributes and metrics for an FD
 class FDMeta(object):
+    __slots__ = ('lhs', 'rhs', 'alpha', 'alpha_history', 'beta', 'beta_history', 'conf', 'conf_history', 'support', 'vios', 'vio_pairs', 'all_vios_found_history', 'iter_vios_found_history', 'iter_vios_total_history')
+
     def __init__(self, fd, a, b, support, vios, vio_pairs):
         # LHS and RHS of the FD (not in set form)
         self.lhs = fd.split(' => ')[0][1:-1].split(', ')
@@ -50,11 +301,14 @@ class FDMeta(object):
 
         # Beta distribution parameters
         self.alpha = a
-        self.alpha_history = [StudyMetric(iter_num=0, value=self.alpha, elapsed_time=0)]
+        self.alpha_history = MetricHistory()
+        self.alpha_history.record(0, self.alpha, 0)
         self.beta = b
-        self.beta_history = [StudyMetric(iter_num=0, value=self.beta, elapsed_time=0)]
+        self.beta_history = MetricHistory()
+        self.beta_history.record(0, self.beta, 0)
         self.conf = (a / (a+b))
-        self.conf_history = [StudyMetric(iter_num=0, value=self.conf, elapsed_time=0)]
+        self.conf_history = MetricHistory()
+        self.conf_history.record(0, self.conf, 0)
         
         self.support = support  # How many tuples the FD applies to
         self.vios = vios    # Individual tuples that violate the FD
@@ -67,32 +321,70 @@ class FDMeta(object):
     
     # Convert class object to dictionary
     def asdict(self):
-        alpha_history = list()
-        for a in self.alpha_history:
-            alpha_history.append(a.asdict())
-
-        beta_history = list()
-        for b in self.beta_history:
-            beta_history.append(b.asdict())
-        
-        conf_history = list()
-        for c in self.conf_history:
-            conf_history.append(c.asdict())
-
         return {
             'lhs': self.lhs,
             'rhs': self.rhs,
             'alpha': self.alpha,
-            'alpha_history': alpha_history,
+            'alpha_history': self.alpha_history.asdict(),
             'beta': self.beta,
-            'beta_history': beta_history,
+            'beta_history': self.beta_history.asdict(),
             'conf': self.conf,
-            'conf_history': conf_history,
+            'conf_history': self.conf_history.asdict(),
             'support': self.support,
             'vios': self.vios,
             'vio_pairs': [list(vp) for vp in self.vio_pairs]
         }
 
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__ if hasattr(self, k)}
+
+    # FDMetas pickled before histories were arrays have lists of StudyMetric objects
+    def __setstate__(self, state):
+        setSlots(self, state)
+        for k in ['alpha_history', 'beta_history', 'conf_history']:
+            if hasattr(self, k) and type(getattr(self, k)) == list:
+                setattr(self, k, MetricHistory.fromlist(getattr(self, k)))
+
+# ChunkedDataset: A CSV dataset that is streamed in fixed-size chunks instead of being loaded into memory
+class ChunkedDataset(object):
+    def __init__(self, path, chunksize):
+        self.path = path    # path to the CSV file
+        self.chunksize = chunksize  # number of rows per chunk
+        self.columns = pd.read_csv(path, nrows=0).columns.tolist()
+        self.num_rows = None
+        self.dtypes = None  # column -> dtype of the column over the whole file (inferred on first use)
+
+    # Iterate over the chunks of the dataset, parsing every chunk with the dtypes the whole file parses to,
+    # so the values (and their string patterns) match those of the dataset loaded into memory
+    def chunks(self, columns=None):
+        if self.dtypes is None:
+            self.inferDtypes()
+        return pd.read_csv(self.path, keep_default_na=False, dtype=self.dtypes, usecols=columns, chunksize=self.chunksize)
+
+    # Infer each column's dtype the way pd.read_csv does for the whole file: a column keeps the dtype all of its
+    # chunks parse to, integers mixed with floats become floats, and any other mix is read as text
+    def inferDtypes(self):
+        seen = {col: set() for col in self.columns}
+        num_rows = 0
+        for chunk in pd.read_csv(self.path, keep_default_na=False, chunksize=self.chunksize):
+            num_rows += len(chunk.index)
+            for col in chunk.columns:
+                seen[col].add(chunk[col].dtype)
+        self.dtypes = dict()
+        for col, dtypes in seen.items():
+            if len(dtypes) == 1:
+                self.dtypes[col] = dtypes.pop()
+            elif all(pd.api.types.is_integer_dtype(d) or pd.api.types.is_float_dtype(d) for d in dtypes):
+                self.dtypes[col] = np.float64
+            else:
+                self.dtypes[col] = str
+        self.num_rows = num_rows
+
+    def __len__(self):
+        if self.num_rows is None:
+            self.inferDtypes()
+        return self.num_rows
+
 # output_reward: Takes the ground truth FD (user hypothesis), model output, and FD metadata store and calculates model rewards
 def output_reward(gt, model_output, fd_metadata):
     if len(model_output) == 0:
@@ -127,43 +419,52 @@ def output_reward(gt, model_output, fd_metadata):
 
 # Record user feedback
 def recordFeedback(data, feedback, vio_pairs, project_id, current_iter, current_time):
-    interaction_metadata = pickle.load( open('./store/' + project_id + '/interaction_metadata.p', 'rb') )
-    # study_metrics = pickle.load( open('./store/' + project_id + '/study_metrics.p', 'rb') )
-    start_time = pickle.load( open('./store/' + project_id + '/start_time.p', 'rb') )
+    interaction_metadata = sessions.load(project_id, 'interaction_metadata.p')
+    # study_metrics = sessions.load(project_id, 'study_metrics.p')
+    start_time = sessions.load(project_id, 'start_time.p')
 
     # Calculate elapsed time
     elapsed_time = current_time - start_time
 
-    # Store user feedback
-    for idx in data.index:
-        if str(idx) in feedback.keys():
-            for col in data.columns:
-                interaction_metadata['feedback_history'][idx][col].append(CellFeedback(iter_num=current_iter, marked=bool(feedback[str(idx)][col]), elapsed_time=elapsed_time))
-        else:
-            for col in data.columns:
-                interaction_metadata['feedback_history'][idx][col].append(CellFeedback(iter_num=current_iter, marked=interaction_metadata['feedback_history'][idx][col][-1].marked if current_iter > 1 else False, elapsed_time=elapsed_time))
-
-    # Store latest sample in sample history
-    interaction_metadata['sample_history'].append(StudyMetric(iter_num=current_iter, value=[int(idx) for idx in feedback.keys()], elapsed_time=elapsed_time))
+    applyFeedback(interaction_metadata, feedback, current_iter, elapsed_time)
     print('*** Latest feedback saved ***')
 
-    pickle.dump( interaction_metadata, open('./store/' + project_id + '/interaction_metadata.p', 'wb') )
+    sessions.dump(project_id, 'interaction_metadata.p', interaction_metadata)
     print('*** Interaction metadata updates saved ***')
 
+# Add one iteration of user feedback to the feedback and sample histories
+def applyFeedback(interaction_metadata, feedback, current_iter, elapsed_time):
+    # Store user feedback
+    interaction_metadata['feedback_history'].record(feedback, current_iter, elapsed_time)
+
+    # Store latest sample in sample history
+    rows = feedback.rows if isinstance(feedback, SparseFeedback) else [int(idx) for idx in feedback.keys()]
+    interaction_metadata['sample_history'].append(StudyMetric(iter_num=current_iter, value=rows, elapsed_time=elapsed_time))
+
 # Interpret user feedback and update alphas and betas for each FD in the hypothesis space
 def interpretFeedback(s_in, feedback, X, sample_X, project_id, current_iter, current_time, target_fd=None):
-    fd_metadata = pickle.load( open('./store/' + project_id + '/fd_metadata.p', 'rb') )
-    start_time = pickle.load( open('./store/' + project_id + '/start_time.p', 'rb') )
+    fd_metadata = sessions.load(project_id, 'fd_metadata.p')
+    start_time = sessions.load(project_id, 'start_time.p')
 
     elapsed_time = current_time - start_time
+    updateBeliefs(fd_metadata, s_in.index, feedback, sample_X, current_iter, elapsed_time)
+
+    # Save updated alpha/beta metrics
+    sessions.dump(project_id, 'fd_metadata.p', fd_metadata)
+
+# Update the alpha and beta of each FD given the user's feedback on a sample (a DataFrame of marks, or a SparseFeedback)
+def updateBeliefs(fd_metadata, s_index, feedback, sample_X, current_iter, elapsed_time):
     # Remove marked cells from consideration
     print('*** about to interpret feedback ***')
-    marked_rows = list()
-    for idx in feedback.index:
-        for col in feedback.columns:
-            if bool(feedback.at[idx, col]) is True:
-                marked_rows.append(int(idx))
-                break
+    if isinstance(feedback, SparseFeedback):
+        marked_rows = feedback.markedRows()
+    else:
+        marked_rows = list()
+        for idx in feedback.index:
+            for col in feedback.columns:
+                if bool(feedback.at[idx, col]) is True:
+                    marked_rows.append(int(idx))
+                    break
 
     # Calculate P(X | \theta_h) for each FD
     for fd_m in fd_metadata.values():
@@ -178,7 +479,7 @@ def interpretFeedback(s_in, feedback, X, sample_X, project_id, current_iter, cur
                 removed_pairs.add((x, y))
 
         # Calculate successes and failures (to use for updating alpha and beta)
-        for i in s_in.index:
+        for i in s_index:
             if i in marked_rows:
                 continue
             if i not in fd_m.vios:  # tuple is clean
@@ -194,52 +495,117 @@ def interpretFeedback(s_in, feedback, X, sample_X, project_id, current_iter, cur
                 
         # Update alpha and beta
         fd_m.alpha += successes
-        fd_m.alpha_history.append(StudyMetric(iter_num=current_iter, value=fd_m.alpha, elapsed_time=elapsed_time))
+        fd_m.alpha_history.record(current_iter, fd_m.alpha, elapsed_time)
         fd_m.beta += failures
-        fd_m.beta_history.append(StudyMetric(iter_num=current_iter, value=fd_m.beta, elapsed_time=elapsed_time))
+        fd_m.beta_history.record(current_iter, fd_m.beta, elapsed_time)
         print('alpha:', fd_m.alpha)
         print('beta:', fd_m.beta)
         fd_m.conf = fd_m.alpha / (fd_m.alpha + fd_m.beta)
-        fd_m.conf_history.append(StudyMetric(iter_num=current_iter, value=fd_m.conf, elapsed_time=elapsed_time))
+        fd_m.conf_history.record(current_iter, fd_m.conf, elapsed_time)
         print('conf:', fd_m.conf)
 
-    # Save updated alpha/beta metrics
-    pickle.dump( fd_metadata, open('./store/' + project_id + '/fd_metadata.p', 'wb') )
+# Build the interaction metadata of a new project
+def initialInteractionMetadata(header, index, user_h):
+    interaction_metadata = dict()
+    interaction_metadata['header'] = header
+    interaction_metadata['user_hypothesis_history'] = [StudyMetric(iter_num=0, value=user_h, elapsed_time=0)]
+    interaction_metadata['feedback_history'] = FeedbackHistory(header, index)
+    interaction_metadata['sample_history'] = list()
+    return interaction_metadata
+
+# Build the FD metadata of a new project from the scenario's hypothesis space
+def initialFDMetadata(h_space):
+    fd_metadata = dict()
+    for h in h_space:
+
+        # Calculate the mean and variance
+        vio_pairs = set(tuple(vp) for vp in h['vio_pairs'])    # Keep the scenario itself JSON-serializable (it is part of project_info)
+        mu = h['conf']      # h['conf'] = # tuples that satisfy FD / # tuples total
+        if mu == 1:
+            mu = 0.99999
+        variance = 0.0025   # hyperparameter
+        
+        # Calculate alpha and beta
+        alpha, beta = initialPrior(mu, variance)
+        
+        # Initialize the FD metadata object
+        fd_m = FDMeta(
+            fd=h['cfd'],
+            a=alpha,
+            b=beta,
+            support=h['support'],
+            vios=h['vios'],
+            vio_pairs=vio_pairs,
+        )
+
+        print('iter: 0'),
+        print('alpha:', fd_m.alpha)
+        print('beta:', fd_m.beta)
+        print('conf:', h['conf'])
+
+        fd_metadata[h['cfd']] = fd_m
+    return fd_metadata
+
+# Build the (empty) study metrics of a new project
+def initialStudyMetrics():
+    study_metrics = dict()
+    study_metrics['iter_err_precision'] = list()
+    study_metrics['iter_err_recall'] = list()
+    study_metrics['iter_err_f1'] = list()
+    study_metrics['all_err_precision'] = list()
+    study_metrics['all_err_recall'] = list()
+    study_metrics['all_err_f1'] = list()
+    return study_metrics
+
+# SampleState: The parts of a project's model state that its next sample is drawn from
+# The key is made of the sampling settings and a fingerprint of the violation pairs, so a speculated sample is only used
+# if it was drawn from the same violation pairs and ratios
+class SampleState(object):
+    def __init__(self, project_id):
+        fd_metadata = sessions.load(project_id, 'fd_metadata.p')
+        project_info = sessions.load(project_id, 'project_info.json')
+        target_fd = project_info['scenario']['target_fd']
+        alt_h_list = project_info['scenario']['alt_h']
+
+        # Get target FD metadata
+        tfd_m = fd_metadata[target_fd]
+
+        # Build set of alternative hypothesis violation pairs
+        alt_h_vio_pairs = set()
+        for h in alt_h_list:
+            alt_h_vio_pairs |= fd_metadata[h].vio_pairs
+
+        self.scenario_id = project_info['scenario_id']
+        self.target_vio_pairs = tfd_m.vio_pairs
+        self.alt_h_vio_pairs = alt_h_vio_pairs
+
+        # Get sampling ratios for each hypothesis
+        self.target_h_sample_ratio = project_info['scenario']['target_h_sample_ratio']
+        self.alt_h_sample_ratio = project_info['scenario']['alt_h_sample_ratio']
+
+        self.key = (
+            self.scenario_id,
+            target_fd,
+            tuple(alt_h_list),
+            self.target_h_sample_ratio,
+            self.alt_h_sample_ratio,
+            samplepools.fingerprint(self.target_vio_pairs, self.alt_h_vio_pairs),
+        )
+
+# Draw the tuple IDs and true violation pairs of a sample from a project's sample state
+def drawSample(data, state, sample_size, current_iter):
+    pool = samplepools.getPool(state.scenario_id, state.target_h_sample_ratio, state.alt_h_sample_ratio, state.target_vio_pairs, state.alt_h_vio_pairs)
+    if pool is not None:    # Draw a precomputed sample if a pool exists for this scenario and sampling ratio
+        return pool.draw()
+    return samplepools.returnTuples(data, sorted(state.target_vio_pairs), sample_size / 2, sorted(state.alt_h_vio_pairs), state.target_h_sample_ratio, state.alt_h_sample_ratio, current_iter)
 
 # Build a sample
 def buildSample(data, X, sample_size, project_id, current_iter, current_time, sampling_method='RANDOM'):
-    # Load data
-    fd_metadata = pickle.load( open('./store/' + project_id + '/fd_metadata.p', 'rb') )
-    with open('./store/' + project_id + '/project_info.json', 'r') as f:
-        project_info = json.load(f)
-    target_fd = project_info['scenario']['target_fd']
-    alt_h_list = project_info['scenario']['alt_h']
-    
-    # Get target FD metadata
-    tfd_m = fd_metadata[target_fd]
-    
-    # Build alternative FD metadata dictionary
-    alt_fd_m = dict()
-    for h in alt_h_list:
-        alt_fd_m[h] = fd_metadata[h]
-    
-    # Build set of alternative hypothesis violation pairs
-    alt_h_vio_pairs = set()
-    for h in alt_fd_m.values():
-        alt_h_vio_pairs |= h.vio_pairs
-
-    sample_X = set()
-    s_out = None
-    
-    # Get sampling ratios for each hypothesis
-    target_h_sample_ratio = project_info['scenario']['target_h_sample_ratio']
-    alt_h_sample_ratio = project_info['scenario']['alt_h_sample_ratio']
-
     # Get the sample
     if sampling_method == 'WEIGHTED':
         s_index, sample_X = returnTuplesBasedOnFDWeights(data, sample_size, project_id)
     else:
-        s_index, sample_X = returnTuples(data, tfd_m.vio_pairs, sample_size / 2, list(alt_h_vio_pairs), target_h_sample_ratio, alt_h_sample_ratio, current_iter)
+        s_index, sample_X = drawSample(data, SampleState(project_id), sample_size, current_iter)
     
     s_out = data.loc[s_index, :]
 
@@ -247,54 +613,12 @@ def buildSample(data, X, sample_size, project_id, current_iter, current_time, sa
     
     return s_out, sample_X
 
-# Return the tuples and violations for the sample
-def returnTuples(data, X, sample_size, alt_h_vio_pairs, target_h_sample_ratio, alt_h_sample_ratio, current_iter):
-    s_out = set()
-    
-    # Add vios to the sample that violate the alt but not the target
-    if len(alt_h_vio_pairs) > math.ceil(alt_h_sample_ratio * sample_size):
-        alt_vios_out = random.sample(population=alt_h_vio_pairs, k=math.ceil(alt_h_sample_ratio * sample_size))
-    else:
-        alt_vios_out = alt_h_vio_pairs
-    for (x, y) in alt_vios_out:
-        s_out.add(x)
-        s_out.add(y)
-    
-    # Add vios to the sample that violate the target but not the alt
-    if len(X) > math.ceil(target_h_sample_ratio * sample_size):
-        target_vios_out = random.sample(population=X, k=math.ceil(target_h_sample_ratio * sample_size))
-    else:
-        target_vios_out = X
-    for (x, y) in target_vios_out:
-        s_out.add(x)
-        s_out.add(y)
-    
-    # Add tuples to the sample that violate neither the target nor the alt
-    for i in range(0, math.ceil((1-target_h_sample_ratio-alt_h_sample_ratio)*sample_size)):
-        other_tups = random.sample(population=data.index.tolist(), k=2)
-        if len([x for x in alt_h_vio_pairs if other_tups[0] in x]) == 0 and len([x for x in target_vios_out if other_tups[0] in x]) == 0:
-            s_out.add(other_tups[0])
-        if len([x for x in alt_h_vio_pairs if other_tups[1] in x]) == 0 and len([x for x in target_vios_out if other_tups[1] in x]) == 0:
-            s_out.add(other_tups[1])
-    
-    s_out = list(s_out)
-    # Shuffle the sample
-    random.shuffle(s_out)
-    # sample_X = set()    # This is the set of true violation pairs in the sample
-    # for i1 in s_out:
-    #     for i2 in s_out:
-    #         tup = (i1, i2) if i1 < i2 else (i2, i1)
-    #         if tup in X:    # If i1 and i2 together form a real violation pair, add it to sample_X
-    #             sample_X.add(tup)
-
-    return list(s_out), target_vios_out
-
 # RETURN TUPLES BASED ON WEIGHT
 def returnTuplesBasedOnFDWeights(data, sample_size, project_id):
 
     # Get tuple and FD weights
-    tuple_weights = pickle.load( open('./store/' + project_id + '/tuple_weights.p', 'rb') )
-    fd_metadata = pickle.load( open('./store/' + project_id + '/fd_metadata.p', 'rb') )
+    tuple_weights = sessions.load(project_id, 'tuple_weights.p')
+    fd_metadata = sessions.load(project_id, 'fd_metadata.p')
     fd_weights = {k: v['conf'] for k, v in fd_metadata.items()}
 
     s_out = set()
@@ -331,6 +655,8 @@ def returnTuplesBasedOnFDWeights(data, sample_size, project_id):
 
 # Get FD support and violations
 def getSupportAndVios(dirty_data, clean_data, fd):
+    if isinstance(dirty_data, ChunkedDataset):
+        return getSupportAndViosChunked(dirty_data, clean_data, fd)[0]
     lhs = fd.split(' => ')[0][1:-1] # lhs of the FD
     rhs = fd.split(' => ')[1]       # rhs of the FD
     clean_patterns = None
@@ -379,6 +705,126 @@ def getSupportAndVios(dirty_data, clean_data, fd):
         
     return support, violations
 
+# Get FD support and violations for the dirty and the clean dataset in one pass
+# The LHS partitions are built once on the clean data and only the tuples with dirty cells in the FD's attributes are patched
+def getSupportAndViosShared(dirty_data, clean_data, fd, dirty_mask=None):
+    if isinstance(dirty_data, ChunkedDataset):
+        return getSupportAndViosChunked(dirty_data, clean_data, fd)
+    lhs = fd.split(' => ')[0][1:-1].split(', ')    # lhs of the FD
+    rhs = fd.split(' => ')[1].split(', ')          # rhs of the FD
+    if dirty_mask is None:
+        dirty_mask = cellDiff(dirty_data, clean_data)
+
+    # Build the partitions on the clean data
+    clean_lhs = buildPatterns(clean_data, lhs)
+    clean_rhs = buildPatterns(clean_data, rhs)
+    partitions = dict()
+    for l, r in zip(clean_lhs, clean_rhs):
+        if l not in partitions.keys():
+            partitions[l] = Counter()
+        partitions[l][r] += 1
+    clean_patterns = pickPatterns(partitions)
+
+    # Patch the partitions with the tuples that have dirty cells in the FD's attributes
+    dirty_lhs = list(clean_lhs)
+    dirty_rhs = list(clean_rhs)
+    dirty_partitions = {l: Counter(c) for l, c in partitions.items()}
+    dirty_rows = np.flatnonzero(dirty_mask[lhs + rhs].to_numpy().any(axis=1))
+    for pos in dirty_rows:
+        idx = dirty_data.index[pos]
+        dirty_lhs[pos] = ', '.join([lh + '=' + str(dirty_data.at[idx, lh]) for lh in lhs])
+        dirty_rhs[pos] = ', '.join([rh + '=' + str(dirty_data.at[idx, rh]) for rh in rhs])
+        if dirty_lhs[pos] == clean_lhs[pos] and dirty_rhs[pos] == clean_rhs[pos]:
+            continue
+        dirty_partitions[clean_lhs[pos]][clean_rhs[pos]] -= 1
+        if dirty_partitions[clean_lhs[pos]][clean_rhs[pos]] == 0:
+            del dirty_partitions[clean_lhs[pos]][clean_rhs[pos]]
+            if len(dirty_partitions[clean_lhs[pos]]) == 0:
+                del dirty_partitions[clean_lhs[pos]]
+        if dirty_lhs[pos] not in dirty_partitions.keys():
+            dirty_partitions[dirty_lhs[pos]] = Counter()
+        dirty_partitions[dirty_lhs[pos]][dirty_rhs[pos]] += 1
+    dirty_patterns = pickPatterns(dirty_partitions, clean_patterns)  # If dirty pattern has >1 rhs, pick the clean rhs
+
+    # Build support and violation lists for the FD over both datasets
+    support = list(dirty_data.index)    # Since it's an FD, all tuples are part of the support
+    violations = [idx for idx, l, r in zip(dirty_data.index, dirty_lhs, dirty_rhs) if dirty_patterns[l] != r]
+    clean_violations = [idx for idx, l, r in zip(clean_data.index, clean_lhs, clean_rhs) if clean_patterns[l] != r]
+
+    return (support, violations), (list(clean_data.index), clean_violations)
+
+# Get FD support and violations by streaming the dataset(s) in chunks
+# Only the per-LHS-group counts of RHS patterns are kept in memory between chunks
+def getSupportAndViosChunked(dirty_data, clean_data, fd):
+    lhs = fd.split(' => ')[0][1:-1].split(', ')    # lhs of the FD
+    rhs = fd.split(' => ')[1].split(', ')          # rhs of the FD
+
+    # First pass: accumulate the partitions of the dirty (and clean) data
+    dirty_partitions = dict()
+    clean_partitions = dict()
+    for dirty_chunk, clean_chunk in chunkPairs(dirty_data, clean_data, lhs + rhs):
+        accumulatePartitions(dirty_partitions, buildPatterns(dirty_chunk, lhs), buildPatterns(dirty_chunk, rhs))
+        if clean_chunk is not None:
+            accumulatePartitions(clean_partitions, buildPatterns(clean_chunk, lhs), buildPatterns(clean_chunk, rhs))
+    clean_patterns = pickPatterns(clean_partitions) if clean_data is not None else None
+    dirty_patterns = pickPatterns(dirty_partitions, clean_patterns)  # If dirty pattern has >1 rhs, pick the clean rhs
+
+    # Second pass: find the tuples that do not match their group's pattern
+    support = list()
+    violations = list()
+    clean_support = list()
+    clean_violations = list()
+    for dirty_chunk, clean_chunk in chunkPairs(dirty_data, clean_data, lhs + rhs):
+        support += dirty_chunk.index.tolist()
+        violations += [idx for idx, l, r in zip(dirty_chunk.index, buildPatterns(dirty_chunk, lhs), buildPatterns(dirty_chunk, rhs)) if dirty_patterns[l] != r]
+        if clean_chunk is not None:
+            clean_support += clean_chunk.index.tolist()
+            clean_violations += [idx for idx, l, r in zip(clean_chunk.index, buildPatterns(clean_chunk, lhs), buildPatterns(clean_chunk, rhs)) if clean_patterns[l] != r]
+
+    return (support, violations), (clean_support, clean_violations)
+
+# Iterate over the aligned chunks of a dirty and (optional) clean dataset
+def chunkPairs(dirty_data, clean_data, columns):
+    if clean_data is None:
+        for dirty_chunk in dirty_data.chunks(columns=columns):
+            yield dirty_chunk, None
+    else:
+        for dirty_chunk, clean_chunk in zip(dirty_data.chunks(columns=columns), clean_data.chunks(columns=columns)):
+            yield dirty_chunk, clean_chunk
+
+# Add a chunk's LHS/RHS patterns to the partition counts
+def accumulatePartitions(partitions, lhs_patterns, rhs_patterns):
+    for l, r in zip(lhs_patterns, rhs_patterns):
+        if l not in partitions.keys():
+            partitions[l] = Counter()
+        partitions[l][r] += 1
+
+# Build the pattern string (e.g. 'a=1, b=2') of the given attributes for every tuple in the dataset
+def buildPatterns(data, attrs):
+    patterns = None
+    for attr in attrs:
+        clause = attr + '=' + data[attr].astype(str)
+        patterns = clause if patterns is None else patterns + ', ' + clause
+    return patterns.tolist()
+
+# Pick the best RHS pattern for each LHS partition, breaking ties with the preferred patterns if possible
+def pickPatterns(partitions, preferred=None):
+    patterns = dict()
+    for l, counts in partitions.items():
+        max_count = max(counts.values())
+        candidates = [r for r, c in counts.items() if c == max_count]
+        if len(candidates) == 1:
+            patterns[l] = candidates[0]
+        elif preferred is not None and l in preferred.keys() and preferred[l] in candidates:
+            patterns[l] = preferred[l]
+        else:
+            patterns[l] = candidates[random.randint(0, len(candidates)-1)]
+    return patterns
+
+# Get a boolean mask of the cells that differ between the dirty and clean datasets
+def cellDiff(dirty_data, clean_data):
+    return dirty_data.astype(str) != clean_data.astype(str)
+
 
 # Convert FD to partial or full CFD
 def fd2cfd(data, lhs, rhs):
@@ -558,6 +1004,8 @@ def initialPrior(mu, variance):
 
 # Get violation pairs for an FD
 def getPairs(data, support, fd):
+    if isinstance(data, ChunkedDataset):
+        return getPairsChunked(data, support, fd)
     vio_pairs = set()
     lhs = fd.split(' => ')[0][1:-1].split(', ')
     rhs = fd.split(' => ')[1].split(', ')
@@ -585,6 +1033,39 @@ def getPairs(data, support, fd):
 
     return list(vio_pairs)   
 
+# Get violation pairs for an FD by streaming the dataset in chunks
+# Only the tuples of LHS groups with more than one RHS pattern are kept in memory
+def getPairsChunked(data, support, fd):
+    lhs = fd.split(' => ')[0][1:-1].split(', ')
+    rhs = fd.split(' => ')[1].split(', ')
+    support = set(support)
+
+    # First pass: find the LHS groups with conflicting RHS values
+    partitions = dict()
+    for chunk in data.chunks(columns=lhs + rhs):
+        chunk = chunk[chunk.index.isin(support)]
+        accumulatePartitions(partitions, buildPatterns(chunk, lhs), buildPatterns(chunk, rhs))
+    conflicting = {l for l, counts in partitions.items() if len(counts) > 1}
+
+    # Second pass: gather the tuples of the conflicting groups
+    groups = dict()
+    for chunk in data.chunks(columns=lhs + rhs):
+        chunk = chunk[chunk.index.isin(support)]
+        for idx, l, r in zip(chunk.index, buildPatterns(chunk, lhs), buildPatterns(chunk, rhs)):
+            if l in conflicting:
+                if l not in groups.keys():
+                    groups[l] = list()
+                groups[l].append((idx, r))
+
+    # Every pair of tuples in a group with different RHS values is a violation pair
+    vio_pairs = set()
+    for rows in groups.values():
+        for (idx1, r1), (idx2, r2) in itertools.combinations(rows, 2):
+            if r1 != r2:
+                vio_pairs.add((idx1, idx2) if idx2 > idx1 else (idx2, idx1))
+
+    return list(vio_pairs)
+
 # Derive total violations for the FD, violations found, and violations marked
 # NOTE: t_sample is the full sample accounting for short, medium, or long-term memory, while curr_sample is only the current sample
 def vioStats(curr_sample, t_sample, feedback, vio_pairs, attrs, dirty_dataset, clean_dataset):
@@ -632,19 +1113,25 @@ def vioStats(curr_sample, t_sample, feedback, vio_pairs, attrs, dirty_dataset, c
 
 # Convert pickle files in ./store/ to JSON (for post-analysis in eval_h.py and other scripts)
 def pkl2Json(project_id):
-    files = os.listdir('./store/' + project_id + '/')
-    for f in files:
+    sessions.flush(project_id)  # Make sure the snapshot on disk is up to date
+    objects = sessions.readProject('./store/' + project_id + '/')  # Reads the snapshot, or the legacy one-file-per-object layout
+    for f, obj in objects.items():
         print('./store/' + project_id + '/' + f)
-        if '.p' in f:
-            obj = pickle.load( open('./store/' + project_id + '/' + f, 'rb') )
+        if f.endswith('.json'):
+            with open('./store/' + project_id + '/' + f, 'w') as fp:
+                json.dump(obj, fp, ensure_ascii=False, indent=4)
+        elif '.p' in f:
             if type(obj) == dict:
                 if f == 'fd_metadata.p':
                     for k in obj.keys():
                         obj[k] = obj[k].asdict()
                 elif f == 'interaction_metadata.p':
-                    for idx in obj['feedback_history'].keys():
-                        for col in obj['feedback_history'][idx].keys():
-                            obj['feedback_history'][idx][col] = [i.asdict() for i in obj['feedback_history'][idx][col]]
+                    if type(obj['feedback_history']) == FeedbackHistory:
+                        obj['feedback_history'] = obj['feedback_history'].asdict()
+                    else:
+                        for idx in obj['feedback_history'].keys():
+                            for col in obj['feedback_history'][idx].keys():
+                                obj['feedback_history'][idx][col] = [i.asdict() for i in obj['feedback_history'][idx][col]]
                     obj['user_hypothesis_history'] = [i.asdict() for i in obj['user_hypothesis_history']]
                     obj['sample_history'] = [i.asdict() for i in obj['sample_history']]
                 elif f == 'study_metrics.p':
@@ -665,8 +1152,8 @@ def checkForTermination(project_id):
         project_info = json.load(f)
     with open('./store/' + project_id + '/interaction_metadata.json', 'r') as f:
         interaction_metadata = json.load(f)
-    dirty_dataset = pd.read_csv(project_info['scenario']['dirty_dataset'], keep_default_na=False)
-    clean_dataset = pd.read_csv(project_info['scenario']['clean_dataset'], keep_default_na=False)
+    dirty_dataset = datasets.get(project_info['scenario']['dirty_dataset'])
+    clean_dataset = datasets.get(project_info['scenario']['clean_dataset'])
     target_fd = project_info['scenario']['target_fd']
 
     h_space = project_info['scenario']['hypothesis_space']
@@ -705,6 +1192,8 @@ def checkForTermination(project_id):
 # Derive post-analysis stats and metrics
 def deriveStats(interaction_metadata, fd_metadata, h_space, study_metrics, dirty_dataset, clean_dataset, target_fd, max_iters=None):
     feedback_history = interaction_metadata['feedback_history'] # User feedback history throughout interaction
+    if type(feedback_history) != FeedbackHistory:
+        feedback_history = FeedbackHistory.fromdict(interaction_metadata['header'], feedback_history)
     user_hypothesis_history = interaction_metadata['user_hypothesis_history']   # The user's submitted hypothesis history
 
     # st = short-term, lt = long-term, mt = mid-term (current + last sample), mt-2 = current + last 2 samples, mt-3 = current + last 3 samples
@@ -895,16 +1384,9 @@ def deriveStats(interaction_metadata, fd_metadata, h_space, study_metrics, dirty
             lt_sample |= set(interaction_metadata['sample_history'][i-ix]['value'])
         elapsed_time = interaction_metadata['sample_history'][i-1]['elapsed_time']
 
-        feedback = dict()
-        marked_rows = set()
-        for x in feedback_history.keys():
-            feedback[x] = dict()
-            for y in feedback_history[x].keys():
-                feedback[x][y] = feedback_history[x][y][i-1]['marked']
-                if feedback[x][y] is True and x not in marked_rows:
-                    marked_rows.add(x)
-
-        marked_rows = [int(r) for r in marked_rows]
+        # Only rows sampled so far are looked up by vioStats
+        feedback = feedback_history.snapshot(lt_sample, i)
+        marked_rows = feedback_history.markedRows(i)
         
         target_sample_X_in_fd = {(x, y) for (x, y) in fd_metadata[target_fd]['vio_pairs'] if x in curr_sample and y in curr_sample}
         fd_metadata[target_fd]['vios_in_sample'].append({ 'iter_num': i, 'value': list(target_sample_X_in_fd), 'elapsed_time': elapsed_time })
@@ -0,0 +1,177 @@
+# Instrumentation of the API: request and stage latency histograms, counters of bytes read and written,
+# and gauges of the other modules' stats(), exposed at /duo/api/metrics in the Prometheus text format
+#
+# Stages are timed with `with metrics.stage('interpret'):`, and are labeled with the endpoint of the request
+# being served by the thread (or 'background' outside of a request)
+
+import os, time, bisect, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PREFIX = 'duo_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)    # Seconds
+LOCAL_ADDRS = {'127.0.0.1', '::1', 'localhost'}
+PUBLIC = os.environ.get('DUO_METRICS_PUBLIC', '0') == '1'  # Set DUO_METRICS_PUBLIC=1 to serve the metrics to other hosts too
+families = list()   # Every Counter and Histogram, in the order they are rendered
+
+def formatValue(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+def formatLabels(names, values):
+    if len(names) == 0:
+        return ''
+    return '{' + ','.join(n + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for n, v in zip(names, values)) + '}'
+
+# Counter: A monotonically increasing value per combination of label values
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series = dict()    # label values -> value
+        self.lock = threading.Lock()
+        families.append(self)
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' counter']
+        for values, v in series:
+            lines.append(self.name + formatLabels(self.labels, values) + ' ' + formatValue(v))
+        return lines
+
+# Histogram: Counts of observations per bucket (cumulative when rendered), plus their sum and count
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = dict()    # label values -> [count per bucket..., count above the last bucket, sum]
+        self.lock = threading.Lock()
+        families.append(self)
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            s = self.series.get(label_values)
+            if s is None:
+                s = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def render(self):
+        with self.lock:
+            series = sorted((values, list(s)) for values, s in self.series.items())
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' histogram']
+        names = self.labels + ('le',)
+        for values, s in series:
+            total = 0
+            for b, n in zip(self.buckets + (float('inf'),), s[:-1]):
+                total += n
+                lines.append(self.name + '_bucket' + formatLabels(names, values + (formatValue(b),)) + ' ' + str(total))
+            lines.append(self.name + '_sum' + formatLabels(self.labels, values) + ' ' + formatValue(s[-1]))
+            lines.append(self.name + '_count' + formatLabels(self.labels, values) + ' ' + str(total))
+        return lines
+
+request_seconds = Histogram('request_seconds', 'Time to serve a request, by endpoint, method, and status', ('endpoint', 'method', 'status'))
+stage_seconds = Histogram('stage_seconds', 'Time spent in a stage of serving a request, by endpoint and stage', ('endpoint', 'stage'))
+bytes_read = Counter('bytes_read_total', 'Bytes read, by source', ('source',))
+bytes_written = Counter('bytes_written_total', 'Bytes written, by target', ('target',))
+collectors = OrderedDict()  # name -> (stats(), keys of cumulative values)
+local = threading.local()   # The endpoint and start time of the request being served by a thread
+
+# Expose the values of a stats() function as gauges (or counters, for the keys of cumulative values)
+def register(name, stats, counters=()):
+    collectors[name] = (stats, set(counters))
+
+# Mark the start of a request served by this thread
+def begin(endpoint, request_bytes):
+    local.endpoint = endpoint
+    local.start = time.perf_counter()
+    if request_bytes:
+        bytes_read.inc(request_bytes, 'request')
+
+# Mark the end of the request served by this thread
+def end(method, status, response_bytes):
+    endpoint = getattr(local, 'endpoint', None)
+    if endpoint is not None:
+        request_seconds.observe(time.perf_counter() - local.start, endpoint, method, str(status))
+        local.endpoint = None
+    if response_bytes:
+        bytes_written.inc(response_bytes, 'response')
+
+# Get the endpoint of the request served by this thread, or None outside of a request
+def currentEndpoint():
+    return getattr(local, 'endpoint', None)
+
+# Time a stage of the request served by this thread (or, for work done later on its behalf, of the given endpoint)
+@contextmanager
+def stage(name, endpoint=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, endpoint or currentEndpoint() or 'background', name)
+
+def read(source, n):
+    bytes_read.inc(n, source)
+
+def written(target, n):
+    bytes_written.inc(n, target)
+
+# Whether or not a client may read the metrics
+def allowed(remote_addr):
+    return PUBLIC or remote_addr in LOCAL_ADDRS
+
+# Render every metric in the Prometheus text format
+def render():
+    lines = list()
+    for m in families:
+        lines += m.render()
+    for name, (stats, counters) in collectors.items():
+        for key, v in stats().items():
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                continue
+            if key in counters:
+                metric = PREFIX + name + '_' + key + '_total'
+                lines += ['# TYPE ' + metric + ' counter', metric + ' ' + formatValue(v)]
+            else:
+                metric = PREFIX + name + '_' + key
+                lines += ['# TYPE ' + metric + ' gauge', metric + ' ' + formatValue(v)]
+    return '\n'.join(lines) + '\n'
+
+# Merge the metrics of several processes (index -> text) into one text, labeling each sample with its process
+def merge(texts, label='worker'):
+    merged = OrderedDict()    # metric name -> (HELP/TYPE lines, sample lines)
+    for index, text in texts.items():
+        name = None
+        for line in text.splitlines():
+            if line.startswith('#'):
+                parts = line.split(' ', 3)
+                if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                    name = parts[2]
+                    meta, _ = merged.setdefault(name, (list(), list()))
+                    if line not in meta:
+                        meta.append(line)
+                continue
+            if line == '' or name is None:
+                continue
+            tag = label + '="' + str(index) + '"'
+            if '{' in line.split(' ', 1)[0]:
+                line = line.replace('{', '{' + tag + ',', 1)
+            else:
+                metric, value = line.split(' ', 1)
+                line = metric + '{' + tag + '} ' + value
+            merged[name][1].append(line)
+    lines = list()
+    for meta, samples in merged.values():
+        lines += meta + samples
+    return '\n'.join(lines) + '\n'
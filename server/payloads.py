@@ -0,0 +1,117 @@
+import os, json, gzip
+import pandas as pd
+
+import helpers
+
+# Response formats of /sample and /feedback
+#   legacy (default): the sample as a JSON string of {row ID: {column: value}}, and the marks as a JSON string of
+#     [{'row', 'col', 'marked'}] for every cell, both inside the JSON response (what the current UI reads)
+#   compact: the header once, the rows as arrays, and the marked cells as [row position, column position] pairs
+#     {'format': 'compact', 'version': 1, 'sample_id': ..., 'header': [...], 'ids': [...], 'rows': [[...], ...], 'marked': [[i, j], ...], 'X': [...], 'msg': ...}
+# Both formats include the sample's ID (its iteration number), which sparse feedback submissions refer to
+#
+# Feedback can be submitted as the full map (row ID -> column -> marked) in 'feedback', or as only the marked cells
+# of the sample in 'marked' ([[row ID, column], ...]) together with the sample's 'sample_id'
+LEGACY = 'legacy'
+COMPACT = 'compact'
+COMPACT_VERSION = 1
+GZIP_MIN_SIZE = int(os.environ.get('DUO_GZIP_MIN_SIZE', 1024))  # Responses smaller than this many bytes are not compressed
+GZIP_LEVEL = int(os.environ.get('DUO_GZIP_LEVEL', 6))
+
+# Get the response format a request asks for (a 'format' field in the query string, form, or JSON body)
+def requestedFormat(request):
+    fmt = request.values.get('format')
+    if fmt is None and request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            fmt = body.get('format')
+    return COMPACT if fmt == COMPACT else LEGACY
+
+# Build the response for a sample
+# marked(idx, col) tells whether or not the user has marked a cell before
+def sampleResponse(fmt, s_out, sample_id, sample_X, marked, msg):
+    if fmt == COMPACT:
+        header = [col for col in s_out.columns]
+        ids = [int(idx) for idx in s_out.index]
+        return {
+            'format': COMPACT,
+            'version': COMPACT_VERSION,
+            'sample_id': sample_id,
+            'header': header,
+            'ids': ids,
+            'rows': s_out.values.tolist(),
+            'marked': [[i, j] for i, idx in enumerate(ids) for j, col in enumerate(header) if marked(idx, col)],
+            'X': [list(v) for v in sample_X],
+            'msg': msg
+        }
+
+    # Add ID to s_out (for use on frontend)
+    s_out.insert(0, 'id', s_out.index, True)
+
+    # Build feedback map for frontend
+    feedback = list()
+    for idx in s_out.index:
+        for col in s_out.columns:
+            feedback.append({
+                'row': idx,
+                'col': col,
+                'marked': False if col == 'id' else marked(idx, col)
+            })
+    return {
+        'sample_id': sample_id,
+        'sample': s_out.to_json(orient='index'),
+        'X': [list(v) for v in sample_X],
+        'feedback': json.dumps(feedback),
+        'msg': msg
+    }
+
+# Build the feedback of a sparse submission (the marked cells of the sample with the given ID)
+# Raises ValueError if the submission is not for the current sample, or marks a cell outside of it
+def sparseFeedback(sample_id, marked, current_sample_id, rows, header):
+    if sample_id is None or int(sample_id) != current_sample_id:
+        raise ValueError('Feedback is for sample ' + str(sample_id) + ', but the current sample is ' + str(current_sample_id))
+    feedback = helpers.SparseFeedback(rows, marked)
+    sample_rows = set(feedback.rows)
+    columns = set(header)
+    for r, c in feedback.marked:
+        if r not in sample_rows or c not in columns:
+            raise ValueError('Cell (' + str(r) + ', ' + str(c) + ') is not in the current sample')
+    return feedback
+
+# Build the feedback of a full submission (a map of every cell of the current sample to whether it is marked)
+# Raises ValueError if the map has a row outside of the current sample, or does not have exactly the header's columns
+def fullFeedback(feedback_dict, rows, header):
+    if not isinstance(feedback_dict, dict):
+        raise ValueError('Feedback must map the rows of the sample to their cells')
+    sample_rows = set(int(r) for r in rows)
+    columns = set(header)
+    for idx, cells in feedback_dict.items():
+        try:
+            row = int(idx)
+        except (TypeError, ValueError):
+            raise ValueError('Row ' + str(idx) + ' is not in the current sample')
+        if row not in sample_rows:
+            raise ValueError('Row ' + str(idx) + ' is not in the current sample')
+        if not isinstance(cells, dict):
+            raise ValueError('Row ' + str(idx) + ' must map the columns to whether the cell is marked')
+        for c in cells.keys():
+            if c not in columns:
+                raise ValueError('Cell (' + str(idx) + ', ' + str(c) + ') is not in the current sample')
+        for c in header:
+            if c not in cells.keys():
+                raise ValueError('Row ' + str(idx) + ' is missing column ' + str(c))
+    return pd.DataFrame.from_dict(feedback_dict, orient='index')
+
+# Compress a response with gzip if the client accepts it and the response is large enough to benefit
+def gzipResponse(request, response):
+    if response.direct_passthrough or response.status_code < 200 or response.status_code >= 300 or 'Content-Encoding' in response.headers:
+        return response
+    if 'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
@@ -1,14 +1,16 @@
 import json
 import pickle
 import os
-from helpers import FDMeta
-from api import User
+from helpers import FDMeta, FeedbackHistory
+from studydb import User
+import studydb, sessions
 import sys
 
 def pkl2jsonRecursive(run_type):
     path = './docker-out/' if run_type == 'real' else './store/'
     project_ids = os.listdir(path)
     # if run_type == 'real':
+    studydb.users.exportPickle('study-utils/users.p')    # Export the user store to the legacy pickle format
     obj = pickle.load( open('study-utils/users.p', 'rb') )
     for user in obj.keys():
         obj[user] = obj[user].asdict()
@@ -16,19 +18,24 @@ def pkl2jsonRecursive(run_type):
         json.dump(obj, fp, ensure_ascii=False, indent=4)
 
     for project_id in project_ids:
-        files = os.listdir(path + project_id + '/')
-        for f in files:
+        objects = sessions.readProject(path + project_id + '/')  # Reads the snapshot, or the legacy one-file-per-object layout
+        for f, obj in objects.items():
             print(path + project_id + '/' + f)
-            if '.p' in f:
-                obj = pickle.load( open(path + project_id + '/' + f, 'rb') )
+            if f.endswith('.json'):
+                with open(path + project_id + '/' + f, 'w') as fp:
+                    json.dump(obj, fp, ensure_ascii=False, indent=4)
+            elif '.p' in f:
                 if type(obj) == dict:
                     if f == 'fd_metadata.p':
                         for k in obj.keys():
                             obj[k] = obj[k].asdict()
                     elif f == 'interaction_metadata.p':
-                        for idx in obj['feedback_history'].keys():
-                            for col in obj['feedback_history'][idx].keys():
-                                obj['feedback_history'][idx][col] = [i.asdict() for i in obj['feedback_history'][idx][col]]
+                        if type(obj['feedback_history']) == FeedbackHistory:
+                            obj['feedback_history'] = obj['feedback_history'].asdict()
+                        else:
+                            for idx in obj['feedback_history'].keys():
+                                for col in obj['feedback_history'][idx].keys():
+                                    obj['feedback_history'][idx][col] = [i.asdict() for i in obj['feedback_history'][idx][col]]
                         if 'user_hypothesis_history' in obj.keys():
                             obj['user_hypothesis_history'] = [i.asdict() for i in obj['user_hypothesis_history']]
                         obj['sample_history'] = [i.asdict() for i in obj['sample_history']]
@@ -1,13 +1,21 @@
 import pandas as pd
 import numpy as np
+import io
 import json
+import random
+import argparse
 import subprocess as sp
+import multiprocessing as mp
 from tqdm import tqdm
 import helpers
+from profiler import StageProfiler
 from rich.console import Console
 
 console = Console()
 
+# Datasets shared read-only with the evaluation workers, keyed by scenario ID
+worker_datasets = dict()
+
 def dataDiff(dirty_df, clean_df):
     diff = pd.DataFrame(columns=clean_df.columns)
     for row in clean_df.index:
@@ -15,70 +23,199 @@ def dataDiff(dirty_df, clean_df):
             diff.at[row, col] = dirty_df.at[row, col] == clean_df.at[row, col]
     return diff
 
+# Compare the dirty and clean datasets chunk by chunk, writing the diff to a file as it goes
+# (the same JSON as dataDiff(...).to_json(orient='index'), without holding it in memory)
+def writeDataDiffChunked(f, dirty_data, clean_data):
+    f.write('{')
+    first = True
+    for dirty_chunk, clean_chunk in helpers.chunkPairs(dirty_data, clean_data, None):
+        rows = (dirty_chunk == clean_chunk).to_json(orient='index')[1:-1]   # The chunk's rows, without the enclosing braces
+        if len(rows) > 0:
+            f.write(rows if first else ',' + rows)
+            first = False
+    f.write('}')
+
+# Write the scenarios to a JSON file (as json.dump would); the diffs of the scenarios in streamed are written
+# chunk by chunk from their datasets (scenario ID -> (dirty, clean) ChunkedDatasets) instead of from scenario['diff']
+def writeScenarios(f, scenarios, streamed):
+    f.write('{')
+    for i, (s_id, scenario) in enumerate(scenarios.items()):
+        f.write((', ' if i > 0 else '') + json.dumps(s_id) + ': ')
+        if s_id not in streamed.keys():
+            json.dump(scenario, f)
+            continue
+        fields = json.dumps({k: v for k, v in scenario.items() if k != 'diff'})[1:-1]
+        f.write('{' + fields + (', ' if len(fields) > 0 else '') + '"diff": ')
+        writeDataDiffChunked(f, *streamed[s_id])
+        f.write('}')
+    f.write('}')
+
+# Load a dataset, or open it for streaming if it should be processed in chunks
+def loadDataset(path, chunksize=None):
+    if chunksize is not None:
+        return helpers.ChunkedDataset(path, chunksize)
+    return pd.read_csv(path, keep_default_na=False)
+
+# Check that streaming the scenario datasets in chunks gives the same output as loading them into memory:
+# the same dtypes and values, the same cell diff, and the same violation pairs for the target and alternative FDs
+# Returns the mismatches found, as (scenario ID, what differs) pairs
+def checkChunked(scenarios, chunksize):
+    mismatches = list()
+    for s_id, scenario in scenarios.items():
+        data = loadDataset(scenario['dirty_dataset'])
+        clean_data = loadDataset(scenario['clean_dataset'])
+        chunked = loadDataset(scenario['dirty_dataset'], chunksize)
+        clean_chunked = loadDataset(scenario['clean_dataset'], chunksize)
+        for in_memory, streamed in [(data, chunked), (clean_data, clean_chunked)]:
+            streamed_df = pd.concat(list(streamed.chunks()))
+            for col in in_memory.columns:
+                if in_memory[col].dtype != streamed_df[col].dtype or in_memory[col].astype(str).tolist() != streamed_df[col].astype(str).tolist():
+                    mismatches.append((s_id, 'values of ' + col + ' in ' + streamed.path))
+        diff = io.StringIO()
+        writeDataDiffChunked(diff, chunked, clean_chunked)
+        if json.loads(diff.getvalue()) != json.loads(dataDiff(data, clean_data).to_json(orient='index')):
+            mismatches.append((s_id, 'diff'))
+        for fd in [scenario['target_fd']] + scenario.get('alt_h', list()):
+            support = list(data.index)
+            if sorted(helpers.getPairs(data, support, fd)) != sorted(helpers.getPairs(chunked, support, fd)):
+                mismatches.append((s_id, 'violation pairs of ' + fd))
+    return mismatches
+
+# Make the scenario datasets available to a worker process (only needed when workers do not inherit them via fork)
+def initWorker(datasets):
+    worker_datasets.update(datasets)
+
+# Evaluate one FD of a scenario over the dirty and clean data
+def evaluateFD(task):
+    s_id, fd, single_pass, trace_memory = task
+    data, clean_data, dirty_mask = worker_datasets[s_id]
+    random.seed(s_id + ':' + fd)    # Seed per task so tie-breaking does not depend on which worker runs it
+    prof = StageProfiler(trace_memory=trace_memory)
+
+    with prof.stage('getSupportAndVios', s_id):
+        if single_pass:
+            (support, vios), (clean_support, clean_vios) = helpers.getSupportAndViosShared(data, clean_data, fd, dirty_mask)
+        else:
+            support, vios = helpers.getSupportAndVios(data, clean_data, fd)
+            clean_support, clean_vios = helpers.getSupportAndVios(clean_data, None, fd)
+    with prof.stage('getPairs', s_id):
+        vio_pairs = helpers.getPairs(data, support, fd)
+
+    h = dict()
+    h['cfd'] = fd
+    h['score'] = 1
+    h['conf'] = (len(support) - len(vios)) / len(support)
+    h['support'] = support
+    h['vios'] = vios
+    h['vio_pairs'] = vio_pairs
+
+    clean_h = dict()
+    clean_h['cfd'] = fd
+    clean_h['score'] = 1
+    clean_h['conf'] = (len(clean_support) - len(clean_vios)) / len(clean_support)
+
+    return h, clean_h, prof.records
+
+# Evaluate all (scenario, FD) tasks, in order, serially or on a process pool
+def evaluateAll(tasks, workers):
+    if workers <= 1:
+        return [evaluateFD(t) for t in tqdm(tasks)]
+
+    if mp.get_start_method() == 'fork':   # Workers inherit worker_datasets copy-on-write
+        pool = mp.Pool(processes=workers)
+    else:
+        pool = mp.Pool(processes=workers, initializer=initWorker, initargs=(worker_datasets,))
+    with pool:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        return list(tqdm(pool.imap(evaluateFD, tasks, chunksize=chunksize), total=len(tasks)))
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prepare the scenarios in scenarios-master.json for the study')
+    parser.add_argument('--single-pass', action='store_true', help='build the dirty and clean hypothesis spaces in one pass over shared LHS partitions')
+    parser.add_argument('--chunksize', type=int, default=None, help='stream the datasets in chunks of this many rows instead of loading them into memory')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to evaluate the hypothesis spaces')
+    parser.add_argument('--profile', default=None, help='write a JSON report of time and memory spent per stage and scenario to this path')
+    parser.add_argument('--check-chunked', action='store_true', help='only check that --chunksize (default 1000) gives the same output as loading the datasets into memory')
+    args = parser.parse_args()
+    prof = StageProfiler(trace_memory=args.profile is not None)
+
     with open('scenarios-master.json', 'r') as f:
         scenarios = json.load(f)
 
-    all_scenarios = dict()
+    if args.check_chunked:
+        mismatches = checkChunked(scenarios, args.chunksize or 1000)
+        for s_id, what in mismatches:
+            console.log('[ERROR] Scenario ' + s_id + ': ' + what + ' differ between the chunked and in-memory datasets')
+        console.log('Checked ' + str(len(scenarios)) + ' scenarios: ' + (str(len(mismatches)) + ' mismatches' if len(mismatches) > 0 else 'chunked and in-memory outputs are identical'))
+        raise SystemExit(1 if len(mismatches) > 0 else 0)
+
+    # Discover and compose the FDs of each scenario
+    all_fds = dict()
+    tasks = list()
     for s_id, scenario in tqdm(scenarios.items()):
-        data = pd.read_csv(scenario['dirty_dataset'], keep_default_na=False)
-        clean_data = pd.read_csv(scenario['clean_dataset'], keep_default_na=False)
+        with prof.stage('load', s_id):
+            data = loadDataset(scenario['dirty_dataset'], args.chunksize)
+            clean_data = loadDataset(scenario['clean_dataset'], args.chunksize)
         min_conf = 0.001
         max_ant = 3
+        prof.count(s_id, 'rows', len(data))
+        prof.count(s_id, 'attributes', len(data.columns))
 
-        process = sp.Popen(['./data/cfddiscovery/CFDD', scenario['dirty_dataset'], str(len(data.index)), str(min_conf), str(max_ant)], stdout=sp.PIPE, stderr=sp.PIPE, env={'LANG': 'C++'})     # CFDD
-        clean_process = sp.Popen(['./data/cfddiscovery/CFDD', scenario['clean_dataset'], str(len(data.index)), str(min_conf), str(max_ant)], stdout=sp.PIPE, stderr=sp.PIPE, env={'LANG': 'C++'})   # CFDD for clean h space
+        with prof.stage('CFDD', s_id):
+            process = sp.Popen(['./data/cfddiscovery/CFDD', scenario['dirty_dataset'], str(len(data)), str(min_conf), str(max_ant)], stdout=sp.PIPE, stderr=sp.PIPE, env={'LANG': 'C++'})     # CFDD
+            clean_process = sp.Popen(['./data/cfddiscovery/CFDD', scenario['clean_dataset'], str(len(data)), str(min_conf), str(max_ant)], stdout=sp.PIPE, stderr=sp.PIPE, env={'LANG': 'C++'})   # CFDD for clean h space
 
-        res = process.communicate()
-        clean_res = clean_process.communicate()
+            res = process.communicate()
+            clean_res = clean_process.communicate()
         if process.returncode == 0:
-            output = res[0].decode('latin_1').replace(',]', ']').replace('\r', '').replace('\t', '').replace('\n', '')
-            fds = [c['cfd'] for c in json.loads(output, strict=False)['cfds'] if '=' not in c['cfd'].split(' => ')[0] and '=' not in c['cfd'].split(' => ')[1] and c['cfd'].split(' => ')[0] != '()']
-            
-            fds = helpers.buildCompositionSpace(fds, None, data, clean_data, min_conf, max_ant)
+            with prof.stage('JSON cleanup', s_id):
+                output = res[0].decode('latin_1').replace(',]', ']').replace('\r', '').replace('\t', '').replace('\n', '')
+                fds = [c['cfd'] for c in json.loads(output, strict=False)['cfds'] if '=' not in c['cfd'].split(' => ')[0] and '=' not in c['cfd'].split(' => ')[1] and c['cfd'].split(' => ')[0] != '()']
+            prof.count(s_id, 'fds', len(fds))
+
+            with prof.stage('buildCompositionSpace', s_id):
+                fds = helpers.buildCompositionSpace(fds, None, data, clean_data, min_conf, max_ant)
         else:
             fds = list()
 
         if clean_process.returncode == 0:
-            clean_output = res[0].decode('latin_1').replace(',]', ']').replace('\r', '').replace('\t', '').replace('\n', '')
-            # NOTE: THIS SHOULD BE CLEAN_OUTPUT IN THE LINE BELOW, NOT OUTPUT
-            clean_fds = [c['cfd'] for c in json.loads(output, strict=False)['cfds'] if '=' not in c['cfd'].split(' => ')[0] and '=' not in c['cfd'].split(' => ')[1] and c['cfd'].split(' => ')[0] != '()']
-            clean_fds = helpers.buildCompositionSpace(clean_fds, None, clean_data, None, min_conf, max_ant)
+            with prof.stage('JSON cleanup', s_id):
+                clean_output = res[0].decode('latin_1').replace(',]', ']').replace('\r', '').replace('\t', '').replace('\n', '')
+                # NOTE: THIS SHOULD BE CLEAN_OUTPUT IN THE LINE BELOW, NOT OUTPUT
+                clean_fds = [c['cfd'] for c in json.loads(output, strict=False)['cfds'] if '=' not in c['cfd'].split(' => ')[0] and '=' not in c['cfd'].split(' => ')[1] and c['cfd'].split(' => ')[0] != '()']
+            with prof.stage('buildCompositionSpace', s_id):
+                clean_fds = helpers.buildCompositionSpace(clean_fds, None, clean_data, None, min_conf, max_ant)
         else:
             clean_fds = list()
-        
+
         intersecting_fds = list(set([f['cfd'] for f in fds]).intersection(set([c['cfd'] for c in clean_fds])))
 
-        h_space = list()
-        for fd in fds:
-            if fd['cfd'] not in intersecting_fds:
-                continue
-            h = dict()
-            h['cfd'] = fd['cfd']
-            h['score'] = 1
-            support, vios = helpers.getSupportAndVios(data, clean_data, h['cfd'])
-            vio_pairs = helpers.getPairs(data, support, h['cfd'])
-            h['conf'] = (len(support) - len(vios)) / len(support)
-            h['support'] = support
-            h['vios'] = vios
-            h['vio_pairs'] = vio_pairs
-            h_space.append(h)
-
-        clean_h_space = list()
-        for fd in clean_fds:
-            if fd['cfd'] not in intersecting_fds:
-                continue
-            h = dict()
-            h['cfd'] = fd['cfd']
-            h['score'] = 1
-            support, vios = helpers.getSupportAndVios(clean_data, None, h['cfd'])
-            h['conf'] = (len(support) - len(vios)) / len(support)
-            # console.log(fd['cfd'])
-            # console.log(vios)
-            clean_h_space.append(h)
-        
         scenario['min_conf'] = min_conf
         scenario['max_ant'] = max_ant
+        all_fds[s_id] = (fds, clean_fds)
+        prof.count(s_id, 'composed_fds', len(fds))
+        prof.count(s_id, 'evaluated_fds', len(intersecting_fds))
+        worker_datasets[s_id] = (data, clean_data, helpers.cellDiff(data, clean_data) if args.single_pass and args.chunksize is None else None)
+        for fd in fds:
+            if fd['cfd'] in intersecting_fds:
+                tasks.append((s_id, fd['cfd'], args.single_pass, args.profile is not None))
+
+    # Evaluate the hypothesis spaces
+    results = dict()
+    for (s_id, fd, _, _), (h, clean_h, records) in zip(tasks, evaluateAll(tasks, args.workers)):
+        results[(s_id, fd)] = (h, clean_h)
+        prof.extend(records)
+        prof.count(s_id, 'pairs', len(h['vio_pairs']))
+
+    all_scenarios = dict()
+    streamed = dict()
+    for s_id, scenario in scenarios.items():
+        fds, clean_fds = all_fds[s_id]
+        data, clean_data, _ = worker_datasets[s_id]
+
+        h_space = [results[(s_id, fd['cfd'])][0] for fd in fds if (s_id, fd['cfd']) in results.keys()]
+        clean_h_space = [results[(s_id, fd['cfd'])][1] for fd in clean_fds if (s_id, fd['cfd']) in results.keys()]
+
         scenario['hypothesis_space'] = h_space
         scenario['clean_hypothesis_space'] = clean_h_space
         console.log([(h['cfd'], h['conf']) for h in scenario['hypothesis_space']])
@@ -90,15 +227,21 @@ if __name__ == '__main__':
             formatted_alt_h.append(fd)
         scenario['alt_h'] = formatted_alt_h
 
-        clean_data = pd.read_csv(scenario['clean_dataset'], keep_default_na=False)
-
-        diff_df = dataDiff(data, clean_data)
-        diff = json.loads(diff_df.to_json(orient='index'))
-        scenario['diff'] = diff
+        if args.chunksize is not None:
+            streamed[s_id] = (data, clean_data)    # The diff is streamed to scenarios.json when it is written
+        else:
+            with prof.stage('dataDiff', s_id):
+                diff_df = dataDiff(data, clean_data)
+                scenario['diff'] = json.loads(diff_df.to_json(orient='index'))
 
         all_scenarios[s_id] = scenario
         all_scenarios[s_id]['sampling_method'] = 'DUO'
         all_scenarios[s_id]['update_method'] = 'BAYESIAN'
 
     with open('scenarios.json', 'w') as f:
-        json.dump(all_scenarios, f)
+        with prof.stage('write'):  # Includes the streamed diffs
+            writeScenarios(f, all_scenarios, streamed)
+
+    if args.profile is not None:
+        prof.write(args.profile)
+        console.print(prof.summary())
@@ -0,0 +1,236 @@
+import os, re, json, time, glob, random, argparse, threading, tracemalloc, cProfile, pstats
+from contextlib import contextmanager
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+PROFILE_DIR = os.environ.get('DUO_PROFILE_DIR', './profiles/')
+PROFILE_RATE = float(os.environ.get('DUO_PROFILE_RATE', 0))    # Fraction of API requests to profile
+PROFILE_HEADER = 'X-Duo-Profile'    # Requests with this header set to 1 are profiled, if DUO_PROFILE_HEADER=1
+PROFILE_HEADER_ENABLED = os.environ.get('DUO_PROFILE_HEADER', '0') == '1'
+PROFILE_MAX_FILES = int(os.environ.get('DUO_PROFILE_MAX_FILES', 500))  # The oldest profiles are deleted beyond this many
+
+# StageProfiler: Records wall time, CPU time, and peak memory of named stages, plus the counts that drive their cost
+class StageProfiler(object):
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory    # whether or not to measure peak memory (tracemalloc slows Python code down)
+        self.records = list()   # one record per stage run
+        self.counts = dict()    # scenario -> count name -> value
+
+    # Profile a stage; stages should not be nested since the peak memory tracker is reset per stage
+    @contextmanager
+    def stage(self, name, scenario=None):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start_mem = tracemalloc.get_traced_memory()[0]
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                'stage': name,
+                'scenario': scenario,
+                'wall_time': time.perf_counter() - start_wall,
+                'cpu_time': time.process_time() - start_cpu,
+                'peak_memory': tracemalloc.get_traced_memory()[1] - start_mem if self.trace_memory else None
+            }
+            self.records.append(record)
+
+    # Record a count (e.g. # rows) for a scenario; repeated counts of the same name are summed
+    def count(self, scenario, name, value):
+        if scenario not in self.counts.keys():
+            self.counts[scenario] = dict()
+        self.counts[scenario][name] = self.counts[scenario].get(name, 0) + value
+
+    # Merge stage records collected elsewhere (e.g. in a worker process)
+    def extend(self, records):
+        self.records += records
+
+    # Aggregate the records per scenario and stage
+    def report(self):
+        scenarios = dict()
+        totals = dict()
+        for r in self.records:
+            for stages in [scenarios.setdefault(str(r['scenario']), dict()), totals]:
+                s = stages.setdefault(r['stage'], { 'calls': 0, 'wall_time': 0, 'cpu_time': 0, 'peak_memory': None })
+                s['calls'] += 1
+                s['wall_time'] += r['wall_time']
+                s['cpu_time'] += r['cpu_time']
+                if r['peak_memory'] is not None:
+                    s['peak_memory'] = max(s['peak_memory'] or 0, r['peak_memory'])
+        return {
+            'scenarios': {s_id: { 'stages': stages, 'counts': self.counts.get(s_id, dict()) } for s_id, stages in scenarios.items()},
+            'totals': totals
+        }
+
+    # Write the machine-readable report
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+    # Build a summary table of the report
+    def summary(self):
+        report = self.report()
+        count_names = sorted({name for counts in self.counts.values() for name in counts.keys()})
+        table = Table(title='Preprocessing profile')
+        for col in ['Scenario', 'Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Peak mem (MB)'] + count_names:
+            table.add_column(col)
+        for s_id, s in list(report['scenarios'].items()) + [('total', { 'stages': report['totals'], 'counts': dict() })]:
+            for i, (stage, st) in enumerate(s['stages'].items()):
+                table.add_row(
+                    s_id if i == 0 else '',
+                    stage,
+                    str(st['calls']),
+                    '%.3f' % st['wall_time'],
+                    '%.3f' % st['cpu_time'],
+                    '-' if st['peak_memory'] is None else '%.1f' % (st['peak_memory'] / 2**20),
+                    *[str(s['counts'].get(name, '')) if i == 0 else '' for name in count_names]
+                )
+        return table
+
+# RequestProfiler: Profiles a sample of API requests with cProfile, writing one .pstats file per request
+# Files are named <endpoint>.<project ID>.<iteration>.<time in ms>.<pid>.pstats
+# Only one request per process is profiled at a time; requests arriving meanwhile run unprofiled
+class RequestProfiler(object):
+    def __init__(self, directory, rate, header_enabled, max_files):
+        self.directory = directory
+        self.rate = rate
+        self.header_enabled = header_enabled
+        self.max_files = max_files
+        self.busy = threading.Lock()
+        self.lock = threading.Lock()
+        self.skipped_lock = threading.Lock()    # Separate from self.lock, which is held while a profile is written
+        self.profiled = 0
+        self.skipped = 0    # requests picked while another request was being profiled
+
+    # Whether or not to profile a request, given its profiling header
+    def wants(self, header_value):
+        if self.header_enabled and header_value in ('1', 'true'):
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+    # Run a request handler under cProfile and write its profile
+    # meta() gives the project ID and iteration of the request once the handler returns (either may be None)
+    def run(self, endpoint, meta, handler, *args, **kwargs):
+        if not self.busy.acquire(blocking=False):
+            with self.skipped_lock:
+                self.skipped += 1
+            return handler(*args, **kwargs)
+        try:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(handler, *args, **kwargs)
+            finally:
+                try:
+                    project_id, iteration = meta()
+                    self.write(profile, endpoint, project_id, iteration)
+                except Exception as e:
+                    console.log('[ERROR] Failed to write the profile of a request to ' + str(endpoint) + ':', e)
+        finally:
+            self.busy.release()
+
+    def write(self, profile, endpoint, project_id, iteration):
+        name = '.'.join(re.sub(r'[^A-Za-z0-9_-]', '_', str(part)) for part in [endpoint, project_id or '-', iteration if iteration is not None else '-', int(time.time() * 1000), os.getpid()]) + '.pstats'
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(path + '.tmp')
+            os.replace(path + '.tmp', path)
+            self.profiled += 1
+            self.rotate()
+
+    # Delete the oldest profiles beyond max_files
+    # The directory is listed again on every rotation, since all the workers of serve.py write to it
+    def rotate(self):
+        files = list()
+        for path in glob.glob(os.path.join(self.directory, '*.pstats')):
+            try:
+                files.append((os.path.getmtime(path), path))
+            except FileNotFoundError:   # Deleted by another worker's rotation
+                pass
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+request_profiler = RequestProfiler(PROFILE_DIR, PROFILE_RATE, PROFILE_HEADER_ENABLED, PROFILE_MAX_FILES)
+
+def stats():
+    return {
+        'rate': request_profiler.rate,
+        'profiled': request_profiler.profiled,
+        'skipped': request_profiler.skipped,
+    }
+
+# Parse the name of a request profile into its endpoint, project ID, and iteration
+def profileInfo(path):
+    parts = os.path.basename(path).split('.')
+    return {'endpoint': parts[0], 'project_id': parts[1], 'iteration': parts[2]}
+
+# Find the request profiles in a directory, optionally only those of an endpoint, project, or iteration
+def findProfiles(directory, endpoint=None, project_id=None, iteration=None):
+    paths = list()
+    for path in sorted(glob.glob(os.path.join(directory, '*.pstats'))):
+        info = profileInfo(path)
+        if endpoint is not None and info['endpoint'] != endpoint:
+            continue
+        if project_id is not None and info['project_id'] != project_id:
+            continue
+        if iteration is not None and info['iteration'] != str(iteration):
+            continue
+        paths.append(path)
+    return paths
+
+# Build a table of the N functions with the most time (own time, or cumulative time) across profiles
+def hotFunctions(paths, n=20, sort='tottime'):
+    stats = pstats.Stats(*paths)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2] if sort == 'tottime' else item[1][3], reverse=True)
+    table = Table(title='Top ' + str(n) + ' functions by ' + ('own' if sort == 'tottime' else 'cumulative') + ' time across ' + str(len(paths)) + ' requests')
+    for col in ['Function', 'Calls', 'Own (s)', 'Cumulative (s)', 'Per request (ms)']:
+        table.add_column(col, justify='left' if col == 'Function' else 'right')
+    for (filename, line, func), (cc, nc, tt, ct, callers) in rows[:n]:
+        table.add_row(
+            os.path.basename(filename) + ':' + str(line) + '(' + func + ')' if line else func,
+            str(nc) if nc == cc else str(nc) + '/' + str(cc),
+            '%.3f' % tt,
+            '%.3f' % ct,
+            '%.2f' % ((tt if sort == 'tottime' else ct) / len(paths) * 1000),
+        )
+    return table
+
+# Build a table of the number of profiles per endpoint
+def profileCounts(paths):
+    counts = dict()
+    for path in paths:
+        endpoint = profileInfo(path)['endpoint']
+        counts[endpoint] = counts.get(endpoint, 0) + 1
+    table = Table(title='Request profiles')
+    table.add_column('Endpoint')
+    table.add_column('Profiles', justify='right')
+    for endpoint, count in sorted(counts.items()):
+        table.add_row(endpoint, str(count))
+    return table
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aggregate the request profiles written by the API (see DUO_PROFILE_RATE)')
+    parser.add_argument('command', choices=['top', 'list'], help='top: the hottest functions across the profiles; list: the number of profiles per endpoint')
+    parser.add_argument('--dir', default=PROFILE_DIR)
+    parser.add_argument('--endpoint', help='only profiles of this endpoint (e.g. feedback)')
+    parser.add_argument('--project', help='only profiles of this project ID')
+    parser.add_argument('--iteration', help='only profiles of this iteration')
+    parser.add_argument('-n', type=int, default=20, help='number of functions to show')
+    parser.add_argument('--sort', choices=['tottime', 'cumulative'], default='tottime')
+    args = parser.parse_args()
+
+    paths = findProfiles(args.dir, args.endpoint, args.project, args.iteration)
+    if len(paths) == 0:
+        console.log('No profiles found in ' + args.dir)
+    elif args.command == 'list':
+        console.print(profileCounts(paths))
+    else:
+        console.print(hotFunctions(paths, args.n, args.sort))
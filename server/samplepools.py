@@ -0,0 +1,246 @@
+import os, json, pickle, random, math, hashlib, threading, argparse
+from collections import deque, Counter
+import numpy as np
+import pandas as pd
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+POOL_DIR = './data/pools/'
+POOL_SIZE = 2000    # Number of samples pre-generated per scenario and sampling ratio
+REFILL_THRESHOLD = 0.25 # Refill a pool in the background when it drops below this fraction of its size
+SAMPLE_SIZE = 10
+SAMPLE_RATIOS = [(0.2, 0.6), (0.3, 0.45)]   # (target_h_sample_ratio, alt_h_sample_ratio) settings used by Import
+
+pools = dict()
+pools_lock = threading.Lock()
+
+# Return the tuples and violations for the sample
+def returnTuples(data, X, sample_size, alt_h_vio_pairs, target_h_sample_ratio, alt_h_sample_ratio, current_iter):
+    s_out = set()
+    
+    # Add vios to the sample that violate the alt but not the target
+    if len(alt_h_vio_pairs) > math.ceil(alt_h_sample_ratio * sample_size):
+        alt_vios_out = random.sample(population=alt_h_vio_pairs, k=math.ceil(alt_h_sample_ratio * sample_size))
+    else:
+        alt_vios_out = alt_h_vio_pairs
+    for (x, y) in alt_vios_out:
+        s_out.add(x)
+        s_out.add(y)
+    
+    # Add vios to the sample that violate the target but not the alt
+    if len(X) > math.ceil(target_h_sample_ratio * sample_size):
+        target_vios_out = random.sample(population=X, k=math.ceil(target_h_sample_ratio * sample_size))
+    else:
+        target_vios_out = X
+    for (x, y) in target_vios_out:
+        s_out.add(x)
+        s_out.add(y)
+    
+    # Add tuples to the sample that violate neither the target nor the alt
+    for i in range(0, math.ceil((1-target_h_sample_ratio-alt_h_sample_ratio)*sample_size)):
+        other_tups = random.sample(population=data.index.tolist(), k=2)
+        if len([x for x in alt_h_vio_pairs if other_tups[0] in x]) == 0 and len([x for x in target_vios_out if other_tups[0] in x]) == 0:
+            s_out.add(other_tups[0])
+        if len([x for x in alt_h_vio_pairs if other_tups[1] in x]) == 0 and len([x for x in target_vios_out if other_tups[1] in x]) == 0:
+            s_out.add(other_tups[1])
+    
+    s_out = list(s_out)
+    # Shuffle the sample
+    random.shuffle(s_out)
+    # sample_X = set()    # This is the set of true violation pairs in the sample
+    # for i1 in s_out:
+    #     for i2 in s_out:
+    #         tup = (i1, i2) if i1 < i2 else (i2, i1)
+    #         if tup in X:    # If i1 and i2 together form a real violation pair, add it to sample_X
+    #             sample_X.add(tup)
+
+    return list(s_out), target_vios_out
+
+# SamplePool: pre-generated samples for one scenario and sampling ratio, refilled in the background
+class SamplePool(object):
+    def __init__(self, scenario_id, target_h_sample_ratio, alt_h_sample_ratio, index, target_vio_pairs, alt_h_vio_pairs, fingerprint, samples):
+        self.scenario_id = scenario_id
+        self.target_h_sample_ratio = target_h_sample_ratio
+        self.alt_h_sample_ratio = alt_h_sample_ratio
+        self.data = pd.DataFrame(index=index)   # Tuple IDs of the dataset (the sampler only needs the index)
+        self.target_vio_pairs = target_vio_pairs    # Violation pairs of the target FD
+        self.alt_h_vio_pairs = alt_h_vio_pairs  # Violation pairs of the alternative FDs
+        self.fingerprint = fingerprint  # Fingerprint of the violation pairs the samples were drawn from
+        self.size = len(samples)
+        self.samples = deque(samples)
+        self.lock = threading.Lock()
+        self.refilling = False
+        self.draws = 0
+        self.misses = 0
+        self.refills = 0
+
+    # Draw a sample (tuple IDs and true violation pairs) from the pool
+    def draw(self):
+        with self.lock:
+            self.draws += 1
+            if len(self.samples) > 0:
+                sample = self.samples.popleft()
+            else:
+                self.misses += 1
+                sample = None
+            if len(self.samples) < REFILL_THRESHOLD * self.size and not self.refilling:
+                self.refilling = True
+                threading.Thread(target=self.refill, daemon=True).start()
+        if sample is None:  # Pool ran dry; build the sample online
+            sample = self.generate()
+        return sample
+
+    # Build a new sample the same way the online sampler does
+    def generate(self):
+        s_index, sample_X = returnTuples(self.data, self.target_vio_pairs, SAMPLE_SIZE / 2, self.alt_h_vio_pairs, self.target_h_sample_ratio, self.alt_h_sample_ratio, None)
+        return s_index, set(tuple(x) for x in sample_X)
+
+    # Top the pool back up to its full size
+    def refill(self):
+        new_samples = [self.generate() for _ in range(self.size - len(self.samples))]
+        with self.lock:
+            self.samples.extend(new_samples)
+            self.refilling = False
+            self.refills += 1
+
+    def stats(self):
+        return {
+            'scenario_id': self.scenario_id,
+            'target_h_sample_ratio': self.target_h_sample_ratio,
+            'alt_h_sample_ratio': self.alt_h_sample_ratio,
+            'size': self.size,
+            'available': len(self.samples),
+            'draws': self.draws,
+            'misses': self.misses,
+            'refills': self.refills,
+        }
+
+# Fingerprint of the violation pairs a pool is built from, used to detect stale pools
+def fingerprint(target_vio_pairs, alt_h_vio_pairs):
+    h = hashlib.sha1()
+    h.update(json.dumps(sorted([list(vp) for vp in target_vio_pairs])).encode())
+    h.update(json.dumps(sorted([list(vp) for vp in alt_h_vio_pairs])).encode())
+    return h.hexdigest()
+
+def poolPath(scenario_id, target_h_sample_ratio, alt_h_sample_ratio):
+    return POOL_DIR + str(scenario_id) + '-' + str(target_h_sample_ratio) + '-' + str(alt_h_sample_ratio) + '.p'
+
+# Get the violation pairs the sampler draws from for a scenario
+def scenarioVioPairs(scenario):
+    target_vio_pairs = list()
+    alt_h_vio_pairs = set()
+    for h in scenario['hypothesis_space']:
+        if h['cfd'] == scenario['target_fd']:
+            target_vio_pairs = sorted(tuple(vp) for vp in h['vio_pairs'])
+        if h['cfd'] in scenario['alt_h']:
+            alt_h_vio_pairs |= set(tuple(vp) for vp in h['vio_pairs'])
+    return target_vio_pairs, sorted(alt_h_vio_pairs)
+
+# Pre-generate a pool of samples for a scenario and sampling ratio
+def buildPool(scenario_id, scenario, target_h_sample_ratio, alt_h_sample_ratio, size=POOL_SIZE):
+    data = pd.read_csv(scenario['dirty_dataset'], keep_default_na=False)
+    target_vio_pairs, alt_h_vio_pairs = scenarioVioPairs(scenario)
+    pool = SamplePool(scenario_id, target_h_sample_ratio, alt_h_sample_ratio, pd.Index(data.index), target_vio_pairs, alt_h_vio_pairs, fingerprint(target_vio_pairs, alt_h_vio_pairs), list())
+    samples = [pool.generate() for _ in range(size)]
+    pickle.dump({
+        'scenario_id': scenario_id,
+        'target_h_sample_ratio': target_h_sample_ratio,
+        'alt_h_sample_ratio': alt_h_sample_ratio,
+        'index': data.index.tolist(),
+        'target_vio_pairs': target_vio_pairs,
+        'alt_h_vio_pairs': alt_h_vio_pairs,
+        'fingerprint': pool.fingerprint,
+        'samples': samples,
+    }, open(poolPath(scenario_id, target_h_sample_ratio, alt_h_sample_ratio), 'wb'))
+    return samples
+
+# Get the pool for a scenario and sampling ratio, or None if no up-to-date pool exists
+def getPool(scenario_id, target_h_sample_ratio, alt_h_sample_ratio, target_vio_pairs, alt_h_vio_pairs):
+    key = (str(scenario_id), target_h_sample_ratio, alt_h_sample_ratio)
+    path = poolPath(scenario_id, target_h_sample_ratio, alt_h_sample_ratio)
+    with pools_lock:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:     # No pool built (yet); check again next time
+            pools.pop(key, None)
+            return None
+        if key in pools.keys() and pools[key][0] == mtime:  # Reuse the loaded pool until the file is rebuilt
+            return pools[key][1]
+        pool = None
+        p = pickle.load( open(path, 'rb') )
+        if p['fingerprint'] == fingerprint(target_vio_pairs, alt_h_vio_pairs):
+            samples = p['samples']
+            random.shuffle(samples)
+            pool = SamplePool(p['scenario_id'], p['target_h_sample_ratio'], p['alt_h_sample_ratio'], pd.Index(p['index']), p['target_vio_pairs'], p['alt_h_vio_pairs'], p['fingerprint'], samples)
+        else:
+            console.log('[WARNING] Sample pool ' + path + ' is out of date; sampling online')
+        pools[key] = (mtime, pool)
+        return pool
+
+# Summarize the distribution of a list of samples
+def poolStats(samples, target_vio_pairs, alt_h_vio_pairs):
+    target_tups = {x for vp in target_vio_pairs for x in vp}
+    alt_tups = {x for vp in alt_h_vio_pairs for x in vp}
+    sizes = [len(s_index) for s_index, _ in samples]
+    x_sizes = [len(sample_X) for _, sample_X in samples]
+    inclusion = Counter()
+    target_frac = list()
+    alt_frac = list()
+    for s_index, _ in samples:
+        inclusion.update(s_index)
+        target_frac.append(len([i for i in s_index if i in target_tups]) / len(s_index))
+        alt_frac.append(len([i for i in s_index if i in alt_tups]) / len(s_index))
+    return {
+        'samples': len(samples),
+        'mean_sample_size': float(np.mean(sizes)),
+        'std_sample_size': float(np.std(sizes)),
+        'mean_sample_X_size': float(np.mean(x_sizes)),
+        'mean_target_tuple_frac': float(np.mean(target_frac)),
+        'mean_alt_tuple_frac': float(np.mean(alt_frac)),
+        'inclusion': {int(k): v / len(samples) for k, v in inclusion.items()},
+    }
+
+# Compare the distribution of a stored pool with samples drawn online
+def comparePool(scenario_id, scenario, target_h_sample_ratio, alt_h_sample_ratio, n=POOL_SIZE):
+    p = pickle.load( open(poolPath(scenario_id, target_h_sample_ratio, alt_h_sample_ratio), 'rb') )
+    pool = SamplePool(scenario_id, target_h_sample_ratio, alt_h_sample_ratio, pd.Index(p['index']), p['target_vio_pairs'], p['alt_h_vio_pairs'], p['fingerprint'], list())
+    online = [pool.generate() for _ in range(n)]
+    pool_stats = poolStats(p['samples'], p['target_vio_pairs'], p['alt_h_vio_pairs'])
+    online_stats = poolStats(online, p['target_vio_pairs'], p['alt_h_vio_pairs'])
+    tuples = set(pool_stats['inclusion'].keys()) | set(online_stats['inclusion'].keys())
+    max_inclusion_diff = max([abs(pool_stats['inclusion'].get(t, 0) - online_stats['inclusion'].get(t, 0)) for t in tuples]) if len(tuples) > 0 else 0
+    return pool_stats, online_stats, max_inclusion_diff
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-generate sample pools for every scenario and sampling ratio')
+    parser.add_argument('command', choices=['build', 'stats'])
+    parser.add_argument('--size', type=int, default=POOL_SIZE, help='number of samples per pool')
+    parser.add_argument('--scenarios', nargs='*', help='scenario IDs (defaults to all scenarios in scenarios.json)')
+    args = parser.parse_args()
+
+    with open('scenarios.json', 'r') as f:
+        scenarios = json.load(f)
+    scenario_ids = args.scenarios if args.scenarios else list(scenarios.keys())
+    if not os.path.isdir(POOL_DIR):
+        os.mkdir(POOL_DIR)
+
+    if args.command == 'build':
+        for s_id in scenario_ids:
+            for target_h_sample_ratio, alt_h_sample_ratio in SAMPLE_RATIOS:
+                buildPool(s_id, scenarios[s_id], target_h_sample_ratio, alt_h_sample_ratio, args.size)
+                console.log('Built pool for scenario ' + s_id + ' at ratio (' + str(target_h_sample_ratio) + ', ' + str(alt_h_sample_ratio) + ')')
+    else:
+        table = Table(title='Sample pools vs. online sampling')
+        for col in ['Scenario', 'Ratio', 'Source', 'Samples', 'Size', 'Sample X', 'Target frac', 'Alt frac', 'Max incl. diff']:
+            table.add_column(col)
+        for s_id in scenario_ids:
+            for target_h_sample_ratio, alt_h_sample_ratio in SAMPLE_RATIOS:
+                if not os.path.isfile(poolPath(s_id, target_h_sample_ratio, alt_h_sample_ratio)):
+                    continue
+                pool_stats, online_stats, max_inclusion_diff = comparePool(s_id, scenarios[s_id], target_h_sample_ratio, alt_h_sample_ratio, args.size)
+                for source, st in [('pool', pool_stats), ('online', online_stats)]:
+                    table.add_row(s_id, str((target_h_sample_ratio, alt_h_sample_ratio)), source, str(st['samples']),
+                        '%.2f ± %.2f' % (st['mean_sample_size'], st['std_sample_size']), '%.2f' % st['mean_sample_X_size'],
+                        '%.3f' % st['mean_target_tuple_frac'], '%.3f' % st['mean_alt_tuple_frac'], '%.3f' % max_inclusion_diff if source == 'pool' else '')
+        console.print(table)
@@ -0,0 +1,93 @@
+import os, json, time, threading
+from rich.console import Console
+
+import datasets
+
+console = Console()
+SCENARIOS_PATH = 'scenarios.json'
+STUDY_SCENARIOS_PATH = 'scenarios-for-study.json'
+POLL_INTERVAL = float(os.environ.get('DUO_SCENARIO_POLL_INTERVAL', 2.0))    # Seconds between checks for changes to the scenario files
+
+# ScenarioSnapshot: An immutable view of the scenario definitions at one point in time
+class ScenarioSnapshot(object):
+    def __init__(self, scenarios, study_scenarios, headers, mtimes):
+        self.scenarios = scenarios  # scenario ID -> scenario definition (from scenarios.json)
+        self.study_scenarios = study_scenarios  # scenario IDs used in the study (from scenarios-for-study.json)
+        self.headers = headers  # scenario ID -> column names of the scenario's dirty dataset
+        self.mtimes = mtimes    # modification times of the files the snapshot was built from
+
+# ScenarioRegistry: Loads the scenario definitions once and swaps in a new snapshot whenever the files change
+class ScenarioRegistry(object):
+    def __init__(self, scenarios_path, study_scenarios_path, poll_interval):
+        self.scenarios_path = scenarios_path
+        self.study_scenarios_path = study_scenarios_path
+        self.poll_interval = poll_interval
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.reloads = 0
+
+    def mtimes(self):
+        return tuple(os.stat(p).st_mtime_ns if os.path.isfile(p) else None for p in [self.scenarios_path, self.study_scenarios_path])
+
+    # Build a new snapshot from the files and swap it in
+    def load(self):
+        mtimes = self.mtimes()
+        scenarios = dict()
+        if os.path.isfile(self.scenarios_path):
+            with open(self.scenarios_path, 'r') as f:
+                scenarios = json.load(f)
+        study_scenarios = list()
+        if os.path.isfile(self.study_scenarios_path):
+            with open(self.study_scenarios_path, 'r') as f:
+                study_scenarios = json.load(f)['scenarios']
+        headers = dict()
+        for s_id, scenario in scenarios.items():
+            try:
+                headers[s_id] = tuple(datasets.header(scenario['dirty_dataset']))
+            except OSError as e:
+                console.log('[WARNING] Could not read the dataset of scenario ' + s_id + ':', e)
+        self.snapshot = ScenarioSnapshot(scenarios, tuple(study_scenarios), headers, mtimes)    # Atomic swap; readers keep whichever snapshot they already hold
+        self.reloads += 1
+
+    # Start watching the scenario files for changes
+    def start(self):
+        with self.lock:
+            if self.snapshot is None:
+                self.load()
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.watch, daemon=True)
+                self.watcher.start()
+
+    def watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                if self.mtimes() != self.snapshot.mtimes:
+                    self.load()
+                    console.log('Reloaded scenarios')
+            except Exception as e:  # Keep serving the previous snapshot if the files are mid-write or invalid
+                console.log('[WARNING] Failed to reload scenarios:', e)
+
+    def current(self):
+        if self.snapshot is None:
+            self.start()
+        return self.snapshot
+
+    # Get a scenario definition
+    # The copy is shallow: callers may set top-level keys but must not modify the nested hypothesis space
+    def scenario(self, scenario_id):
+        return dict(self.current().scenarios[scenario_id])
+
+    # Get the column names of a scenario's dirty dataset
+    def header(self, scenario_id):
+        snapshot = self.current()
+        if scenario_id in snapshot.headers.keys():
+            return list(snapshot.headers[scenario_id])
+        return datasets.header(snapshot.scenarios[scenario_id]['dirty_dataset'])
+
+    # Get the IDs of the scenarios used in the study
+    def studyScenarios(self):
+        return list(self.current().study_scenarios)
+
+registry = ScenarioRegistry(SCENARIOS_PATH, STUDY_SCENARIOS_PATH, POLL_INTERVAL)
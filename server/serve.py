@@ -0,0 +1,212 @@
+# Pre-forking server for the study API
+# The master loads the scenarios and datasets once and forks the workers, which share them (the datasets through shared memory).
+# The master also runs a small router that sends every request of a project (or a user) to the same worker,
+# since each worker keeps its projects' sessions in its own memory.
+#
+# To run: python serve.py --workers 4 --port 5000
+
+import os, io, sys, json, time, signal, socket, argparse, threading, zlib
+import http.client
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+from rich.console import Console
+
+import metrics, studydb
+
+console = Console()
+WORKERS = int(os.environ.get('DUO_WORKERS', os.cpu_count() or 1))
+HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade', 'content-length'}
+
+# Worker: One forked API process, serving on its own loopback socket
+class Worker(object):
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count  # Number of workers, which decides the projects the worker owns
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.pid = None
+        self.restarts = 0
+
+    def start(self, app):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                runWorker(self, app)
+            finally:
+                os._exit(0)     # Never return into the master's code
+        self.pid = pid
+
+# Exit on the first SIGTERM, and ignore any further ones so they cannot interrupt the cleanup
+def stop(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+# Run a worker's server (in the forked process)
+def runWorker(worker, app):
+    import scenarios, sessions, eventlog, warmup, studydb
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # The master handles Ctrl-C
+    scenarios.registry.start()  # Threads do not survive fork, so the scenario watcher starts here
+    studydb.project_ids.shard = (worker.index, worker.count)   # Create only projects this worker owns
+    warmup.timings.clear()     # Report only this worker's own warmup (the master reports the rest)
+    server = make_server('127.0.0.1', worker.port, app, threaded=True, fd=worker.sock.fileno())
+    warmup.ready('Worker ' + str(worker.index) + ' (pid ' + str(os.getpid()) + ', port ' + str(worker.port) + ')')
+    if warmup.ENABLED:
+        warmup.loadPoolsLater(scenarios.registry.current())    # Loaded after the fork, so each worker shuffles its own pools
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+    finally:    # os._exit skips atexit, so write the sessions and event logs here
+        sessions.flush()
+        eventlog.writer.sync()
+
+# Router: Forwards each request to the worker that owns its project (or user)
+# A project's owner is a function of its ID alone (studydb.projectOwner), and the worker that handles an /import
+# allocates an ID it owns, so the router needs no table of projects
+class Router(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.next_worker = 0
+
+    # Pick the worker for a request from its project ID or email
+    def route(self, environ, body):
+        try:
+            fields = json.loads(body)
+        except ValueError:
+            fields = Request(dict(environ, **{'wsgi.input': io.BytesIO(body)})).form  # Parse a copy, so the body can still be forwarded
+        if not hasattr(fields, 'get'):
+            fields = dict()
+        project_id = fields.get('project_id')
+        if project_id is not None:
+            return studydb.projectOwner(project_id, len(self.workers))
+        email = fields.get('email')
+        if email is not None:
+            return zlib.crc32(str(email).encode()) % len(self.workers)
+        with self.lock:
+            self.next_worker = (self.next_worker + 1) % len(self.workers)
+            return self.next_worker
+
+    # Gather the metrics of every worker, labeled with the worker's index, plus the router's own
+    def metrics(self):
+        texts = dict()
+        for w in self.workers:
+            conn = http.client.HTTPConnection('127.0.0.1', w.port, timeout=10)
+            try:
+                conn.request('GET', '/duo/api/metrics')
+                upstream = conn.getresponse()
+                if upstream.status == 200:
+                    texts[w.index] = upstream.read().decode()
+            except (ConnectionError, OSError) as e:
+                console.log('[ERROR] Worker ' + str(w.index) + ' did not respond:', e)
+            finally:
+                conn.close()
+        texts['router'] = '\n'.join([
+            '# TYPE duo_workers_up gauge', 'duo_workers_up ' + str(len(texts)),
+            '# TYPE duo_worker_restarts_total counter', 'duo_worker_restarts_total ' + str(sum(w.restarts for w in self.workers)),
+        ])
+        return metrics.merge(texts)
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        if request.path == '/duo/api/metrics':
+            if not metrics.allowed(request.remote_addr):
+                return Response(json.dumps({'msg': '[ERROR] Metrics are only served locally'}), status=403, mimetype='application/json')(environ, start_response)
+            return Response(self.metrics(), content_type=metrics.CONTENT_TYPE)(environ, start_response)
+        body = request.get_data(cache=True)
+        index = self.route(environ, body)
+        worker = self.workers[index]
+        path = request.full_path if request.query_string else request.path
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS}
+        conn = http.client.HTTPConnection('127.0.0.1', worker.port, timeout=600)
+        try:
+            conn.request(request.method, path, body=body, headers=headers)
+            upstream = conn.getresponse()
+            data = upstream.read()
+        except (ConnectionError, OSError) as e:
+            console.log('[ERROR] Worker ' + str(index) + ' did not respond:', e)
+            return Response(json.dumps({'msg': '[ERROR] Server worker unavailable'}), status=503, mimetype='application/json')(environ, start_response)
+        finally:
+            conn.close()
+        response_headers = [(k, v) for k, v in upstream.getheaders() if k.lower() not in HOP_HEADERS]
+        return Response(data, status=upstream.status, headers=response_headers)(environ, start_response)
+
+# Restart workers that exit unexpectedly
+def supervise(workers, app, stopping):
+    while not stopping.is_set():
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            time.sleep(0.5)
+            continue
+        if stopping.is_set():
+            return
+        for w in workers:
+            if w.pid == pid:
+                console.log('[WARNING] Worker ' + str(w.index) + ' exited with status ' + str(status) + '; restarting')
+                w.restarts += 1
+                w.start(app)
+
+# Load everything the workers share before forking
+# The datasets are published in shared memory, so the workers (including restarted ones) map one copy of them
+def preload():
+    import datasets, shareddata, warmup
+    snapshot, paths = warmup.loadScenarios()
+    shared = None
+    try:
+        with warmup.phase('shared'):
+            shared = shareddata.publish({path: datasets.get(path) for path in paths})
+            shareddata.use(shared)
+            datasets.clear()
+            datasets.preload(paths)     # Rebuild the datasets on top of the shared blocks
+    except OSError as e:
+        console.log('[WARNING] Could not publish the datasets in shared memory:', e)
+    console.log('Preloaded ' + str(len(snapshot.scenarios)) + ' scenarios and ' + str(len(paths)) + ' datasets' + (' (' + str(shared.nbytes()) + ' bytes shared)' if shared is not None else ''))
+    return shared
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the study API with multiple worker processes')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='number of worker processes (default: DUO_WORKERS or # CPUs)')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    shared = preload()
+    import warmup
+    with warmup.phase('imports'):
+        from api import app     # Import the app (and everything it imports) before forking too
+
+    n_workers = max(1, args.workers)
+    workers = [Worker(i, n_workers) for i in range(n_workers)]
+    for w in workers:
+        w.start(app)
+
+    stopping = threading.Event()
+    threading.Thread(target=supervise, args=(workers, app, stopping), daemon=True).start()
+
+    router = make_server(args.host, args.port, Router(workers), threaded=True)
+    signal.signal(signal.SIGTERM, stop)     # Stop the workers on SIGTERM too, not only on Ctrl-C
+    console.log('Routing requests on ' + args.host + ':' + str(args.port) + ' to ' + str(len(workers)) + ' workers')
+    warmup.ready('Router')
+    try:
+        router.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        stopping.set()
+        for w in workers:
+            try:
+                os.kill(w.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for w in workers:
+            try:
+                os.waitpid(w.pid, 0)
+            except ChildProcessError:
+                pass
+        if shared is not None:
+            shared.close()
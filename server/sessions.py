@@ -0,0 +1,393 @@
+import os, json, pickle, time, threading, itertools, atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+from rich.console import Console
+
+import metrics
+
+console = Console()
+STORE_DIR = './store/'
+SNAPSHOT_NAME = 'project.snapshot'
+STATIC_NAME = 'project.static'
+SNAPSHOT_VERSION = 2
+# Objects derived from the scenario when a project is created, which do not change afterwards:
+# they are written to their own file when set, instead of with every iteration's snapshot
+STATIC_OBJECTS = {'project_info.json', 'X.p', 'tuple_weights.p'}
+SESSION_CAPACITY = int(os.environ.get('DUO_SESSION_CAPACITY', 64))  # Max number of sessions kept in memory
+SESSION_IDLE_TIMEOUT = float(os.environ.get('DUO_SESSION_IDLE_TIMEOUT', 30 * 60))  # Seconds after which an idle session is evicted
+FLUSH_INTERVAL = float(os.environ.get('DUO_FLUSH_INTERVAL', 1.0))    # Seconds between background writes
+
+# Objects that can be rebuilt from another source (e.g. the project's event log) if they are missing from the store
+# file name -> rebuild(project_id), which returns a dict of file name -> object, or None if the project cannot be rebuilt
+rebuilders = dict()
+# Brings the objects of a snapshot up to date with the events logged after it (e.g. after a crash between the two)
+# catch_up(project_id, objects, n_events) replays the events after the first n_events (None if unknown) onto the objects,
+# and returns the number of events logged for the project
+catch_up = None
+sequence = itertools.count(1)   # Orders the snapshots taken in this process, so an older one never overwrites a newer one
+
+# Session: The state of one project (interaction) kept in process memory
+class Session(object):
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.objects = dict()   # file name (e.g. 'fd_metadata.p') -> object
+        self.lock = threading.RLock()   # hold while reading or mutating the session's objects
+        self.last_access = time.time()
+        self.loaded = False     # whether or not the project's snapshot (if any) has been read
+        self.legacy = False     # whether or not the project is stored in the legacy one-file-per-object layout
+        self.dirty = False      # whether or not objects have changed since the last snapshot
+        self.static_dirty = False   # whether or not static objects have changed since they were last written
+        self.events = 0         # number of events logged for the project (None if unknown), stored with each snapshot
+        self.evicted = False    # whether or not the session was dropped from the cache; a new session holds the project's state
+        self.users = 0          # number of locked() blocks holding the session (the lock is reentrant, so this thread may hold it too)
+
+    # Read the project's snapshot (and static objects) and replay the events logged after it, or fall back to the legacy layout
+    def load(self):
+        project_dir = STORE_DIR + self.project_id
+        snapshot = readSnapshot(project_dir)
+        if snapshot is not None:
+            static = readSnapshot(project_dir, STATIC_NAME)
+            objects = dict(static['objects']) if static is not None else dict()
+            objects.update(snapshot['objects'])
+            self.static_dirty = static is None and any(name in STATIC_OBJECTS for name in objects.keys())   # Older snapshots hold every object
+            self.events = snapshot.get('events')
+            if catch_up is not None:
+                n_events = catch_up(self.project_id, objects, self.events)
+                self.dirty = self.events is not None and n_events > self.events
+                self.events = n_events
+            for name, obj in objects.items():
+                if name not in self.objects.keys():
+                    self.objects[name] = obj
+        else:
+            self.legacy = os.path.isdir(project_dir) and len(legacyNames(project_dir)) > 0
+            self.static_dirty = self.legacy
+            if self.legacy:
+                self.events = catch_up(self.project_id, dict(), None) if catch_up is not None else None
+        self.loaded = True
+
+    # Get an object of the session, loading it from disk on first access
+    def get(self, name):
+        with self.lock:
+            self.last_access = time.time()
+            if not self.loaded:
+                self.load()
+            if name not in self.objects.keys() and name in rebuilders.keys():
+                rebuilt = rebuilders[name](self.project_id)
+                if rebuilt is not None:
+                    for n, obj in rebuilt.items():
+                        if n not in self.objects.keys():
+                            self.objects[n] = obj
+            if name not in self.objects.keys():
+                self.objects[name] = readObject(STORE_DIR + self.project_id, name)
+            return self.objects[name]
+
+    # Replace an object of the session; it is written with the next snapshot
+    def set(self, name, obj):
+        with self.lock:
+            self.last_access = time.time()
+            if not self.loaded:
+                self.load()
+            self.objects[name] = obj
+            self.dirty = True
+            if name in STATIC_OBJECTS:
+                self.static_dirty = True
+
+    # Count an event logged for the project
+    def logged(self):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if self.events is not None:
+                self.events += 1
+
+    # Serialize the full state of the session (call with the session lock held)
+    # Returns the sequence number of the snapshot, its data, and the data of the static objects (None if they have not changed)
+    def snapshot(self):
+        if self.legacy:     # Pull in the objects that were never accessed so the snapshot is complete
+            for name in legacyNames(STORE_DIR + self.project_id):
+                if name not in self.objects.keys():
+                    self.objects[name] = readObject(STORE_DIR + self.project_id, name)
+        static = None
+        if self.static_dirty:
+            static = serializeSnapshot({name: obj for name, obj in self.objects.items() if name in STATIC_OBJECTS})
+            self.static_dirty = False
+        data = serializeSnapshot({name: obj for name, obj in self.objects.items() if name not in STATIC_OBJECTS}, self.objects.get('current_iter.p'), self.events)
+        self.dirty = False
+        return next(sequence), data, static
+
+    # Discard the changes since the last snapshot; objects are read from disk again on next access
+    # (call with the session lock held)
+    def reset(self):
+        self.objects = dict()
+        self.loaded = False
+        self.legacy = False
+        self.dirty = False
+        self.static_dirty = False
+        self.events = 0
+
+# Persister: Writes session snapshots to disk in the background, coalescing repeated commits of the same session
+class Persister(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = OrderedDict()    # project ID -> session
+        self.endpoints = dict()         # project ID -> endpoint of the request that last committed the project (for the metrics)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.written = dict()   # project ID -> sequence number of the newest snapshot written
+        self.write_lock = threading.Lock()
+        self.writes = 0
+        self.coalesced = 0
+
+    def schedule(self, session):
+        with self.lock:
+            if session.project_id in self.pending.keys():
+                self.coalesced += 1
+            self.pending[session.project_id] = session
+            endpoint = metrics.currentEndpoint()
+            if endpoint is not None or session.project_id not in self.endpoints.keys():  # A flush outside of a request keeps the request's label
+                self.endpoints[session.project_id] = endpoint
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    # Write the pending snapshots (of one project, or of all projects)
+    def flush(self, project_id=None):
+        with self.lock:
+            keys = [k for k in self.pending.keys() if project_id is None or k == project_id]
+            batch = [(self.pending.pop(k), self.endpoints.pop(k, None)) for k in keys]
+        for session, endpoint in batch:
+            with metrics.stage('persist', endpoint):
+                with session.lock:  # Serialize under the session lock so the snapshot falls between requests
+                    if not session.loaded or session.evicted:   # Changes were discarded, or written on eviction
+                        continue
+                    seq, data, static = session.snapshot()
+                self.write(session.project_id, seq, data, static)
+
+    # Write a snapshot of a project, unless a newer one was written in the meantime
+    # The static objects are written first (and always, since a newer snapshot does not include them)
+    def write(self, project_id, seq, data, static=None):
+        with self.write_lock:
+            if static is not None:
+                writeSnapshot(STORE_DIR + project_id, static, STATIC_NAME)
+            if self.written.get(project_id, 0) > seq:
+                return
+            writeSnapshot(STORE_DIR + project_id, data)
+            self.written[project_id] = seq
+            self.writes += 1
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+                cache.evictIdle()
+            except Exception as e:
+                console.log('[ERROR] Failed to persist sessions:', e)
+
+# SessionCache: LRU cache of sessions
+class SessionCache(object):
+    def __init__(self, capacity, idle_timeout):
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, project_id):
+        with self.lock:
+            if project_id in self.sessions.keys():
+                self.hits += 1
+                self.sessions.move_to_end(project_id)
+                return self.sessions[project_id]
+            self.misses += 1
+            session = Session(project_id)
+            self.sessions[project_id] = session
+            excess = len(self.sessions) - self.capacity
+            lru = list(self.sessions.values())[:-1] if excess > 0 else list()
+        for s in lru:   # Sessions in use are skipped, so the cache can exceed its capacity while they are
+            if excess <= 0:
+                break
+            if self.drop(s):
+                excess -= 1
+        return session
+
+    # Evict sessions that have not been used for a while
+    def evictIdle(self):
+        now = time.time()
+        with self.lock:
+            idle = [s for s in self.sessions.values() if now - s.last_access > self.idle_timeout]
+        for s in idle:
+            self.drop(s)
+
+    # Drop a session from memory after writing its pending changes
+    def evict(self, project_id):
+        with self.lock:
+            session = self.sessions.get(project_id)
+        if session is not None:
+            self.drop(session, wait=True)
+
+    # Write a session's changes and then remove it from the cache, all under the session lock so no request
+    # sees the project between the two; a session whose lock is held (i.e. in use) is skipped unless waiting
+    # Returns whether or not the session was evicted
+    def drop(self, session, wait=False):
+        if not session.lock.acquire(blocking=wait):
+            return False
+        try:
+            if session.evicted or session.users > 0:
+                return False
+            with persister.lock:
+                if persister.pending.get(session.project_id) is session:
+                    del persister.pending[session.project_id]
+                    persister.endpoints.pop(session.project_id, None)
+            if session.loaded and session.dirty:
+                seq, data, static = session.snapshot()
+                persister.write(session.project_id, seq, data, static)
+            with self.lock:
+                if self.sessions.get(session.project_id) is session:
+                    del self.sessions[session.project_id]
+            session.evicted = True
+            return True
+        finally:
+            session.lock.release()
+
+def serializeSnapshot(objects, current_iter=None, events=None):
+    return pickle.dumps({
+        'version': SNAPSHOT_VERSION,
+        'iteration': current_iter,
+        'events': events,   # number of events logged for the project when the snapshot was taken
+        'saved_at': time.time(),
+        'objects': objects,
+    })
+
+# Read the snapshot (or the static objects) of a project directory, or None if the project has none
+def readSnapshot(project_dir, name=SNAPSHOT_NAME):
+    path = os.path.join(project_dir, name)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+        metrics.read('snapshot', f.tell())
+    if snapshot['version'] > SNAPSHOT_VERSION:
+        raise ValueError('Snapshot ' + path + ' has version ' + str(snapshot['version']) + ', but only versions up to ' + str(SNAPSHOT_VERSION) + ' are supported')
+    return snapshot
+
+# Write a snapshot atomically: write a temporary file, fsync it, and rename it over the previous snapshot
+def writeSnapshot(project_dir, data, name=SNAPSHOT_NAME):
+    path = os.path.join(project_dir, name)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    metrics.written('snapshot', len(data))
+
+# Get the names of the objects of a project stored in the legacy layout (one pickle file per object, plus project_info.json)
+def legacyNames(project_dir):
+    return [f for f in os.listdir(project_dir) if f.endswith('.p') or f == 'project_info.json']
+
+def readObject(project_dir, name):
+    path = os.path.join(project_dir, name)
+    metrics.read('legacy', os.path.getsize(path))
+    if name.endswith('.json'):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return pickle.load( open(path, 'rb') )
+
+# Read every object of a project directory, from its snapshot or from the legacy layout
+def readProject(project_dir):
+    snapshot = readSnapshot(project_dir)
+    if snapshot is not None:
+        static = readSnapshot(project_dir, STATIC_NAME)
+        objects = dict(static['objects']) if static is not None else dict()
+        objects.update(snapshot['objects'])
+        return objects
+    return {name: readObject(project_dir, name) for name in legacyNames(project_dir)}
+
+persister = Persister(FLUSH_INTERVAL)
+cache = SessionCache(SESSION_CAPACITY, SESSION_IDLE_TIMEOUT)
+
+# Get the in-memory session of a project
+def get(project_id):
+    return cache.get(project_id)
+
+# Hold the lock of a project's session, e.g. for the duration of a request: the session cannot be evicted meanwhile
+# Usage: with sessions.locked(project_id): ...
+@contextmanager
+def locked(project_id):
+    while True:
+        session = cache.get(project_id)
+        session.lock.acquire()
+        if not session.evicted:
+            break
+        session.lock.release()  # Evicted while waiting for the lock; the next get() reads its snapshot
+    session.users += 1
+    try:
+        yield session
+    finally:
+        session.users -= 1
+        session.lock.release()
+
+# Load an object of a project through its session
+def load(project_id, name):
+    return cache.get(project_id).get(name)
+
+# Get an object of a project's session if the session is in memory, without loading anything
+def peek(project_id, name):
+    with cache.lock:
+        session = cache.sessions.get(project_id)
+    return session.objects.get(name) if session is not None else None
+
+# Store an object of a project through its session
+def dump(project_id, name, obj):
+    cache.get(project_id).set(name, obj)
+
+# Mark the end of an iteration: the project's state is written as one snapshot in the background
+def commit(project_id):
+    persister.schedule(cache.get(project_id))
+
+# Discard a project's changes since its last snapshot (call with the session lock held)
+# Flush the project before the changes to be able to discard them
+def rollback(project_id):
+    session = cache.get(project_id)
+    with persister.lock:
+        persister.pending.pop(project_id, None)
+        persister.endpoints.pop(project_id, None)
+    session.reset()
+
+# Write the snapshot of a project (or of every project) with changes to disk now
+def flush(project_id=None):
+    with cache.lock:
+        active = [s for p_id, s in cache.sessions.items() if project_id is None or p_id == project_id]
+    for s in active:
+        if s.dirty:
+            persister.schedule(s)
+    persister.flush(project_id)
+
+# Count an event logged for a project, so the project's snapshots record which events they include
+def logged(project_id):
+    cache.get(project_id).logged()
+
+# Register objects that can be rebuilt for a project if they are missing from the store
+def register(names, rebuild):
+    for name in names:
+        rebuilders[name] = rebuild
+
+# Register the function that replays a project's logged events onto an older snapshot
+def registerCatchUp(f):
+    global catch_up
+    catch_up = f
+
+def stats():
+    return {
+        'sessions': len(cache.sessions),
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'writes': persister.writes,
+        'coalesced_writes': persister.coalesced,
+        'pending_writes': len(persister.pending),
+    }
+
+atexit.register(flush)
@@ -0,0 +1,240 @@
+# Shares the encoded datasets of the scenarios between processes through named shared memory blocks
+# A publisher places each column's array in its own block and writes a small JSON manifest of the blocks;
+# other processes attach to the blocks as read-only numpy views, so N processes use one copy of the data.
+# Numeric columns are shared as is; text columns are shared as integer codes, which processes use as categorical columns
+# (only each column's unique values are decoded per process). datasets.get returns text columns as categorical columns
+# when it parses the file too, so a dataset looks the same whether or not it is shared.
+# The violation pairs, violations, and support of the hypotheses are not shared (see the README).
+#
+# To publish for other processes (e.g. eval_h.py runs): python shareddata.py publish
+# then run them with DUO_SHARED_MANIFEST set to the manifest path.
+
+import os, sys, json, time, signal, argparse, threading
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import pandas as pd
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+MANIFEST_PATH = './data/shared-manifest.json'  # Default path the publisher writes the manifest to
+MANIFEST_VERSION = 2
+
+# Create a block holding a copy of an array
+def createBlock(arr):
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, {'name': shm.name, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+
+# Attach to an existing block
+def openBlock(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)   # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')     # Only the publisher may unlink the block
+        return shm
+
+# Read-only view of the array in a block
+def blockView(shm, spec):
+    arr = np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=shm.buf)
+    arr.flags.writeable = False
+    return arr
+
+def blockBytes(spec):
+    return int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize
+
+# SharedData: The arrays listed in a manifest
+# The publisher's instance owns the blocks and unlinks them on close; attached instances only unmap them
+class SharedData(object):
+    def __init__(self, manifest, owner=False):
+        self.manifest = manifest
+        self.owner = owner
+        self.blocks = dict()    # block name -> SharedMemory
+        self.lock = threading.Lock()
+
+    # Copy an array into a new block (publisher only)
+    def add(self, arr):
+        shm, spec = createBlock(arr)
+        self.blocks[shm.name] = shm
+        return spec
+
+    def view(self, spec):
+        with self.lock:
+            if spec['name'] not in self.blocks.keys():
+                self.blocks[spec['name']] = openBlock(spec['name'])
+            return blockView(self.blocks[spec['name']], spec)
+
+    # Whether or not the dataset at a path is shared, and unchanged since it was published
+    def has(self, path, stat=None):
+        entry = self.manifest['datasets'].get(os.path.abspath(path))
+        if entry is None:
+            return False
+        stat = stat if stat is not None else os.stat(path)
+        return entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+
+    # Rebuild a dataset as a DataFrame with the values of pd.read_csv(path, keep_default_na=False)
+    # Numeric columns are views of the shared blocks; text columns are categorical columns whose codes are views of the shared blocks
+    def frame(self, path):
+        entry = self.manifest['datasets'][os.path.abspath(path)]
+        columns = dict()
+        for c in entry['columns']:
+            if 'values' in c.keys():
+                columns[c['name']] = pd.Series(self.view(c['values']), copy=False)
+            else:
+                categories = pd.Index(json.loads(self.view(c['uniques']).tobytes()), dtype=c['dtype'])
+                columns[c['name']] = pd.Series(pd.Categorical.from_codes(self.view(c['codes']), categories=categories, validate=False), copy=False)
+        return pd.DataFrame(columns, columns=[c['name'] for c in entry['columns']], copy=False)
+
+    def nbytes(self):
+        return sum(blockBytes(c[k]) for d in self.manifest['datasets'].values() for c in d['columns'] for k in ['values', 'codes', 'uniques'] if k in c.keys())
+
+    def close(self):
+        with self.lock:
+            for shm in self.blocks.values():
+                shm.close()
+                if self.owner:
+                    try:
+                        shm.unlink()
+                    except FileNotFoundError:
+                        pass
+            self.blocks = dict()
+
+# Get the integer type pandas keeps the codes of a categorical column with n categories in, so shared codes are used without a copy
+def codeDtype(n):
+    for dtype in [np.int8, np.int16, np.int32]:
+        if n < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+# Get the integer codes, unique values, and value type of a text (or already categorical) column, in order of appearance
+def textCodes(series):
+    codes, uniques = pd.factorize(series, sort=False)
+    dtype = series.cat.categories.dtype if isinstance(series.dtype, pd.CategoricalDtype) else series.dtype
+    return codes.astype(codeDtype(len(uniques))), list(uniques), str(dtype)
+
+# Encode a dataset column: numeric columns are shared as is, other columns as integer codes plus their unique values
+def encodeColumn(shared, name, series):
+    if series.dtype.kind in 'biuf':
+        return {'name': name, 'values': shared.add(series.to_numpy())}
+    codes, uniques, dtype = textCodes(series)
+    return {
+        'name': name,
+        'dtype': dtype,
+        'codes': shared.add(codes),
+        'uniques': shared.add(np.frombuffer(json.dumps(uniques).encode(), dtype=np.uint8)),
+    }
+
+# Convert the text columns of a dataset to the categorical columns a shared dataset is rebuilt with,
+# so a dataset has the same values and dtypes whether or not it comes from shared memory
+def categorize(data):
+    columns = dict()
+    for col in data.columns:
+        if data[col].dtype.kind in 'biuf':
+            columns[col] = data[col]
+        else:
+            codes, uniques, dtype = textCodes(data[col])
+            columns[col] = pd.Series(pd.Categorical.from_codes(codes, categories=pd.Index(uniques, dtype=dtype), validate=False), index=data.index, copy=False)
+    return pd.DataFrame(columns, columns=data.columns, index=data.index, copy=False)
+
+# Publish datasets (path -> DataFrame)
+# If a manifest path is given, the manifest is also written there for other processes to attach to
+def publish(frames, manifest_path=None):
+    shared = SharedData({'version': MANIFEST_VERSION, 'pid': os.getpid(), 'published_at': time.time(), 'datasets': dict()}, owner=True)
+    try:
+        for path, data in frames.items():
+            stat = os.stat(path)
+            shared.manifest['datasets'][os.path.abspath(path)] = {
+                'mtime_ns': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'columns': [encodeColumn(shared, col, data[col]) for col in data.columns],
+            }
+    except BaseException:
+        shared.close()
+        raise
+    if manifest_path is not None:
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(shared.manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    return shared
+
+# Attach to the data listed in a manifest
+def attach(manifest_path):
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest['version'] > MANIFEST_VERSION:
+        raise ValueError('Manifest ' + manifest_path + ' has version ' + str(manifest['version']) + ', but only versions up to ' + str(MANIFEST_VERSION) + ' are supported')
+    return SharedData(manifest)
+
+current = None  # The shared data this process uses
+current_lock = threading.Lock()
+attached = False
+
+# Get the shared data this process uses, attaching to $DUO_SHARED_MANIFEST on first use
+# Returns None if no data is shared (or the publisher is gone), in which case callers read the files themselves
+def get():
+    global current, attached
+    if not attached:
+        with current_lock:
+            if not attached:
+                path = os.environ.get('DUO_SHARED_MANIFEST')
+                if current is None and path:
+                    try:
+                        current = attach(path)
+                    except (OSError, ValueError) as e:
+                        console.log('[WARNING] Could not attach to shared data ' + path + ':', e)
+                attached = True
+    return current
+
+# Use a SharedData (e.g. the one this process published) for this process and the processes it forks
+def use(shared):
+    global current, attached
+    with current_lock:
+        current = shared
+        attached = True
+
+# Get the dirty and clean datasets of the scenarios
+def scenarioDatasets(scenarios):
+    paths = set()
+    for scenario in scenarios.values():
+        for key in ['dirty_dataset', 'clean_dataset']:
+            if key in scenario.keys() and os.path.isfile(scenario[key]):
+                paths.add(scenario[key])
+    return sorted(paths)
+
+def info(shared):
+    table = Table(title='Shared data (published by pid ' + str(shared.manifest['pid']) + ')')
+    table.add_column('Name')
+    table.add_column('Columns', justify='right')
+    table.add_column('Bytes', justify='right')
+    for path, d in shared.manifest['datasets'].items():
+        table.add_row(os.path.relpath(path), str(len(d['columns'])), str(sum(blockBytes(c[k]) for c in d['columns'] for k in ['values', 'codes', 'uniques'] if k in c.keys())))
+    console.print(table)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Share the scenario datasets between processes')
+    parser.add_argument('command', choices=['publish', 'info'], help='publish: publish the data and keep it available until stopped; info: list the published data')
+    parser.add_argument('--manifest', default=os.environ.get('DUO_SHARED_MANIFEST', MANIFEST_PATH))
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        info(attach(args.manifest))
+        sys.exit(0)
+
+    import scenarios, datasets
+    scenarios.registry.load()
+    snapshot = scenarios.registry.current()
+    paths = scenarioDatasets(snapshot.scenarios)
+    shared = publish({path: datasets.get(path) for path in paths}, args.manifest)
+    console.log('Published the ' + str(len(paths)) + ' datasets of ' + str(len(snapshot.scenarios)) + ' scenarios (' + str(shared.nbytes()) + ' bytes)')
+    console.log('Run other processes with DUO_SHARED_MANIFEST=' + os.path.abspath(args.manifest) + '; press Ctrl-C to stop sharing')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        shared.close()
+        os.remove(args.manifest)
@@ -11,6 +11,7 @@ import math
 import scipy.special as sc
 from scipy.stats import beta as betaD
 import re
+import time
 
 # FD Metadata object
 class FDMeta(object):
@@ -26,6 +27,15 @@ class FDMeta(object):
         self.vios = vios
         self.vio_pairs = vio_pairs
 
+# POST to the API, waiting and retrying while the server says it is busy (503 with Retry-After)
+def post(url, data, max_tries=10):
+    for _ in range(max_tries - 1):
+        r = requests.post(url, data=data)
+        if r.status_code != 503:
+            return r
+        time.sleep(float(r.headers.get('Retry-After', 1)))
+    return requests.post(url, data=data)
+
 # Calculate the initial probability mean for the FD
 def initialPrior(mu, variance):
     beta = (1 - mu) * ((mu * (1 - mu) / variance) - 1)
@@ -45,6 +55,18 @@ def buildFeedbackMap(data, feedback, header):
         feedbackMap[row] = tup
     return feedbackMap
 
+# Parse a sample response in the compact format into the sample ({row ID: {'id': ID, column: value}}) and the marks ([{'row', 'col', 'marked'}])
+def parseSample(res):
+    data = dict()
+    feedback = list()
+    marked = set((i, j) for i, j in res['marked'])
+    for i, (idx, row) in enumerate(zip(res['ids'], res['rows'])):
+        data[str(idx)] = {'id': idx}
+        for j, col in enumerate(res['header']):
+            data[str(idx)][col] = '' if row[j] is None else str(row[j])
+            feedback.append({'row': idx, 'col': col, 'marked': (i, j) in marked})
+    return data, feedback
+
 def shuffleFDs(fds):
     return random.shuffle(fds)
 
@@ -111,7 +133,7 @@ def run(s, b_type, decision_type, stat_calc):
 
     # Start the interaction
     try:
-        r = requests.post('http://localhost:5000/duo/api/import', data={
+        r = post('http://localhost:5000/duo/api/import', {
             'scenario_id': str(s),
             'email': '',
             'initial_fd': 'Not Sure',   # TODO: Logic for what the simulated user thinks at first
@@ -135,26 +157,14 @@ def run(s, b_type, decision_type, stat_calc):
     # Get first sample
     try:
         print('before sample')
-        r = requests.post('http://localhost:5000/duo/api/sample', data={'project_id': project_id})
+        r = post('http://localhost:5000/duo/api/sample', {'project_id': project_id, 'format': 'compact'})
         print('after sample')
         res = r.json()
 
-        sample = res['sample']
-        print('extracted sample')
         sample_X = set(tuple(x) for x in res['X'])
         print('got vios')
-        data = json.loads(sample)
-        feedback = json.loads(res['feedback'])
-        print('parsed data')
-        for row in data.keys():
-            for j in data[row].keys():
-                if j == 'id':
-                    continue
-                if data[row][j] is None:
-                    data[row][j] = ''
-                elif type(data[row][j]) != 'str':
-                    data[row][j] = str(data[row][j])
-        
+        data, feedback = parseSample(res)
+        sample_id = res['sample_id']
         print('prepped data')
     except Exception as e:
         print(e)
@@ -281,36 +291,28 @@ def run(s, b_type, decision_type, stat_calc):
                     iter_marked_rows.add(int(row))
         
         # Set up the feedback representation that will be given to the server
-        feedback = dict()
+        # (only the marked cells; every other cell of the sample is unmarked)
+        marked = list()
         for f in feedbackMap.keys():
-            feedback[data[f]['id']] = feedbackMap[f]
+            marked += [[data[f]['id'], col] for col in feedbackMap[f].keys() if feedbackMap[f][col]]
         
         formData = {
             'project_id': project_id,
-            'feedback': json.dumps(feedback),
+            'sample_id': sample_id,
+            'marked': json.dumps(marked),
             'current_user_h': 'Not Sure',   # TODO: Hypothesize an FD in the simulation in each iteration
             'user_h_comment': '',
+            'format': 'compact',
         }
 
         try:
-            r = requests.post('http://localhost:5000/duo/api/feedback', data=formData)  # Send feedback to server
+            r = post('http://localhost:5000/duo/api/feedback', formData)  # Send feedback to server
             res = r.json()
             msg = res['msg']
             if msg != '[DONE]': # Server says do another iteration
-                sample = res['sample']
                 sample_X = set(tuple(x) for x in res['X'])
-                feedback = json.loads(res['feedback'])
-                data = json.loads(sample)
-
-                for row in data.keys():
-                    for j in data[row].keys():
-                        if j == 'id':
-                            continue
-
-                        if data[row][j] is None:
-                            data[row][j] = ''
-                        elif type(data[row][j]) != 'str':
-                            data[row][j] = str(data[row][j])
+                data, feedback = parseSample(res)
+                sample_id = res['sample_id']
                 if mark_prob < 0.9:
                     mark_prob += 0.05
                 elif mark_prob < 0.95:
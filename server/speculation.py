@@ -0,0 +1,99 @@
+import os, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from rich.console import Console
+
+import helpers, sessions
+
+console = Console()
+ENABLED = os.environ.get('DUO_SPECULATION', '1') != '0'    # Set DUO_SPECULATION=0 to always sample synchronously
+WORKERS = int(os.environ.get('DUO_SPECULATION_WORKERS', 2))    # Number of threads computing next samples
+MAX_PENDING = sessions.SESSION_CAPACITY     # Max number of projects with a next sample in flight
+
+# Speculation: A next sample being computed in the background, and the sample state it is drawn from
+class Speculation(object):
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future
+
+# Speculator: Computes each project's next sample while the participant labels the current one
+# The next sample does not depend on the feedback on the current one, only on the project's sample state,
+# so a speculated sample is used if that state is unchanged when the feedback arrives, and drawn again otherwise
+class Speculator(object):
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = None    # Started on first use, since threads do not survive fork
+        self.pending = OrderedDict()    # project ID -> Speculation
+        self.lock = threading.Lock()
+        self.hits = 0       # speculated sample used
+        self.misses = 0     # sample state changed; sample drawn again
+        self.late = 0       # speculation had not started yet; sample drawn synchronously
+        self.cold = 0       # nothing speculated for the project (e.g. after a restart)
+        self.errors = 0
+
+    # Start computing a project's next sample (call with the project's session lock held)
+    def schedule(self, project_id, data, sample_size, current_iter):
+        state = helpers.SampleState(project_id)
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='speculation')
+            future = self.executor.submit(helpers.drawSample, data, state, sample_size, current_iter)
+            dropped = [self.pending.pop(project_id, None)]
+            self.pending[project_id] = Speculation(state.key, future)
+            while len(self.pending) > self.max_pending:
+                dropped.append(self.pending.popitem(last=False)[1])
+        for s in dropped:
+            if s is not None:
+                s.future.cancel()
+
+    # Get a project's next sample: the speculated one if its sample state is unchanged, or a newly drawn one
+    # (call with the project's session lock held)
+    def take(self, project_id, data, sample_size, current_iter):
+        state = helpers.SampleState(project_id)
+        with self.lock:
+            s = self.pending.pop(project_id, None)
+        result = None
+        if s is None:
+            outcome = 'cold'
+        elif s.future.cancel():
+            outcome = 'late'
+        elif s.key != state.key:
+            outcome = 'misses'
+        else:
+            try:
+                result = s.future.result()
+                outcome = 'hits'
+            except Exception as e:
+                outcome = 'errors'
+                console.log('[ERROR] Failed to speculate the next sample of project ' + project_id + ':', e)
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+        if result is None:
+            result = helpers.drawSample(data, state, sample_size, current_iter)
+        s_index, sample_X = result
+        return data.loc[s_index, :], sample_X
+
+speculator = Speculator(WORKERS, MAX_PENDING)
+
+# Start computing a project's next sample in the background
+def schedule(project_id, data, sample_size, current_iter):
+    if ENABLED:
+        speculator.schedule(project_id, data, sample_size, current_iter)
+
+# Get a project's next sample, using the speculated one if it is still valid
+def take(project_id, data, sample_size, current_iter):
+    return speculator.take(project_id, data, sample_size, current_iter)
+
+def stats():
+    takes = speculator.hits + speculator.misses + speculator.late + speculator.cold + speculator.errors
+    return {
+        'pending': len(speculator.pending),
+        'hits': speculator.hits,
+        'misses': speculator.misses,
+        'late': speculator.late,
+        'cold': speculator.cold,
+        'errors': speculator.errors,
+        'hit_rate': speculator.hits / takes if takes > 0 else None,
+        'miss_rate': (takes - speculator.hits) / takes if takes > 0 else None,
+    }
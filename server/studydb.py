@@ -0,0 +1,216 @@
+import os, json, pickle, sqlite3, threading, zlib
+from contextlib import contextmanager
+from datetime import datetime
+from random import shuffle
+from rich.console import Console
+
+import scenarios
+
+console = Console()
+DB_PATH = './study-utils/study.db'
+USERS_PICKLE_PATH = './study-utils/users.p'
+STORE_DIR = './store/'
+TIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+
+class User(object):
+    def __init__(self):
+        self.scenarios = scenarios.registry.studyScenarios()
+        shuffle(self.scenarios)
+        self.start_time = datetime.now()
+        self.done = list()
+        self.runs = list()
+        self.pre_survey = dict()
+        self.post_questionnaire = dict()
+        self.comments = ''
+        self.background = list()
+        console.log(self.scenarios)
+
+    def asdict(self):
+        return {
+            'scenarios': self.scenarios,
+            'start_time': self.start_time.strftime(TIME_FORMAT),
+            'done': self.done,
+            'runs': self.runs if hasattr(self, 'runs') else None,
+            'pre_survey': self.pre_survey,
+            'post_questionnaire': self.post_questionnaire,
+            'comments': self.comments if hasattr(self, 'comments') else None,
+            'background': self.background
+        }
+
+    # Rebuild a user from its dictionary form
+    @classmethod
+    def fromdict(cls, d):
+        user = cls.__new__(cls)
+        user.scenarios = d['scenarios']
+        user.start_time = datetime.strptime(d['start_time'], TIME_FORMAT)
+        user.done = d['done']
+        user.runs = d['runs'] if d['runs'] is not None else list()
+        user.pre_survey = d['pre_survey']
+        user.post_questionnaire = d['post_questionnaire']
+        user.comments = d['comments'] if d['comments'] is not None else ''
+        user.background = d['background']
+        return user
+
+# Unpickler for the legacy users.p, which pickled User from the module that defined it (api.py, usually run as __main__)
+class UserUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == 'User' and module in ('__main__', 'api'):
+            return User
+        return super().find_class(module, name)
+
+# Open a connection to the study database (one per thread)
+local = threading.local()
+def connect(path=DB_PATH):
+    conns = getattr(local, 'conns', None)
+    if conns is None:
+        conns = local.conns = dict()
+    if path not in conns.keys():
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)  # Autocommit; transactions are opened explicitly
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conns[path] = conn
+    return conns[path]
+
+# Create the users table if it does not exist yet
+def createTable(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+# UserStore: Study participants, stored one row per user so each request only reads and writes its own user
+class UserStore(object):
+    def __init__(self, path=DB_PATH, pickle_path=USERS_PICKLE_PATH):
+        self.path = path
+        self.pickle_path = pickle_path
+        self.ready = False
+        self.lock = threading.Lock()
+
+    def conn(self):
+        if not self.ready:
+            with self.lock:
+                if not self.ready:
+                    conn = connect(self.path)
+                    createTable(conn)
+                    if conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0 and os.path.isfile(self.pickle_path):
+                        self.importPickle(self.pickle_path)  # Migrate the users from the legacy pickle file
+                    self.ready = True
+        return connect(self.path)
+
+    # Get a user, or None if no user exists with this email
+    def get(self, email):
+        row = self.conn().execute('SELECT data FROM users WHERE email = ?', (email,)).fetchone()
+        return None if row is None else User.fromdict(json.loads(row[0]))
+
+    # Add a new user; returns False if a user already exists with this email
+    def create(self, email, user):
+        cur = self.conn().execute('INSERT OR IGNORE INTO users (email, data) VALUES (?, ?)', (email, json.dumps(user.asdict())))
+        return cur.rowcount == 1
+
+    # Read, modify, and write back one user in a single transaction
+    # Yields None if no user exists with this email
+    @contextmanager
+    def edit(self, email):
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM users WHERE email = ?', (email,)).fetchone()
+            user = None if row is None else User.fromdict(json.loads(row[0]))
+            yield user
+            if user is not None:
+                conn.execute('UPDATE users SET data = ? WHERE email = ?', (json.dumps(user.asdict()), email))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    # Get all users as a dictionary of email -> User (the legacy users.p format)
+    def all(self):
+        return {email: User.fromdict(json.loads(data)) for email, data in self.conn().execute('SELECT email, data FROM users ORDER BY rowid')}
+
+    # Write all users to a pickle file in the legacy users.p format (used by pkl2json.py and anonymize.py)
+    def exportPickle(self, path=None):
+        pickle.dump( self.all(), open(path if path is not None else self.pickle_path, 'wb') )
+
+    # Load users from a pickle file in the legacy users.p format
+    # If replace is True, users that are not in the file are removed from the store
+    def importPickle(self, path=None, replace=False):
+        users = UserUnpickler( open(path if path is not None else self.pickle_path, 'rb') ).load()
+        conn = connect(self.path)
+        createTable(conn)   # The store may not have been used yet (e.g. by anonymize.py)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if replace:
+                conn.execute('DELETE FROM users')
+            for email, user in users.items():
+                conn.execute('INSERT OR REPLACE INTO users (email, data) VALUES (?, ?)', (email, json.dumps(user.asdict())))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        console.log('Imported ' + str(len(users)) + ' users from ' + (path if path is not None else self.pickle_path))
+
+# ProjectIdAllocator: Hands out project IDs from a persisted counter, so creating a project does not scan the store
+# The increment runs in a write transaction, so concurrent workers never get the same ID
+# Under serve.py, each worker only takes the IDs it owns (see projectOwner), skipping the others
+class ProjectIdAllocator(object):
+    def __init__(self, path=DB_PATH, store_dir=STORE_DIR):
+        self.path = path
+        self.store_dir = store_dir
+        self.ready = False
+        self.lock = threading.Lock()
+        self.shard = None   # (worker index, number of workers), or None to take every ID
+
+    def conn(self):
+        if not self.ready:
+            with self.lock:
+                if not self.ready:
+                    conn = connect(self.path)
+                    conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+                    conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        if conn.execute("SELECT value FROM counters WHERE name = 'project_id'").fetchone() is None:
+                            conn.execute("INSERT INTO counters (name, value) VALUES ('project_id', ?)", (self.lastStoredId(),))  # Continue after the projects already in the store
+                        conn.execute('COMMIT')
+                    except BaseException:
+                        conn.execute('ROLLBACK')
+                        raise
+                    self.ready = True
+        return connect(self.path)
+
+    # Get the largest project ID in the store (only scanned once, when the counter is created)
+    def lastStoredId(self):
+        if not os.path.isdir(self.store_dir):
+            return 0
+        project_ids = list()
+        for d in os.listdir(self.store_dir):
+            if os.path.isdir(os.path.join(self.store_dir, d)):
+                try:
+                    project_ids.append(int(d, 16))
+                except ValueError:
+                    continue
+        return max(project_ids) if len(project_ids) > 0 else 0
+
+    # Get the next project ID
+    def next(self):
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            value = conn.execute("SELECT value FROM counters WHERE name = 'project_id'").fetchone()[0] + 1
+            if self.shard is not None:
+                index, n = self.shard
+                value += (index - value) % n   # The next ID that this worker owns
+            conn.execute("UPDATE counters SET value = ? WHERE name = 'project_id'", (value,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return '{:08x}'.format(value)
+
+# Get the index of the worker (out of n) that owns a project: a pure function of the project ID,
+# so the router and the worker that creates the project always agree
+def projectOwner(project_id, n):
+    try:
+        return int(project_id, 16) % n
+    except (ValueError, TypeError):    # Not an allocated ID
+        return zlib.crc32(str(project_id).encode()) % n
+
+users = UserStore()
+project_ids = ProjectIdAllocator()
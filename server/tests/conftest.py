@@ -0,0 +1,64 @@
+import os, sys, json
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+os.environ.setdefault('DUO_WARMUP', '0')
+
+import pandas as pd
+
+SCENARIO_ID = '1'
+
+# Build scenarios.json with only the hypotheses the tests need, so preprocessing (and CFDD) need not run
+def buildScenarios():
+    import preprocessing
+    with open(os.path.join(SERVER_DIR, 'scenarios-master.json'), 'r') as f:
+        scenario = json.load(f)[SCENARIO_ID]
+    data = pd.read_csv(scenario['dirty_dataset'], keep_default_na=False)
+    clean_data = pd.read_csv(scenario['clean_dataset'], keep_default_na=False)
+    preprocessing.worker_datasets[SCENARIO_ID] = (data, clean_data, None)
+    results = [preprocessing.evaluateFD((SCENARIO_ID, fd, False, False)) for fd in [scenario['target_fd']] + scenario['alt_h']]
+    scenario['hypothesis_space'] = [h for h, _, _ in results]
+    scenario['clean_hypothesis_space'] = [clean_h for _, clean_h, _ in results]
+    scenario['diff'] = json.loads(preprocessing.dataDiff(data, clean_data).to_json(orient='index'))
+    scenario['sampling_method'] = 'DUO'
+    scenario['update_method'] = 'BAYESIAN'
+    with open('scenarios.json', 'w') as f:
+        json.dump({SCENARIO_ID: scenario}, f)
+
+# Run the tests in a scratch directory laid out like server/ (the server reads and writes paths relative to it)
+@pytest.fixture(scope='session', autouse=True)
+def workspace(tmp_path_factory):
+    path = tmp_path_factory.mktemp('server')
+    for name in ['data', 'scenarios-for-study.json']:
+        os.symlink(os.path.join(SERVER_DIR, name), os.path.join(path, name))
+    os.mkdir(os.path.join(path, 'store'))
+    os.mkdir(os.path.join(path, 'study-utils'))
+    cwd = os.getcwd()
+    os.chdir(path)
+    buildScenarios()
+    yield path
+    import sessions, eventlog
+    sessions.flush()    # Write what is pending before leaving the directory, rather than at exit
+    eventlog.writer.sync()
+    os.chdir(cwd)
+
+@pytest.fixture
+def client():
+    import api
+    return api.app.test_client()
+
+# Start a project for a new user and get its first sample (in the compact format)
+@pytest.fixture
+def project(client, request):
+    email = request.node.name + '@test'
+    client.post('/duo/api/start', json={'email': email})
+    client.post('/duo/api/pre-survey', json={'email': email, 'scenario_id': SCENARIO_ID, 'answers': {}})
+    res = client.post('/duo/api/import', json={'email': email, 'scenario_id': SCENARIO_ID, 'initial_fd': '(manager) => owner', 'fd_comment': ''})
+    project_id = res.get_json()['project_id']
+    sample = client.post('/duo/api/sample', json={'project_id': project_id, 'format': 'compact'}).get_json()
+    return project_id, sample
+
+# Full-map feedback on a compact sample, marking the given (row ID, column) cells
+def fullFeedback(sample, marked=()):
+    return {str(idx): {col: (idx, col) in marked for col in sample['header']} for idx in sample['ids']}
@@ -0,0 +1,51 @@
+import sessions, eventlog, helpers
+from conftest import fullFeedback
+
+def submit(client, project_id, **sub):
+    sub.update({'project_id': project_id, 'current_user_h': '(manager) => owner', 'user_h_comment': '', 'format': 'compact'})
+    return client.post('/duo/api/feedback', json=sub)
+
+def liveState(project_id):
+    return {name: sessions.load(project_id, name) for name in eventlog.REPLAYED}
+
+def assertSameState(replayed, live):
+    r_im, l_im = replayed['interaction_metadata.p'], live['interaction_metadata.p']
+    assert r_im['feedback_history'].asdict() == l_im['feedback_history'].asdict()
+    assert [m.asdict() for m in r_im['sample_history']] == [m.asdict() for m in l_im['sample_history']]
+    assert [m.asdict() for m in r_im['user_hypothesis_history']] == [m.asdict() for m in l_im['user_hypothesis_history']]
+    assert replayed['fd_metadata.p'].keys() == live['fd_metadata.p'].keys()
+    for fd, fd_m in live['fd_metadata.p'].items():
+        r_fd_m = replayed['fd_metadata.p'][fd].asdict()
+        l_fd_m = fd_m.asdict()
+        assert {tuple(vp) for vp in r_fd_m.pop('vio_pairs')} == {tuple(vp) for vp in l_fd_m.pop('vio_pairs')}   # Listed in set order
+        assert r_fd_m == l_fd_m
+
+def test_replay_matches_live_state(client, project):
+    project_id, sample = project
+    for i in range(4):
+        if i % 2 == 0:
+            res = submit(client, project_id, feedback=fullFeedback(sample, {(sample['ids'][0], sample['header'][-1])}))
+        else:
+            res = submit(client, project_id, sample_id=sample['sample_id'], marked=[[sample['ids'][1], sample['header'][0]]])
+        assert res.status_code == 200, res.get_json()
+        sample = res.get_json()
+    sessions.flush(project_id)
+
+    assertSameState(eventlog.replay(project_id), liveState(project_id))
+
+def test_rejected_feedback_is_not_logged(client, project):
+    project_id, sample = project
+    n_events = len(eventlog.read(project_id))
+    bad = [
+        dict(fullFeedback(sample), **{'999999': {col: False for col in sample['header']}}),  # Row outside of the sample
+        {idx: dict(cells, unknown=True) for idx, cells in fullFeedback(sample).items()},    # Unknown column
+        {idx: {col: False for col in sample['header'][1:]} for idx in fullFeedback(sample)},  # Missing column
+    ]
+    for feedback in bad:
+        res = submit(client, project_id, feedback=feedback)
+        assert res.status_code == 400
+        assert len(eventlog.read(project_id)) == n_events
+
+    res = submit(client, project_id, feedback=fullFeedback(sample))
+    assert res.status_code == 200
+    assertSameState(eventlog.replay(project_id), liveState(project_id))
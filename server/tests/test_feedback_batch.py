@@ -0,0 +1,69 @@
+import pytest
+import sessions, eventlog, helpers
+from conftest import fullFeedback
+
+def projectState(project_id):
+    return {
+        'events': len(eventlog.read(project_id)),
+        'current_iter': sessions.load(project_id, 'current_iter.p'),
+        'current_sample': list(sessions.load(project_id, 'current_sample.p')),
+        'feedback_history': sessions.load(project_id, 'interaction_metadata.p')['feedback_history'].asdict(),
+        'alphas': {fd: fd_m.alpha for fd, fd_m in sessions.load(project_id, 'fd_metadata.p').items()},
+    }
+
+def submission(**sub):
+    return dict(sub, current_user_h='(manager) => owner', user_h_comment='')
+
+def test_batch_applies_submissions_in_order(client, project):
+    project_id, sample = project
+    before = projectState(project_id)
+    subs = [submission(feedback=fullFeedback(sample))] + [submission(sample_id=sample['sample_id'] + k, marked=[]) for k in (1, 2)]
+    res = client.post('/duo/api/feedback-batch', json={'project_id': project_id, 'submissions': subs, 'format': 'compact'})
+    assert res.status_code == 200, res.get_json()
+    body = res.get_json()
+    assert body['applied'] == 3
+    assert [s['sample_id'] for s in body['samples']] == [sample['sample_id'] + k for k in (1, 2, 3)]
+    assert body['state']['current_iter'] == before['current_iter'] + 3
+    assert projectState(project_id)['events'] == before['events'] + 9    # Feedback, sample, and hypothesis per submission
+
+@pytest.mark.parametrize('bad', [
+    submission(sample_id=0, marked=[]),     # Stale sample
+    submission(feedback={'999999': {}}),    # Row outside of the sample
+    submission(marked=[]),  # No sample ID
+    'not a submission',
+    {'feedback': {}},   # No hypothesis
+])
+def test_failed_batch_applies_nothing(client, project, bad):
+    project_id, sample = project
+    before = projectState(project_id)
+    subs = [submission(feedback=fullFeedback(sample)), bad]
+    res = client.post('/duo/api/feedback-batch', json={'project_id': project_id, 'submissions': subs})
+    assert res.status_code == 400
+    assert res.get_json()['msg'].startswith('[ERROR] Submission 1')
+    assert projectState(project_id) == before
+
+def test_unexpected_error_rolls_back(client, project, monkeypatch):
+    project_id, sample = project
+    before = projectState(project_id)
+    calls = list()
+    def interpretFeedback(*args, **kwargs):     # Fail from the second submission on, after the first one was applied
+        calls.append(args)
+        if len(calls) >= 2:
+            raise RuntimeError('interpretation failed')
+        return original(*args, **kwargs)
+    original = helpers.interpretFeedback
+    monkeypatch.setattr(helpers, 'interpretFeedback', interpretFeedback)
+    client.application.config['PROPAGATE_EXCEPTIONS'] = True
+    try:
+        with pytest.raises(RuntimeError):
+            client.post('/duo/api/feedback-batch', json={'project_id': project_id, 'submissions': [submission(feedback=fullFeedback(sample)), submission(sample_id=sample['sample_id'] + 1, marked=[])]})
+        with pytest.raises(RuntimeError):
+            client.post('/duo/api/feedback', json=dict(submission(feedback=fullFeedback(sample)), project_id=project_id))
+    finally:
+        client.application.config['PROPAGATE_EXCEPTIONS'] = None
+    assert projectState(project_id) == before
+
+    monkeypatch.setattr(helpers, 'interpretFeedback', original)
+    res = client.post('/duo/api/feedback', json=dict(submission(feedback=fullFeedback(sample)), project_id=project_id))
+    assert res.status_code == 200
+    assert projectState(project_id)['current_iter'] == before['current_iter'] + 1
@@ -0,0 +1,57 @@
+import pytest
+import pandas as pd
+import payloads, sessions, eventlog
+
+ROWS = pd.Index([3, 7, 11])
+HEADER = ['facilityname', 'type', 'manager', 'owner']
+
+def test_sparse_feedback():
+    feedback = payloads.sparseFeedback('4', [[7, 'owner'], ['11', 'type']], 4, ROWS, HEADER)
+    assert feedback.rows == [3, 7, 11]
+    assert feedback.marked == [(7, 'owner'), (11, 'type')]
+    assert feedback.markedRows() == [7, 11]
+
+@pytest.mark.parametrize('sample_id, marked, message', [
+    (3, [], 'Feedback is for sample 3, but the current sample is 4'),    # Stale sample
+    (None, [], 'Feedback is for sample None'),
+    (4, [[8, 'owner']], 'Cell (8, owner) is not in the current sample'),   # Row outside of the sample
+    (4, [[7, 'id']], 'Cell (7, id) is not in the current sample'),     # Unknown column
+])
+def test_sparse_feedback_errors(sample_id, marked, message):
+    with pytest.raises(ValueError, match=message.replace('(', r'\(').replace(')', r'\)')):
+        payloads.sparseFeedback(sample_id, marked, 4, ROWS, HEADER)
+
+@pytest.mark.parametrize('feedback, message', [
+    ({'3': {c: False for c in HEADER}, '8': {c: False for c in HEADER}}, 'Row 8 is not in the current sample'),
+    ({'3': dict({c: False for c in HEADER}, id=True)}, r'Cell \(3, id\) is not in the current sample'),
+    ({'3': {c: False for c in HEADER[1:]}}, 'Row 3 is missing column facilityname'),
+    ({'3': True}, 'Row 3 must map the columns'),
+    ([], 'Feedback must map the rows'),
+])
+def test_full_feedback_errors(feedback, message):
+    with pytest.raises(ValueError, match=message):
+        payloads.fullFeedback(feedback, ROWS, HEADER)
+
+def test_rejected_sparse_feedback_changes_nothing(client, project):
+    project_id, sample = project
+    n_events = len(eventlog.read(project_id))
+    current_iter = sessions.load(project_id, 'current_iter.p')
+    base = {'project_id': project_id, 'current_user_h': '(manager) => owner', 'user_h_comment': ''}
+    bad = [
+        {'sample_id': sample['sample_id'] - 1, 'marked': []},
+        {'sample_id': sample['sample_id'], 'marked': [[999999, sample['header'][0]]]},
+        {'sample_id': sample['sample_id'], 'marked': [[sample['ids'][0], 'unknown']]},
+        {'sample_id': sample['sample_id'], 'marked': [[sample['ids'][0]]]},   # Not a (row, column) pair
+        {'sample_id': sample['sample_id'], 'marked': 'all'},
+        {'marked': []},     # No sample ID
+    ]
+    for sub in bad:
+        res = client.post('/duo/api/feedback', json=dict(base, **sub))
+        assert res.status_code == 400, sub
+        assert res.get_json()['msg'].startswith('[ERROR]')
+    assert len(eventlog.read(project_id)) == n_events
+    assert sessions.load(project_id, 'current_iter.p') == current_iter
+
+    res = client.post('/duo/api/feedback', json=dict(base, sample_id=sample['sample_id'], marked=[[sample['ids'][0], sample['header'][0]]]))
+    assert res.status_code == 200
+    assert sessions.load(project_id, 'interaction_metadata.p')['feedback_history'].marked(sample['ids'][0], sample['header'][0])
@@ -0,0 +1,31 @@
+import os, json
+import samplepools
+from conftest import SCENARIO_ID
+
+def test_pools_are_picked_up_once_built(tmp_path, monkeypatch):
+    monkeypatch.setattr(samplepools, 'POOL_DIR', str(tmp_path) + '/')
+    monkeypatch.setattr(samplepools, 'pools', dict())
+    with open('scenarios.json', 'r') as f:
+        scenario = json.load(f)[SCENARIO_ID]
+    target_vio_pairs, alt_h_vio_pairs = samplepools.scenarioVioPairs(scenario)
+    ratios = samplepools.SAMPLE_RATIOS[0]
+
+    assert samplepools.getPool(SCENARIO_ID, *ratios, target_vio_pairs, alt_h_vio_pairs) is None
+    samplepools.buildPool(SCENARIO_ID, scenario, *ratios, size=5)
+    pool = samplepools.getPool(SCENARIO_ID, *ratios, target_vio_pairs, alt_h_vio_pairs)   # Not the None of the first call
+    assert pool is not None and pool.size == 5
+    assert samplepools.getPool(SCENARIO_ID, *ratios, target_vio_pairs, alt_h_vio_pairs) is pool
+
+    os.remove(samplepools.poolPath(SCENARIO_ID, *ratios))
+    assert samplepools.getPool(SCENARIO_ID, *ratios, target_vio_pairs, alt_h_vio_pairs) is None
+
+def test_stale_pools_are_not_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(samplepools, 'POOL_DIR', str(tmp_path) + '/')
+    monkeypatch.setattr(samplepools, 'pools', dict())
+    with open('scenarios.json', 'r') as f:
+        scenario = json.load(f)[SCENARIO_ID]
+    target_vio_pairs, alt_h_vio_pairs = samplepools.scenarioVioPairs(scenario)
+    ratios = samplepools.SAMPLE_RATIOS[0]
+
+    samplepools.buildPool(SCENARIO_ID, scenario, *ratios, size=5)
+    assert samplepools.getPool(SCENARIO_ID, *ratios, set(target_vio_pairs) | {(-1, -2)}, alt_h_vio_pairs) is None
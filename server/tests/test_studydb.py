@@ -0,0 +1,45 @@
+import sys, pickle
+from datetime import datetime
+import studydb
+
+# The User class of the legacy api.py, which pickled it as __main__.User
+class User(object):
+    pass
+
+def writeLegacyUsers(path, monkeypatch, module):
+    user = User()
+    user.scenarios = ['1', '2']
+    user.start_time = datetime(2021, 3, 4, 5, 6, 7)
+    user.done = ['1']
+    user.pre_survey = {'q': 'a'}
+    user.post_questionnaire = dict()
+    user.background = list()    # Users of older versions have no runs or comments
+    monkeypatch.setattr(User, '__module__', module)
+    monkeypatch.setattr(sys.modules[module], 'User', User, raising=False)
+    with open(path, 'wb') as f:
+        pickle.dump({'legacy@test': user}, f)
+    monkeypatch.delattr(sys.modules[module], 'User')
+
+def test_migrates_legacy_users_pickle(tmp_path, monkeypatch):
+    writeLegacyUsers(tmp_path / 'users.p', monkeypatch, '__main__')
+    users = studydb.UserStore(str(tmp_path / 'study.db'), str(tmp_path / 'users.p'))
+
+    user = users.get('legacy@test')
+    assert isinstance(user, studydb.User)
+    assert user.scenarios == ['1', '2']
+    assert user.start_time == datetime(2021, 3, 4, 5, 6, 7)
+    assert user.done == ['1']
+    assert user.pre_survey == {'q': 'a'}
+    assert user.runs == [] and user.comments == ''
+
+def test_imports_users_pickled_by_api_module(tmp_path, monkeypatch):
+    import api
+    writeLegacyUsers(tmp_path / 'users.p', monkeypatch, 'api')
+    users = studydb.UserStore(str(tmp_path / 'study.db'), str(tmp_path / 'users.p'))
+    assert users.get('legacy@test').done == ['1']
+
+def test_imports_pickle_into_new_store(tmp_path, monkeypatch):
+    writeLegacyUsers(tmp_path / 'users.p', monkeypatch, '__main__')
+    users = studydb.UserStore(str(tmp_path / 'study.db'), str(tmp_path / 'none.p'))
+    users.importPickle(str(tmp_path / 'users.p'), replace=True)
+    assert list(users.all().keys()) == ['legacy@test']
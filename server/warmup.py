@@ -0,0 +1,88 @@
+# Warms up a server process before it takes requests, so the first request of each scenario does not pay for loading it:
+# loads the scenario definitions and parses (or attaches to) the scenarios' datasets; their sample pools are loaded in the
+# background once the server is up. Reports how long the process took to get ready.
+
+import os, time, threading
+from contextlib import contextmanager
+from rich.console import Console
+
+import scenarios, datasets, samplepools, shareddata
+
+console = Console()
+ENABLED = os.environ.get('DUO_WARMUP', '1') != '0'     # Set DUO_WARMUP=0 to start serving right away and load everything on first use
+FAST_START = os.environ.get('DUO_FAST_START', '0') == '1'  # Set DUO_FAST_START=1 to run api.py without debug mode and its reloader, which starts a second process
+timings = dict()    # warmup phase -> seconds
+ready_after = None  # seconds from the start of the process until it was ready
+
+# Seconds since this process started (or was forked), or None if the OS does not tell
+def processAge():
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Time a phase of the warmup
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+# Load the scenario definitions and parse their datasets
+# Returns the scenario snapshot and the paths of the datasets
+def loadScenarios():
+    with phase('scenarios'):
+        scenarios.registry.load()
+        snapshot = scenarios.registry.current()
+        paths = shareddata.scenarioDatasets(snapshot.scenarios)
+        datasets.preload(paths)
+    return snapshot, paths
+
+# Load the sample pools of the scenarios (in each worker, since every worker draws from its own copy)
+def loadPools(snapshot):
+    n = 0
+    with phase('pools'):
+        for s_id, scenario in snapshot.scenarios.items():
+            if 'hypothesis_space' not in scenario.keys():
+                continue
+            target_vio_pairs, alt_h_vio_pairs = samplepools.scenarioVioPairs(scenario)
+            for target_h_sample_ratio, alt_h_sample_ratio in samplepools.SAMPLE_RATIOS:
+                if samplepools.getPool(s_id, target_h_sample_ratio, alt_h_sample_ratio, target_vio_pairs, alt_h_vio_pairs) is not None:
+                    n += 1
+    return n
+
+# Load the sample pools in a background thread, so the server takes requests meanwhile
+# (a request that needs a pool before then loads it itself)
+def loadPoolsLater(snapshot):
+    def run():
+        try:
+            n = loadPools(snapshot)
+            console.log('Loaded ' + str(n) + ' sample pools in the background in ' + '%.2f' % timings['pools'] + ' s')
+        except Exception as e:
+            console.log('[ERROR] Failed to load the sample pools:', e)
+    threading.Thread(target=run, daemon=True).start()
+
+# Warm up everything a single-process server uses (the sample pools in the background)
+def warmup():
+    snapshot, paths = loadScenarios()
+    console.log('Warmed up ' + str(len(snapshot.scenarios)) + ' scenarios and ' + str(len(paths)) + ' datasets')
+    loadPoolsLater(snapshot)
+
+# Mark this process as ready to take requests, and report how long it took
+def ready(name='Server'):
+    global ready_after
+    ready_after = processAge()
+    phases = ', '.join(p + ' ' + '%.2f' % t + ' s' for p, t in list(timings.items()))
+    console.log(name + ' ready' + (' ' + '%.2f' % ready_after + ' s after start' if ready_after is not None else '') + (' (' + phases + ')' if phases else ''))
+
+def stats():
+    stats = {'ready_after_seconds': ready_after}
+    for p, t in list(timings.items()):     # The pools may still be loading in the background
+        stats[p + '_seconds'] = t
+    return stats